@@ -0,0 +1,318 @@
+# Local Bank Statement Parsers
+# Rule-based parsing of digital statements from banks with stable table layouts.
+# The bank is detected from the first page, transactions are read from the ruled
+# tables pdfplumber finds, and the result is only trusted when every running
+# balance follows from the previous one. Anything else goes to the model.
+
+import re
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from statement_merge import balance_continuity
+
+# Bump when parsing rules change, so cached results are not reused
+PARSER_VERSION = "1"
+
+DEFAULT_DATE_FORMATS = (
+    "%d/%m/%Y", "%d/%m/%y", "%d-%m-%Y", "%d-%m-%y", "%d.%m.%Y",
+    "%d %b %Y", "%d-%b-%Y", "%d %b %y", "%d-%b-%y", "%d/%b/%Y", "%Y-%m-%d"
+)
+
+# "1234.50", "1,234.50", "1234.50 Cr", "1234.50Dr"
+_MONEY = re.compile(r"^(-?\d+(?:\.\d+)?)\s*(Cr|Dr)?\.?$", re.IGNORECASE)
+
+_ACCOUNT_NUMBER = re.compile(
+    r"(?:A/?C|Account)\s*(?:No\.?|Number|#)?\s*[:.\-]?\s*([X*\d][X*\d\s\-]{5,24}\d)",
+    re.IGNORECASE
+)
+
+# Narration keywords -> suggested Tally ledger; first match wins
+CONTRA_LEDGER_RULES = (
+    (re.compile(r"\bSAL(ARY)?\b", re.IGNORECASE), "Salary"),
+    (re.compile(r"\bINTEREST\b|\bINT\.?\s*(PD|PAID)\b", re.IGNORECASE), "Interest Received"),
+    (re.compile(r"\bCHGS?\b|\bCHARGES?\b|\bFEES?\b|\bGST\b|\bAMC\b|\bSMS\b", re.IGNORECASE), "Bank Charges"),
+    (re.compile(r"\bATM\b|\bCASH\b|\bCSH\b", re.IGNORECASE), "Cash"),
+)
+
+
+def _normalize_header(text: str) -> str:
+    return re.sub(r"[^a-z0-9]", "", text.lower())
+
+
+def _parse_money(cell: str) -> Optional[float]:
+    """Parse an amount cell; '' -> None, Dr balances are negative. Raises ValueError if unreadable."""
+    text = cell.replace(",", "").strip()
+    if not text or text in ("-", "--"):
+        return None
+    match = _MONEY.match(text)
+    if not match:
+        raise ValueError(f"unreadable amount {cell!r}")
+    value = float(match.group(1))
+    if (match.group(2) or "").lower() == "dr":
+        value = -value
+    return value
+
+
+def suggest_contra_ledger(description: str) -> str:
+    for pattern, ledger in CONTRA_LEDGER_RULES:
+        if pattern.search(description):
+            return ledger
+    return "Suspense A/c"
+
+
+class StatementParseError(Exception):
+    """The statement does not match the layout (or its balances do not add up)"""
+
+
+class BankLayout:
+    """
+    Table layout of one bank's digital statements.
+
+    Args:
+        name: Bank name reported as bankName
+        patterns: Regexes that identify the bank in the first page's text
+        columns: Field -> header aliases, most specific first. Fields are date,
+            description, withdrawal, deposit and balance.
+        date_formats: strptime formats tried for the date column
+    """
+
+    REQUIRED_FIELDS = ("date", "description", "balance")
+
+    def __init__(
+        self,
+        name: str,
+        patterns: List[str],
+        columns: Dict[str, List[str]],
+        date_formats: Tuple[str, ...] = DEFAULT_DATE_FORMATS
+    ):
+        self.name = name
+        self.patterns = [re.compile(p, re.IGNORECASE) for p in patterns]
+        self.columns = {field: [_normalize_header(a) for a in aliases] for field, aliases in columns.items()}
+        self.date_formats = date_formats
+
+    def detect(self, header_text: str) -> Optional[int]:
+        """Position of the earliest bank name match in header_text, or None"""
+        positions = [m.start() for m in (p.search(header_text) for p in self.patterns) if m]
+        return min(positions) if positions else None
+
+    def map_columns(self, header_row: List[str]) -> Optional[Dict[str, int]]:
+        """Column index of each field if header_row is this layout's header, else None"""
+        cells = [_normalize_header(cell) for cell in header_row]
+        mapping = {}
+        for field, aliases in self.columns.items():
+            for alias in aliases:
+                index = next((i for i, cell in enumerate(cells) if cell and cell.startswith(alias) and i not in mapping.values()), None)
+                if index is not None:
+                    mapping[field] = index
+                    break
+        if any(field not in mapping for field in self.REQUIRED_FIELDS):
+            return None
+        if "withdrawal" not in mapping and "deposit" not in mapping:
+            return None
+        return mapping
+
+    def parse_date(self, cell: str) -> Optional[str]:
+        text = cell.strip()
+        for fmt in self.date_formats:
+            try:
+                return datetime.strptime(text, fmt).strftime("%Y-%m-%d")
+            except ValueError:
+                continue
+        return None
+
+    def parse_transactions(self, tables: List[List[List[str]]]) -> List[dict]:
+        """
+        Read transactions from the statement's tables, in document order.
+
+        Tables without this layout's header continue the previous table when they
+        have the same width (statements that do not repeat the header per page).
+
+        Raises:
+            StatementParseError: No matching table, or a row that cannot be read
+        """
+        transactions = []
+        mapping, width = None, None
+
+        for rows in tables:
+            header = self.map_columns(rows[0])
+            if header is not None:
+                mapping, width = header, len(rows[0])
+                rows = rows[1:]
+            elif mapping is None or len(rows[0]) != width:
+                continue
+
+            for row in rows:
+                self._parse_row(row, mapping, transactions)
+
+        if mapping is None:
+            raise StatementParseError("no transaction table with the expected columns")
+        return transactions
+
+    def _parse_row(self, row: List[str], mapping: Dict[str, int], transactions: List[dict]):
+        def cell(field: str) -> str:
+            return row[mapping[field]] if field in mapping else ""
+
+        try:
+            withdrawal = _parse_money(cell("withdrawal"))
+            deposit = _parse_money(cell("deposit"))
+            balance = _parse_money(cell("balance"))
+        except ValueError as e:
+            raise StatementParseError(str(e))
+        description = cell("description")
+        date = self.parse_date(cell("date"))
+
+        if withdrawal is None and deposit is None:
+            if date is None and balance is None and description and transactions:
+                # Narration wrapped onto a row of its own
+                transactions[-1]["description"] += " " + description
+            # Opening balance, sub-headers and blank rows carry no transaction
+            return
+        if date is None:
+            if re.search(r"\btotal", " ".join(row), re.IGNORECASE):
+                return
+            raise StatementParseError(f"transaction row without a readable date: {row}")
+        if balance is None:
+            raise StatementParseError(f"transaction row without a balance: {row}")
+
+        withdrawal, deposit = withdrawal or 0.0, deposit or 0.0
+        transactions.append({
+            "id": f"txn-{len(transactions) + 1}",
+            "date": date,
+            "description": description,
+            "withdrawal": withdrawal,
+            "deposit": deposit,
+            "balance": balance,
+            "voucherType": "Payment" if withdrawal else "Receipt",
+            "contraLedger": suggest_contra_ledger(description)
+        })
+
+
+# ============================================================
+# LAYOUT REGISTRY
+# ============================================================
+BANK_LAYOUTS: List[BankLayout] = []
+
+
+def register_layout(layout: BankLayout) -> BankLayout:
+    """Add a bank layout; detection tries every registered layout"""
+    BANK_LAYOUTS.append(layout)
+    return layout
+
+
+register_layout(BankLayout(
+    "HDFC Bank",
+    [r"\bHDFC\s*BANK\b"],
+    {
+        "date": ["Date", "Txn Date"],
+        "description": ["Narration", "Description"],
+        "withdrawal": ["Withdrawal Amt", "Withdrawal", "Debit"],
+        "deposit": ["Deposit Amt", "Deposit", "Credit"],
+        "balance": ["Closing Balance", "Balance"]
+    }
+))
+
+register_layout(BankLayout(
+    "ICICI Bank",
+    [r"\bICICI\s*BANK\b"],
+    {
+        "date": ["Transaction Date", "Txn Date", "Value Date", "Date"],
+        "description": ["Transaction Remarks", "Remarks", "Particulars", "Description"],
+        "withdrawal": ["Withdrawal Amount", "Withdrawal", "Debit"],
+        "deposit": ["Deposit Amount", "Deposit", "Credit"],
+        "balance": ["Balance"]
+    }
+))
+
+register_layout(BankLayout(
+    "State Bank of India",
+    [r"\bSTATE\s+BANK\s+OF\s+INDIA\b", r"\bSBI\b"],
+    {
+        "date": ["Txn Date", "Transaction Date", "Date", "Value Date"],
+        "description": ["Description", "Narration", "Particulars"],
+        "withdrawal": ["Debit", "Withdrawal"],
+        "deposit": ["Credit", "Deposit"],
+        "balance": ["Balance"]
+    }
+))
+
+register_layout(BankLayout(
+    "Axis Bank",
+    [r"\bAXIS\s*BANK\b"],
+    {
+        "date": ["Tran Date", "Txn Date", "Transaction Date", "Date"],
+        "description": ["Particulars", "Description", "Narration"],
+        "withdrawal": ["Debit", "Withdrawal", "Dr"],
+        "deposit": ["Credit", "Deposit", "Cr"],
+        "balance": ["Balance"]
+    }
+))
+
+register_layout(BankLayout(
+    "Kotak Mahindra Bank",
+    [r"\bKOTAK\s*MAHINDRA\s*BANK\b", r"\bKOTAK\b"],
+    {
+        "date": ["Transaction Date", "Date"],
+        "description": ["Narration", "Description", "Particulars"],
+        "withdrawal": ["Withdrawal", "Debit", "Dr"],
+        "deposit": ["Deposit", "Credit", "Cr"],
+        "balance": ["Balance"]
+    }
+))
+
+
+def detect_bank(header_text: str) -> Optional[BankLayout]:
+    """The registered layout whose bank name appears first in header_text"""
+    matches = [(position, layout) for layout in BANK_LAYOUTS if (position := layout.detect(header_text)) is not None]
+    return min(matches, key=lambda match: match[0])[1] if matches else None
+
+
+def validate_balances(transactions: List[dict]) -> Optional[str]:
+    """None if every balance follows from the previous row, else the first break"""
+    for index in range(1, len(transactions)):
+        status = balance_continuity(transactions[index - 1], transactions[index])
+        if status != "ok":
+            return f"running balance {status} at transaction {index + 1}"
+    return None
+
+
+def parse_statement(header_text: str, tables: List[List[List[str]]]) -> Tuple[Optional[dict], dict]:
+    """
+    Parse a digital statement without the model.
+
+    Args:
+        header_text: Text of the first page (bank name, account number)
+        tables: Cleaned table rows of every page, in document order
+
+    Returns:
+        (statement in the model's JSON shape or None, {"bank", "status", "reason"})
+        where status is "parsed", "unsupported_bank", "layout_mismatch" or "balance_mismatch"
+    """
+    layout = detect_bank(header_text)
+    if layout is None:
+        return None, {"bank": None, "status": "unsupported_bank", "reason": "no registered bank layout matched"}
+
+    try:
+        transactions = layout.parse_transactions(tables)
+    except StatementParseError as e:
+        return None, {"bank": layout.name, "status": "layout_mismatch", "reason": str(e)}
+    if not transactions:
+        return None, {"bank": layout.name, "status": "layout_mismatch", "reason": "no transactions found"}
+
+    balance_error = validate_balances(transactions)
+    if balance_error:
+        return None, {"bank": layout.name, "status": "balance_mismatch", "reason": balance_error}
+
+    account_match = _ACCOUNT_NUMBER.search(header_text)
+    account_number = re.sub(r"[\s\-]", "", account_match.group(1)) if account_match else ""
+    account_digits = re.sub(r"\D", "", account_number)
+
+    statement = {
+        "documentType": "BANK_STATEMENT",
+        "bankName": layout.name,
+        "accountNumber": account_number,
+        "accountNumberLast4": account_digits[-4:],
+        "totalWithdrawals": round(sum(t["withdrawal"] for t in transactions), 2),
+        "totalDeposits": round(sum(t["deposit"] for t in transactions), 2),
+        "transactions": transactions
+    }
+    return statement, {"bank": layout.name, "status": "parsed", "reason": None}
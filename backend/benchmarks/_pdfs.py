@@ -0,0 +1,20 @@
+# Synthetic PDFs for the benchmarks: pages are full-page noise scans, the
+# worst case for rendering and encoding (nothing compresses).
+
+import io
+import random
+
+from PIL import Image
+
+
+def scanned_pdf(pages: int, seed: int = 1) -> bytes:
+    """A PDF of `pages` A4 pages, each a 600x800 greyscale noise scan"""
+    rng = random.Random(seed)
+    # Four distinct scans, repeated: enough variety without building one image per page
+    scans = [Image.frombytes("L", (600, 800), rng.randbytes(600 * 800)) for _ in range(min(pages, 4))]
+    page_images = [scans[i % len(scans)] for i in range(pages)]
+
+    buf = io.BytesIO()
+    # 600x800 pixels at 72.6 DPI is an A4 page
+    page_images[0].save(buf, format="PDF", save_all=True, append_images=page_images[1:], resolution=72.6)
+    return buf.getvalue()
@@ -0,0 +1,47 @@
+# Per-request model setup cost: the old path (genai.configure, a new
+# GenerativeModel and a new async client on every request) vs a handle from
+# gemini_client.model_registry. Uses the real SDK with a fake key; no call is
+# made, so connection and TLS setup of a new channel are not included.
+# Run from backend/: python benchmarks/bench_model_setup.py [requests]
+
+import asyncio
+import os
+import sys
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+import google.generativeai as genai
+from google.generativeai import client as genai_client
+
+from credential_pool import Credential
+from gemini_client import get_model, model_registry
+from rate_limiter import MemoryBuckets
+
+# About the size of the invoice extraction system instruction
+SYSTEM_INSTRUCTION = "Extract the invoice fields as JSON. " * 170
+
+
+async def main(requests: int):
+    started = time.perf_counter()
+    for _ in range(requests):
+        genai.configure(api_key="benchmark-key")
+        model = genai.GenerativeModel("gemini-2.5-flash", system_instruction=SYSTEM_INSTRUCTION)
+        model._async_client = genai_client.get_default_generative_async_client()
+    before = (time.perf_counter() - started) / requests
+
+    credential = Credential("benchmark-key-2", 1, MemoryBuckets())
+    spec = get_model("gemini-2.5-flash", SYSTEM_INSTRUCTION)
+    model_registry.get(credential, spec)  # first request of the process builds the handle
+    started = time.perf_counter()
+    for _ in range(requests):
+        model_registry.get(credential, get_model("gemini-2.5-flash", SYSTEM_INSTRUCTION))
+    after = (time.perf_counter() - started) / requests
+
+    print(f"{requests} requests, {len(SYSTEM_INSTRUCTION)}-char system instruction")
+    print(f"per-request setup: before {before * 1e6:.0f}us  after {after * 1e6:.1f}us  (x{before / after:.0f})")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 300))
@@ -0,0 +1,49 @@
+# Peak memory of rendering every page of a scanned PDF: materialized list
+# (split_pdf_to_images, the old behaviour) vs lazy generator (iter_pdf_page_images).
+#
+# Each mode runs in a fresh interpreter, so max RSS is not inherited from the other.
+# Run from backend/: python benchmarks/bench_page_memory.py [pages]
+
+import os
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(mode: str, pages: int):
+    import pdf_processor
+    from _pdfs import scanned_pdf
+
+    pdf = scanned_pdf(pages)
+    tracemalloc.start()
+    started = time.perf_counter()
+    if mode == "list":
+        rendered = pdf_processor.split_pdf_to_images(pdf)
+        count = len(rendered)
+        del rendered
+    else:
+        count = 0
+        for img_base64, _, _ in pdf_processor.iter_pdf_page_images(pdf, workers=1):
+            count += 1
+            del img_base64
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{mode:9s} pages={count:3d}  python peak={peak / 1e6:6.1f}MB  max RSS={max_rss:6.0f}MB  time={elapsed:5.2f}s")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "--mode":
+        measure(sys.argv[2], int(sys.argv[3]))
+        sys.exit(0)
+
+    for pages in ([int(sys.argv[1])] if len(sys.argv) > 1 else [20, 60]):
+        for mode in ("list", "generator"):
+            subprocess.run([sys.executable, __file__, "--mode", mode, str(pages)], check=True)
@@ -0,0 +1,51 @@
+# Serial vs process-pool page rasterization (PDF_RENDER_WORKERS).
+#
+# Renders every page of a scanned PDF with 1 (serial), 2 and 4 render workers,
+# checks the pages come back in order, and reports wall time and speedup over
+# serial. The pool is warmed up first so interpreter start-up is not counted.
+# The speedup is bounded by the CPUs available; the CPU count is printed.
+# Run from backend/: python benchmarks/bench_render_workers.py [pages] [batch_size]
+
+import os
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import pdf_processor
+from _pdfs import scanned_pdf
+
+WORKER_COUNTS = (1, 2, 4)
+
+
+def render(path: str, workers: int, batch_size: int) -> float:
+    started = time.perf_counter()
+    pages = [page_num for _, page_num, _ in pdf_processor.iter_pdf_page_images(path, workers=workers, batch_size=batch_size)]
+    elapsed = time.perf_counter() - started
+    assert pages == sorted(pages) and len(pages) == len(set(pages)), "pages out of order"
+    return elapsed
+
+
+if __name__ == "__main__":
+    page_total = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    print(f"{page_total} pages, batch size {batch_size}, {cpus} CPUs available")
+
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+        f.write(scanned_pdf(page_total))
+        path = f.name
+    try:
+        # Warm up the pool (spawned processes import pdf_processor once)
+        render(path, max(WORKER_COUNTS), batch_size)
+
+        serial = None
+        for workers in WORKER_COUNTS:
+            elapsed = render(path, workers, batch_size)
+            serial = serial or elapsed
+            print(f"workers={workers}: {elapsed:6.2f}s  {page_total / elapsed:5.1f} pages/s  speedup x{serial / elapsed:.2f}")
+    finally:
+        os.unlink(path)
@@ -0,0 +1,225 @@
+# Gemini Credential Pool
+# Spreads model calls over several Gemini API keys (one per project) to
+# multiply throughput. Each call goes to the least-loaded key, every key has
+# its own RPM/TPM limiter, and a key the provider answers with
+# ResourceExhausted is set aside for a while while other keys take over; the
+# last usable key is paused instead, so calls queue for it rather than
+# failing. Each key has its own API client,
+# so there is no process-wide genai.configure() for concurrent calls to race on.
+
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List, Optional
+
+import google.ai.generativelanguage as glm
+from google.api_core.client_options import ClientOptions
+from google.api_core.exceptions import ResourceExhausted
+
+from rate_limiter import (
+    GEMINI_QUEUE_MAX_DEPTH,
+    GEMINI_QUEUE_MAX_WAIT_SECONDS,
+    GEMINI_RPM,
+    GEMINI_TPM,
+    RateLimiter,
+    RateLimitExceeded,
+    make_buckets
+)
+
+# How long a key is skipped after the provider reports it out of quota
+# (unless the provider says when to retry)
+GEMINI_KEY_QUARANTINE_SECONDS = float(os.getenv("GEMINI_KEY_QUARANTINE_SECONDS", "60"))
+# How long the last usable key is paused after a quota error without a retry delay
+GEMINI_KEY_BACKOFF_SECONDS = float(os.getenv("GEMINI_KEY_BACKOFF_SECONDS", "5"))
+
+
+def keys_from_env() -> List[str]:
+    """GEMINI_API_KEYS (comma-separated) plus GEMINI_API_KEY, without duplicates"""
+    keys = []
+    for key in os.getenv("GEMINI_API_KEYS", "").split(",") + [os.getenv("GEMINI_API_KEY", "")]:
+        key = key.strip()
+        if key and key not in keys:
+            keys.append(key)
+    return keys
+
+
+def provider_retry_after(e: ResourceExhausted) -> Optional[float]:
+    """Retry delay the provider attached to a ResourceExhausted (google.rpc.RetryInfo), if any"""
+    for detail in getattr(e, "details", None) or []:
+        delay = getattr(detail, "retry_delay", None)
+        if delay is not None and hasattr(delay, "ToTimedelta"):
+            return delay.ToTimedelta().total_seconds()
+    return None
+
+
+class Credential:
+    """
+    One Gemini API key with its own limiter, client and load counters.
+
+    Args:
+        api_key: Gemini API key
+        index: Position in the pool (the key is reported as "key-<index>")
+        buckets: Bucket store shared by the pool's limiters
+    """
+
+    def __init__(self, api_key: str, index: int, buckets):
+        self.api_key = api_key
+        self.id = f"key-{index}"
+        # Stable across processes, so shared buckets of the same key line up
+        fingerprint = hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:12]
+        self.limiter = RateLimiter(
+            GEMINI_RPM,
+            GEMINI_TPM,
+            GEMINI_QUEUE_MAX_WAIT_SECONDS,
+            GEMINI_QUEUE_MAX_DEPTH,
+            buckets,
+            name=f"{fingerprint}:"
+        )
+        self.in_flight = 0
+        self.quarantined_until = 0.0
+        self.calls = 0
+        self.quota_errors = 0
+        self._async_client = None
+        self._client_lock = threading.Lock()
+
+    @property
+    def async_client(self):
+        """This key's GenerativeService client, built on first use (inside the event loop)"""
+        with self._client_lock:
+            if self._async_client is None:
+                self._async_client = glm.GenerativeServiceAsyncClient(client_options=ClientOptions(api_key=self.api_key))
+            return self._async_client
+
+    def quarantined(self, now: float) -> bool:
+        return self.quarantined_until > now
+
+    def stats(self, now: float) -> dict:
+        return {
+            "id": self.id,
+            "hint": f"…{self.api_key[-4:]}",
+            "inFlight": self.in_flight,
+            "calls": self.calls,
+            "quotaErrors": self.quota_errors,
+            "quarantinedForSeconds": round(max(self.quarantined_until - now, 0.0), 1),
+            "rateLimit": self.limiter.stats()
+        }
+
+
+class CredentialPool:
+    """
+    Picks a key for each model call.
+
+    lease() chooses the available key with the most headroom in its RPM/TPM
+    buckets, counting calls already waiting for it (fewest calls in flight on
+    a tie), waits for that key's limiter and
+    counts the call against it. ResourceExhausted from the provider quarantines
+    the key (for the provider's retry delay, else quarantine_seconds) while
+    other keys are available. The last available key is never quarantined:
+    its limiter is paused for the retry delay (else backoff_seconds), so the
+    next calls wait in its queue, within the limiter's wait budget, instead
+    of failing at once.
+
+    Args:
+        quarantine_seconds: How long a key is skipped after ResourceExhausted
+        backoff_seconds: How long the last available key is paused after ResourceExhausted
+    """
+
+    def __init__(self, quarantine_seconds: float, backoff_seconds: float):
+        self.credentials: List[Credential] = []
+        self.quarantine_seconds = quarantine_seconds
+        self.backoff_seconds = backoff_seconds
+        self._buckets = make_buckets()
+
+    def configure(self, api_keys: List[str]):
+        """Use these keys from now on (keys already in the pool keep their state)"""
+        existing = {credential.api_key: credential for credential in self.credentials}
+        self.credentials = [
+            existing.get(key) or Credential(key, index, self._buckets)
+            for index, key in enumerate(api_keys, start=1)
+        ]
+
+    def __len__(self) -> int:
+        return len(self.credentials)
+
+    def available(self) -> int:
+        """Keys not in quarantine"""
+        now = time.monotonic()
+        return sum(1 for credential in self.credentials if not credential.quarantined(now))
+
+    def _candidates(self) -> List[Credential]:
+        now = time.monotonic()
+        candidates = [credential for credential in self.credentials if not credential.quarantined(now)]
+        if not candidates:
+            if not self.credentials:
+                raise RuntimeError("No Gemini API key configured")
+            retry_after = min(credential.quarantined_until for credential in self.credentials) - now
+            raise RateLimitExceeded("Every Gemini API key is out of quota", retry_after=retry_after)
+        return candidates
+
+    async def _choose(self, tokens: int) -> Credential:
+        candidates = self._candidates()
+        if len(candidates) == 1:
+            return candidates[0]
+
+        def read_levels():
+            return [credential.limiter.levels() for credential in candidates]
+
+        # Levels are read from SQLite when shared; the choice itself is made on the
+        # event loop, so concurrent calls see each other's waiting calls
+        levels = await asyncio.to_thread(read_levels) if self._buckets.shared else read_levels()
+        scored = [
+            (credential.limiter.headroom(tokens, credential_levels), -credential.in_flight, index)
+            for index, (credential, credential_levels) in enumerate(zip(candidates, levels))
+        ]
+        return candidates[max(scored)[2]]
+
+    def quota_exceeded(self, credential: Credential, retry_after: Optional[float] = None):
+        """The provider answered ResourceExhausted on this key: quarantine it, or pause it if it is the last one"""
+        credential.quota_errors += 1
+        now = time.monotonic()
+        if any(other is not credential and not other.quarantined(now) for other in self.credentials):
+            seconds = retry_after if retry_after is not None else self.quarantine_seconds
+            credential.quarantined_until = now + seconds
+            print(f"🔑 Gemini {credential.id} out of quota; skipped for {seconds:g}s ({self.available()}/{len(self)} keys left)")
+        else:
+            seconds = retry_after if retry_after is not None else self.backoff_seconds
+            credential.limiter.pause(seconds)
+            print(f"🔑 Gemini {credential.id} out of quota and no other key available; pausing its calls for {seconds:g}s")
+
+    @asynccontextmanager
+    async def lease(self, tokens: int) -> AsyncIterator[Credential]:
+        """
+        Hold the least-loaded key for one call with ~tokens input tokens.
+
+        Raises:
+            RateLimitExceeded: Every key is quarantined, or the chosen key's limiter refused the call
+        """
+        credential = await self._choose(tokens)
+        credential.in_flight += 1
+        try:
+            await credential.limiter.acquire(tokens)
+            credential.calls += 1
+            yield credential
+        except ResourceExhausted as e:
+            if not isinstance(e, RateLimitExceeded):
+                self.quota_exceeded(credential, provider_retry_after(e))
+            raise
+        finally:
+            credential.in_flight -= 1
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "keys": len(self.credentials),
+            "available": self.available(),
+            "quarantineSeconds": self.quarantine_seconds,
+            "backoffSeconds": self.backoff_seconds,
+            "credentials": [credential.stats(now) for credential in self.credentials]
+        }
+
+
+# Keys are added by main.py once the .env file is loaded (keys_from_env)
+credential_pool = CredentialPool(GEMINI_KEY_QUARANTINE_SECONDS, GEMINI_KEY_BACKOFF_SECONDS)
@@ -0,0 +1,309 @@
+# Gemini Client Helpers
+# Async wrappers around google-generativeai so model calls never block the event loop.
+# Every call runs on the least-loaded API key of the credential pool
+# (credential_pool.py), admitted by that key's rate limiter, and transient
+# failures are retried behind a circuit breaker (resilience.py). Calls made
+# for a request with a bound token budget (usage_budget.py) reserve their
+# estimated tokens first.
+
+import asyncio
+import base64
+import io
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Awaitable, Callable, NamedTuple, Optional, TypeVar
+
+import google.generativeai as genai
+from google.api_core.exceptions import ResourceExhausted
+from google.generativeai.types import GenerationConfig
+from PIL import Image
+
+from credential_pool import Credential, credential_pool
+from rate_limiter import GEMINI_QUEUE_MAX_WAIT_SECONDS, RateLimitExceeded
+from resilience import call_with_retry, with_deadline
+from usage_budget import check_request_size, current_usage
+
+# Upper bound on in-flight model calls per worker. Native async generation
+# means a waiting call costs no thread, so this can be set well above the CPU count.
+MAX_CONCURRENT_CALLS = int(os.getenv("GEMINI_MAX_CONCURRENCY", "32"))
+# Model handles kept by the registry (the proxy endpoints accept caller-supplied
+# system instructions and configs, so it is bounded)
+MODEL_REGISTRY_SIZE = int(os.getenv("GEMINI_MODEL_REGISTRY_SIZE", "64"))
+
+# Input tokens assumed for a non-image file part (e.g. a PDF) until the response reports the real count
+FILE_PART_TOKENS_EST = int(os.getenv("GEMINI_FILE_PART_TOKENS_EST", "1548"))
+
+_call_semaphore = asyncio.Semaphore(MAX_CONCURRENT_CALLS)
+
+T = TypeVar("T")
+
+
+# ============================================================
+# TOKEN ESTIMATES
+# ============================================================
+def estimate_tokens(text: str) -> int:
+    """
+    Rough Gemini token count of a text, without an API call.
+    Digits are tokenized one per token; other text averages ~4 characters per token.
+    """
+    digits = sum(ch.isdigit() for ch in text)
+    return digits + -(-(len(text) - digits) // 4)
+
+
+def estimate_image_tokens(width: int, height: int) -> int:
+    """Gemini 2.x image cost: 258 tokens when both sides are <= 384px, else 258 per tile"""
+    if width <= 384 and height <= 384:
+        return 258
+    tile = min(max(min(width, height) / 1.5, 256), 768)
+    return 258 * math.ceil(width / tile) * math.ceil(height / tile)
+
+
+def _inline_part_tokens(mime_type: str, data: Any) -> int:
+    if mime_type.startswith("image/") and isinstance(data, (str, bytes)):
+        try:
+            # The size is in the header: decode only the start of the data
+            head = base64.b64decode(data[:65536]) if isinstance(data, str) else data[:49152]
+            with Image.open(io.BytesIO(head)) as img:
+                return estimate_image_tokens(*img.size)
+        except Exception:
+            pass
+    return FILE_PART_TOKENS_EST
+
+
+def estimate_request_tokens(contents: Any) -> int:
+    """
+    Rough input token count of generate_content contents (text, inline
+    {"mime_type", "data"} parts, {"text"} / {"inline_data"} parts, and
+    {"role", "parts"} chat turns), without an API call.
+    """
+    if isinstance(contents, str):
+        return estimate_tokens(contents)
+    if isinstance(contents, (list, tuple)):
+        return sum(estimate_request_tokens(part) for part in contents)
+    if isinstance(contents, dict):
+        if "parts" in contents:
+            return estimate_request_tokens(contents["parts"])
+        if "text" in contents:
+            return estimate_tokens(str(contents["text"]))
+        inline = contents.get("inline_data") or contents.get("inlineData") or contents
+        if "data" in inline:
+            return _inline_part_tokens(inline.get("mime_type") or inline.get("mimeType") or "", inline["data"])
+    return FILE_PART_TOKENS_EST
+
+
+def _prompt_tokens(response: Any) -> Optional[int]:
+    metadata = getattr(response, "usage_metadata", None)
+    return getattr(metadata, "prompt_token_count", None) or None
+
+
+def response_tokens(response: Any) -> int:
+    """Total tokens a response reports (prompt + output), 0 if it reports none"""
+    metadata = getattr(response, "usage_metadata", None)
+    if not metadata:
+        return 0
+    total = getattr(metadata, "total_token_count", None)
+    if total:
+        return total
+    return (getattr(metadata, "prompt_token_count", None) or 0) + (getattr(metadata, "candidates_token_count", None) or 0)
+
+
+class ModelSpec(NamedTuple):
+    """A model configuration; bound to an API key per call (see ModelRegistry.get)"""
+    model_name: str
+    system_instruction: Optional[str] = None
+    generation_config: Optional[dict] = None
+
+
+class ModelRegistry:
+    """
+    Process-wide GenerativeModel handles, keyed by (API key, model name, system
+    instruction, generation config), least recently used evicted first.
+
+    genai.configure() is never called: it swaps process-global SDK state and drops
+    the SDK's cached clients. Instead every handle is bound to its key's own
+    GenerativeService client, so calls on different keys never share
+    configuration and calls on the same key reuse one connection.
+    """
+
+    def __init__(self, max_models: int):
+        self.max_models = max_models
+        self._models: "OrderedDict[tuple, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, credential: Credential, spec: ModelSpec):
+        """
+        Get the model handle for this key and configuration, building it on first use.
+
+        Args:
+            credential: API key of the credential pool
+            spec: Model name, system instruction and default generation config
+
+        Returns:
+            Shared genai.GenerativeModel
+        """
+        config_key = json.dumps(spec.generation_config, sort_keys=True, default=str) if spec.generation_config else None
+        key = (credential.id, spec.model_name, spec.system_instruction, config_key)
+        with self._lock:
+            model = self._models.get(key)
+            if model is not None:
+                self._models.move_to_end(key)
+                self.hits += 1
+                return model
+            self.misses += 1
+
+        kwargs = {}
+        if spec.system_instruction:
+            kwargs["system_instruction"] = spec.system_instruction
+        if spec.generation_config:
+            kwargs["generation_config"] = GenerationConfig(**spec.generation_config)
+        model = genai.GenerativeModel(spec.model_name, **kwargs)
+        # The SDK only falls back to its global client when this is unset
+        model._async_client = credential.async_client
+
+        with self._lock:
+            # Another request may have built the same handle meanwhile; keep the first
+            model = self._models.setdefault(key, model)
+            self._models.move_to_end(key)
+            while len(self._models) > self.max_models:
+                self._models.popitem(last=False)
+        return model
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"models": len(self._models), "hits": self.hits, "misses": self.misses}
+
+
+model_registry = ModelRegistry(MODEL_REGISTRY_SIZE)
+
+
+def get_model(model_name: str, system_instruction: Optional[str] = None, generation_config: Optional[dict] = None) -> ModelSpec:
+    """Model to pass to generate_content_async / generate_content_stream; the API key is picked per call"""
+    return ModelSpec(model_name, system_instruction, generation_config)
+
+
+async def _with_credential(tokens: int, call: Callable[[Credential], Awaitable[T]]) -> T:
+    """
+    Run call(credential) on the least-loaded key of the pool. A key the provider
+    reports out of quota is quarantined and the call moves on to the next key;
+    on the last key, the call waits out its pause and tries again, for at most
+    GEMINI_QUEUE_MAX_WAIT_SECONDS in all.
+    """
+    deadline = time.monotonic() + GEMINI_QUEUE_MAX_WAIT_SECONDS
+    while True:
+        try:
+            async with credential_pool.lease(tokens) as credential:
+                return await call(credential)
+        except ResourceExhausted as e:
+            if isinstance(e, RateLimitExceeded) or not credential_pool.available() or time.monotonic() >= deadline:
+                raise
+            print(f"🔑 Retrying after a Gemini quota error ({credential_pool.available()} keys available)")
+
+
+async def generate_content_async(model: ModelSpec, contents: Any, **kwargs) -> Any:
+    """
+    Run a Gemini generation without blocking the event loop.
+
+    Transient errors (5xx, deadline) are retried with jittered backoff; each
+    attempt picks a key from the credential pool, is admitted by that key's
+    rate limiter and is bounded by GEMINI_CALL_TIMEOUT_SECONDS.
+
+    Args:
+        model: Model from get_model()
+        contents: Prompt parts, exactly as accepted by model.generate_content
+        **kwargs: Extra arguments (generation_config, etc.)
+
+    Returns:
+        The GenerateContentResponse from the model
+
+    Raises:
+        RequestTooLarge: The contents exceed GEMINI_MAX_INPUT_TOKENS
+        TokenBudgetExceeded: The call does not fit in the request's token budget
+        RateLimitExceeded: No rate limit capacity within GEMINI_QUEUE_MAX_WAIT_SECONDS, or every key is out of quota
+        CircuitOpenError: Gemini is failing and calls are paused
+    """
+    tokens = estimate_request_tokens(contents)
+    check_request_size(tokens)
+    usage = current_usage()
+    reservation = await usage.reserve(tokens) if usage else None
+
+    async def call(credential: Credential):
+        async with _call_semaphore:
+            response = await with_deadline(model_registry.get(credential, model).generate_content_async(contents, **kwargs))
+        await credential.limiter.reconcile(tokens, _prompt_tokens(response))
+        return response
+
+    response = None
+    try:
+        response = await call_with_retry(lambda: _with_credential(tokens, call))
+        return response
+    finally:
+        if usage:
+            await usage.settle(reservation, response_tokens(response))
+
+
+async def generate_content_stream(model: ModelSpec, contents: Any, **kwargs) -> AsyncIterator[Any]:
+    """
+    Stream a Gemini generation chunk by chunk.
+
+    Async generator: the call slot is held until the stream is exhausted or
+    closed. Closing it early (e.g. the client disconnected) cancels the
+    underlying RPC so the model stops generating. The call is retried like
+    generate_content_async until the first chunk arrives, never after.
+
+    Args:
+        model: Model from get_model()
+        contents: Prompt parts, exactly as accepted by model.generate_content
+        **kwargs: Extra arguments (generation_config, etc.)
+
+    Yields:
+        GenerateContentResponse chunks; each carries the usage_metadata so far
+    """
+    tokens = estimate_request_tokens(contents)
+    check_request_size(tokens)
+    usage = current_usage()
+    reservation = await usage.reserve(tokens) if usage else None
+
+    async def open_stream(credential: Credential):
+        await _call_semaphore.acquire()
+        try:
+            # Returns once the first chunk has arrived
+            response = await with_deadline(
+                model_registry.get(credential, model).generate_content_async(contents, stream=True, **kwargs)
+            )
+        except BaseException:
+            _call_semaphore.release()
+            raise
+        return credential, response
+
+    try:
+        credential, response = await call_with_retry(lambda: _with_credential(tokens, open_stream))
+    except BaseException:
+        if usage:
+            await usage.settle(reservation, None)
+        raise
+    prompt_tokens = None
+    last_chunk = None
+    try:
+        async for chunk in response:
+            prompt_tokens = _prompt_tokens(chunk) or prompt_tokens
+            last_chunk = chunk
+            yield chunk
+    finally:
+        _call_semaphore.release()
+        await credential.limiter.reconcile(tokens, prompt_tokens)
+        if usage:
+            # Tokens generated before a disconnect are billed too
+            await usage.settle(reservation, response_tokens(last_chunk))
+        # The SDK exposes no close(). Closing its stream iterator and dropping
+        # the response releases the last references to the gRPC call, which
+        # grpc cancels on collection if it is still running.
+        iterator = getattr(response, "_iterator", None)
+        if hasattr(iterator, "aclose"):
+            await iterator.aclose()
+        del response
@@ -0,0 +1,208 @@
+# Extraction Job Store
+# SQLite (WAL mode) backed queue of extraction jobs; uploaded files are kept on disk
+# next to the database until the job finishes. Jobs survive restarts, and workers in
+# any number of processes claim them atomically with a renewable lease.
+#
+# Input files are stored as uploaded, except that password-protected PDFs are
+# stored DECRYPTED (passwords are never persisted, so the worker could not open
+# them otherwise). An input file is deleted as soon as its job finishes or
+# fails for good; until then it sits unencrypted in input_dir, which is created
+# owner-only (0700). Keep input_dir off shared or backed-up volumes.
+
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Optional, Union
+
+JOB_STATUSES = ("queued", "running", "succeeded", "failed")
+
+
+class JobStore:
+    """
+    Persistent job records plus their input files.
+
+    A worker claims the oldest queued job (or a running job whose lease expired,
+    i.e. its worker died) inside one IMMEDIATE transaction, so a job is never
+    handed to two workers at once. Jobs claimed max_attempts times without
+    finishing are marked failed instead of being retried forever.
+    """
+
+    def __init__(self, db_path: str, input_dir: str):
+        self.db_path = db_path
+        self.input_dir = input_dir
+        self._local = threading.local()
+        os.makedirs(self.input_dir, mode=0o700, exist_ok=True)
+
+        with self._transaction() as conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    owner TEXT NOT NULL,
+                    filename TEXT,
+                    mime_type TEXT,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    lease_until REAL,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL,
+                    result TEXT,
+                    error TEXT
+                )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at)")
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=10000")
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _input_path(self, job_id: str) -> str:
+        return os.path.join(self.input_dir, f"{job_id}.bin")
+
+    @staticmethod
+    def _to_dict(row: sqlite3.Row) -> dict:
+        job = dict(row)
+        for field in ("result", "error"):
+            if job[field] is not None:
+                job[field] = json.loads(job[field])
+        return job
+
+    def create(self, kind: str, owner: str, filename: str, mime_type: str, source: Union[bytes, str]) -> str:
+        """
+        Store the input file and queue a job for it; returns the job id.
+        source is either the file's bytes or the path of a file to move into the store.
+        """
+        job_id = uuid.uuid4().hex
+        path = self._input_path(job_id)
+        tmp_path = f"{path}.tmp"
+        if isinstance(source, str):
+            shutil.move(source, tmp_path)
+        else:
+            with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as f:
+                f.write(source)
+        os.chmod(tmp_path, 0o600)
+        os.replace(tmp_path, path)
+
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, kind, owner, filename, mime_type, status, created_at) VALUES (?, ?, ?, ?, ?, 'queued', ?)",
+                (job_id, kind, owner, filename, mime_type, time.time())
+            )
+        return job_id
+
+    def get(self, job_id: str) -> Optional[dict]:
+        row = self._connection().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_dict(row) if row is not None else None
+
+    def input_path(self, job_id: str) -> str:
+        """Path of a job's stored input file"""
+        return self._input_path(job_id)
+
+    def claim(self, lease_seconds: float, max_attempts: int) -> Optional[dict]:
+        """Claim the next runnable job for this worker, or None if there is none"""
+        now = time.time()
+        with self._transaction() as conn:
+            while True:
+                row = conn.execute(
+                    """SELECT * FROM jobs
+                       WHERE status = 'queued' OR (status = 'running' AND lease_until < ?)
+                       ORDER BY created_at LIMIT 1""",
+                    (now,)
+                ).fetchone()
+                if row is None:
+                    return None
+
+                if row["attempts"] >= max_attempts:
+                    error = {"status": 500, "detail": f"Job abandoned after {row['attempts']} attempts"}
+                    conn.execute(
+                        "UPDATE jobs SET status = 'failed', error = ?, finished_at = ?, lease_until = NULL WHERE id = ?",
+                        (json.dumps(error), now, row["id"])
+                    )
+                    self._remove_input(row["id"])
+                    continue
+
+                conn.execute(
+                    "UPDATE jobs SET status = 'running', attempts = attempts + 1, lease_until = ?, started_at = ? WHERE id = ?",
+                    (now + lease_seconds, now, row["id"])
+                )
+                job = self._to_dict(row)
+                job.update(status="running", attempts=row["attempts"] + 1, started_at=now)
+                return job
+
+    def renew(self, job_id: str, lease_seconds: float):
+        """Extend a running job's lease (called periodically by its worker)"""
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND status = 'running'",
+                (time.time() + lease_seconds, job_id)
+            )
+
+    def release(self, job_id: str):
+        """Put a running job back in the queue (e.g. the server is shutting down)"""
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', lease_until = NULL, attempts = MAX(attempts - 1, 0) WHERE id = ? AND status = 'running'",
+                (job_id,)
+            )
+
+    def finish(self, job_id: str, result: Any = None, error: Optional[dict] = None):
+        """Record the outcome of a job and delete its input file"""
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ?, lease_until = NULL WHERE id = ?",
+                (
+                    "failed" if error is not None else "succeeded",
+                    json.dumps(result) if result is not None else None,
+                    json.dumps(error) if error is not None else None,
+                    time.time(),
+                    job_id
+                )
+            )
+        self._remove_input(job_id)
+
+    def counts(self) -> dict:
+        """Number of jobs per status"""
+        rows = self._connection().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        counts = {status: 0 for status in JOB_STATUSES}
+        counts.update({row[0]: row[1] for row in rows})
+        return counts
+
+    def purge(self, older_than_seconds: float) -> int:
+        """Delete finished jobs older than the retention period; returns how many"""
+        cutoff = time.time() - older_than_seconds
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "DELETE FROM jobs WHERE status IN ('succeeded', 'failed') AND finished_at < ?",
+                (cutoff,)
+            )
+            return cursor.rowcount
+
+    def _remove_input(self, job_id: str):
+        try:
+            os.remove(self._input_path(job_id))
+        except FileNotFoundError:
+            pass
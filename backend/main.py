@@ -1,15 +1,25 @@
 from fastapi import FastAPI, Header, HTTPException, Body, UploadFile, File, Depends, Form
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import Any, Dict, Optional, List
+from typing import Any, Awaitable, Callable, Dict, Optional, List, Tuple
 import os
 import json
-import pypdf
+import asyncio
+import math
+import time
 from dotenv import load_dotenv
-import google.generativeai as genai
-from google.generativeai.types import GenerationConfig
 from google.api_core.exceptions import ResourceExhausted
-from pdf_processor import split_pdf_to_images, get_pdf_page_count
+from pdf_processor import PdfSession, PdfPasswordError, open_pdf_session, decrypted_pdf_cache, split_text, triage_pdf
+from gemini_client import generate_content_async, generate_content_stream, get_model, model_registry, estimate_tokens, estimate_image_tokens, response_tokens
+from credential_pool import credential_pool, keys_from_env
+from resilience import CircuitOpenError, gemini_breaker, is_retryable, retry_stats
+from result_cache import result_cache, make_version
+from statement_merge import merge_chunk_transactions, check_boundary_balances, parse_amount
+from token_ledger import TokenLedger, DEFAULT_BUCKET
+from usage_budget import UsageScope, TokenBudgetExceeded, RequestTooLarge, bind_usage, current_usage
+from job_store import JobStore
+from bank_parsers import parse_statement, PARSER_VERSION as BANK_PARSER_VERSION
+from uploads import RequestSizeLimit, StoredFile, UploadTooLarge, spool_upload, REQUEST_MAX_BYTES, UPLOAD_MAX_MB
 import hashlib
 
 # Load environment variables
@@ -37,11 +47,11 @@ else:
     print("⚠️ WARNING: No .env file found! Checking environment variables directly.")
 
 # Debug Key Loading (Masked)
-key = os.getenv("GEMINI_API_KEY", "")
-if key:
-    print(f"✅ GEMINI_API_KEY Found: {key[:4]}...{key[-4:]} (Length: {len(key)})")
-else:
-    print("❌ GEMINI_API_KEY NOT FOUND in environment")
+GEMINI_API_KEYS = keys_from_env()
+for key in GEMINI_API_KEYS:
+    print(f"✅ Gemini API key found: {key[:4]}...{key[-4:]} (Length: {len(key)})")
+if not GEMINI_API_KEYS:
+    print("❌ GEMINI_API_KEY / GEMINI_API_KEYS NOT FOUND in environment")
 
 
 app = FastAPI(title="AutoTally Backend API")
@@ -64,9 +74,15 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Oversized bodies are refused from Content-Length, or as soon as they are received
+app.add_middleware(RequestSizeLimit, max_bytes=REQUEST_MAX_BYTES)
+
 # Simple API key validation
 VALID_API_KEYS = os.getenv("BACKEND_API_KEY", "").split(",")
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
+
+# Every model call picks the least-loaded of these keys; the SDK is never
+# configured globally (see gemini_client.ModelRegistry)
+credential_pool.configure(GEMINI_API_KEYS)
 
 # ============================================================
 # TOKEN USAGE TRACKING
@@ -80,83 +96,66 @@ PLAN_LIMITS = {
     "Platinum": 200000
 }
 
-def load_token_usage() -> dict:
-    """Load token usage from JSON file"""
-    default = {
+# Atomic, multi-process safe counter (SQLite WAL). token_usage.json is imported once if present.
+TOKEN_USAGE_DB = os.getenv("TOKEN_USAGE_DB", os.path.join(os.path.dirname(__file__), "token_usage.db"))
+token_ledger = TokenLedger(TOKEN_USAGE_DB, default_plan="Bronze", legacy_json_path=TOKEN_USAGE_FILE)
+
+def plan_limit(plan: str) -> int:
+    return PLAN_LIMITS.get(plan, 1000)
+
+def usage_bucket(api_key: str) -> str:
+    """Ledger bucket of a backend API key; the key itself is not stored"""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:32]
+
+def bind_token_budget(api_key: str):
+    """Charge the model calls of this request to the caller's bucket, each reserved before it runs"""
+    bind_usage(UsageScope(token_ledger, usage_bucket(api_key), plan_limit))
+
+def load_token_usage(bucket: str = DEFAULT_BUCKET) -> dict:
+    """Load current token usage (as after the monthly reset). Blocking: async callers use asyncio.to_thread"""
+    try:
+        return token_ledger.get(bucket)
+    except Exception as e:
+        print(f"Error loading token usage: {e}")
+    return {
         "used": 0,
+        "reserved": 0,
         "plan": "Bronze",
         "reset_date": None,
         "last_notified_threshold": 0
     }
-    try:
-        if os.path.exists(TOKEN_USAGE_FILE):
-            with open(TOKEN_USAGE_FILE, "r") as f:
-                data = json.load(f)
-                # Check if we need to reset (new month)
-                from datetime import datetime
-                current_month = datetime.now().strftime("%Y-%m")
-                if data.get("reset_date") != current_month:
-                    data["used"] = 0
-                    data["reset_date"] = current_month
-                    data["last_notified_threshold"] = 0
-                    save_token_usage(data)
-                return data
-    except Exception as e:
-        print(f"Error loading token usage: {e}")
-    return default
 
-def save_token_usage(data: dict):
-    """Save token usage to JSON file"""
-    try:
-        from datetime import datetime
-        if not data.get("reset_date"):
-            data["reset_date"] = datetime.now().strftime("%Y-%m")
-        with open(TOKEN_USAGE_FILE, "w") as f:
-            json.dump(data, f, indent=2)
-    except Exception as e:
-        print(f"Error saving token usage: {e}")
+async def track_token_usage(response) -> dict:
+    """
+    Token stats after a Gemini response. The tokens were already charged to the
+    request's bucket when the call settled its reservation (gemini_client).
+    """
+    tokens_used = response_tokens(response)
+    usage = current_usage()
+    token_data = await asyncio.to_thread(load_token_usage, usage.bucket if usage else DEFAULT_BUCKET)
+    if tokens_used > 0:
+        print(f"📊 Tokens used this request: {tokens_used}, Total: {token_data['used']}/{plan_limit(token_data['plan'])}")
+    else:
+        print(f"📊 No usage_metadata in response")
 
-def track_token_usage(response) -> dict:
-    """Track token usage from Gemini response and return updated stats"""
-    token_data = load_token_usage()
-    tokens_used = 0
-    
-    try:
-        # Try to get token count from various possible attributes
-        if hasattr(response, 'usage_metadata') and response.usage_metadata:
-            metadata = response.usage_metadata
-            # Try total_token_count first
-            if hasattr(metadata, 'total_token_count') and metadata.total_token_count:
-                tokens_used = metadata.total_token_count
-            # Fallback to sum of prompt + candidates
-            elif hasattr(metadata, 'prompt_token_count') and hasattr(metadata, 'candidates_token_count'):
-                prompt_tokens = metadata.prompt_token_count or 0
-                candidate_tokens = metadata.candidates_token_count or 0
-                tokens_used = prompt_tokens + candidate_tokens
-            
-            if tokens_used > 0:
-                token_data["used"] += tokens_used
-                save_token_usage(token_data)
-                print(f"📊 Tokens used this request: {tokens_used}, Total: {token_data['used']}/{PLAN_LIMITS.get(token_data['plan'], 100)}")
-            else:
-                print(f"📊 No token count in metadata: {metadata}")
-        else:
-            print(f"📊 No usage_metadata in response")
-    except Exception as e:
-        print(f"Error tracking tokens: {e}")
-    
     return {
         "tokens_this_request": tokens_used,
         "total_used": token_data["used"],
         "plan": token_data["plan"],
-        "limit": PLAN_LIMITS.get(token_data["plan"], 100)
+        "limit": plan_limit(token_data["plan"])
     }
 
-def check_token_limit() -> dict:
-    """Check if user has exceeded token limit. Returns status and message."""
-    token_data = load_token_usage()
-    limit = PLAN_LIMITS.get(token_data["plan"], 1000)
-    used = token_data["used"]
+async def check_token_limit(bucket: Optional[str] = None) -> dict:
+    """
+    Check if user has exceeded token limit. Returns status and message.
+    Defaults to the bucket bound to the request; tokens reserved by calls still running count as used.
+    """
+    if bucket is None:
+        usage = current_usage()
+        bucket = usage.bucket if usage else DEFAULT_BUCKET
+    token_data = await asyncio.to_thread(load_token_usage, bucket)
+    limit = plan_limit(token_data["plan"])
+    used = token_data["used"] + token_data.get("reserved", 0)
     
     if used >= limit:
         return {
@@ -175,7 +174,7 @@ def check_token_limit() -> dict:
 
 # Initialize token usage on startup
 _token_data = load_token_usage()
-print(f"📊 Token Usage: {_token_data['used']}/{PLAN_LIMITS.get(_token_data['plan'], 100)} ({_token_data['plan']} plan)")
+print(f"📊 Token Usage (before per-key buckets): {_token_data['used']}/{plan_limit(_token_data['plan'])} ({_token_data['plan']} plan)")
 
 
 def validate_api_key(authorization: str = Header(None)):
@@ -195,6 +194,160 @@ def validate_api_key(authorization: str = Header(None)):
 
 
 
+async def _spool(file: UploadFile) -> StoredFile:
+    """Spool an upload to a temp file (hashed on the way), mapping the size limit to 413"""
+    try:
+        return await spool_upload(file)
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+
+
+def _budget_error(e: Exception) -> HTTPException:
+    """429 for calls the caller's token budget cannot cover, 413 for calls too large for the model"""
+    if isinstance(e, RequestTooLarge):
+        return HTTPException(status_code=413, detail=str(e))
+    return HTTPException(status_code=429, detail=e.message)
+
+
+async def _preflight_tokens(input_tokens: int, calls: int):
+    """Refuse a multi-call extraction before its first call if the caller's budget cannot cover its estimate"""
+    usage = current_usage()
+    if usage:
+        await asyncio.to_thread(usage.preflight, input_tokens, calls)
+
+
+def _gemini_unavailable(e: CircuitOpenError) -> HTTPException:
+    """503 for model calls refused while the Gemini circuit breaker is open"""
+    return HTTPException(
+        status_code=503,
+        detail="AI service is temporarily unavailable. Please retry shortly.",
+        headers={"Retry-After": str(math.ceil(e.retry_after))}
+    )
+
+
+async def _iterate_in_thread(iterator):
+    """Advance a blocking iterator (e.g. page rendering) in a worker thread, one item at a time"""
+    try:
+        while True:
+            item = await asyncio.to_thread(next, iterator, None)
+            if item is None:
+                return
+            yield item
+    finally:
+        _close_iterator(iterator)
+
+
+def _close_iterator(iterator):
+    close = getattr(iterator, "close", None)
+    if close:
+        try:
+            close()
+        except ValueError:
+            # Still being advanced in a worker thread (the request was cancelled);
+            # the generator is finalized when that thread lets go of it
+            pass
+
+
+# ============================================================
+# PROGRESS STREAMING
+# ============================================================
+# Long extractions can report progress as NDJSON (stream=true): one
+# {"type": "progress", "stage": ..., ...} line per stage, then a single
+# {"type": "result", "status": 200, "data": ...} or {"type": "error", "status", "detail"}.
+# Heartbeat lines keep proxies from timing out while a model call is in flight.
+PROGRESS_HEARTBEAT_SECONDS = float(os.getenv("PROGRESS_HEARTBEAT_SECONDS", "10"))
+
+ProgressCallback = Callable[..., None]
+
+
+def _no_progress(stage: str, **fields):
+    pass
+
+
+def _progress_stream(run: Callable[[ProgressCallback], Awaitable[dict]]):
+    """
+    Run an extraction as a background task and stream its progress events.
+    If the client disconnects, the extraction task is cancelled.
+    """
+    from fastapi.responses import StreamingResponse
+
+    queue: asyncio.Queue = asyncio.Queue()
+
+    def progress(stage: str, **fields):
+        queue.put_nowait({"type": "progress", "stage": stage, **fields})
+
+    async def runner():
+        try:
+            result = await run(progress)
+            queue.put_nowait({"type": "result", "status": 200, "data": result})
+        except HTTPException as e:
+            queue.put_nowait({"type": "error", "status": e.status_code, "detail": e.detail})
+        except Exception as e:
+            print(f"PROGRESS STREAM ERROR: {str(e)}")
+            queue.put_nowait({"type": "error", "status": 500, "detail": str(e)})
+        finally:
+            queue.put_nowait(None)
+
+    async def lines():
+        task = asyncio.create_task(runner())
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), PROGRESS_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield json.dumps({"type": "heartbeat"}) + "\n"
+                    continue
+                if event is None:
+                    return
+                yield json.dumps(event) + "\n"
+        finally:
+            task.cancel()
+
+    return StreamingResponse(
+        lines(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+async def _respond(run: Callable[[ProgressCallback], Awaitable[dict]], stream: bool):
+    """Return run's result as JSON, or stream its progress when stream is set"""
+    if stream:
+        return _progress_stream(run)
+    return await run(_no_progress)
+
+
+# Digital statements and invoices are prompted with their tables as TSV
+# (pdf_processor.compact_layout_text) instead of extract_text()'s flattened rows
+COMPACT_TEXT_LAYOUT = os.getenv("COMPACT_TEXT_LAYOUT", "true").lower() != "false"
+
+# Told to the model only when its text really has TSV tables. A part of a long
+# document, or a table continued from the previous page, starts mid-table with
+# no header row, so the first row is not assumed to be one.
+TABLE_LAYOUT_NOTE = """Tables in the text are tab-separated, one row per line, and an empty cell has no value.
+A table's first row is its column header row only if it names the columns: this text may start
+in the middle of a table (a later part of the document, or a table continued from the previous page).
+A first row that holds values is a data row - keep it; its columns are in the same order as the table's header.
+
+"""
+
+
+def _table_note(text: str) -> str:
+    """TABLE_LAYOUT_NOTE for compact-layout text with tables, '' otherwise (plain or OCR text)"""
+    return TABLE_LAYOUT_NOTE if COMPACT_TEXT_LAYOUT and "\t" in text else ""
+
+
+def _text_layout_stats(plain_text: str, prompt_text: str) -> dict:
+    """Size of the plain text layer vs the text actually sent to the model"""
+    return {
+        "layout": "compact" if COMPACT_TEXT_LAYOUT else "plain",
+        "plain_chars": len(plain_text),
+        "prompt_chars": len(prompt_text),
+        "plain_tokens_est": estimate_tokens(plain_text),
+        "prompt_tokens_est": estimate_tokens(prompt_text)
+    }
+
+
 # Helper to clean JSON string
 def clean_json_text(text: str) -> str:
     """Clean markdown code blocks from JSON string"""
@@ -222,7 +375,23 @@ async def root():
 @app.get("/health")
 async def health():
     """Health check endpoint"""
-    return {"status": "healthy", "message": "Backend is running"}
+    breaker = gemini_breaker.stats()
+    # Both read SQLite (shared rate limit buckets, job queue): keep them off the event loop
+    keys, jobs = await asyncio.gather(
+        asyncio.to_thread(credential_pool.stats),
+        asyncio.to_thread(job_store.counts)
+    )
+    return {
+        # Degraded: model calls fail fast until the breaker's probe call succeeds
+        "status": "healthy" if breaker["state"] == "closed" else "degraded",
+        "message": "Backend is running",
+        "result_cache": result_cache.stats(),
+        "decrypted_pdf_cache": decrypted_pdf_cache.stats(),
+        "gemini_models": model_registry.stats(),
+        "gemini_keys": keys,
+        "gemini_breaker": {**breaker, "retries": dict(retry_stats)},
+        "jobs": jobs
+    }
 
 
 @app.get("/healthz")
@@ -255,9 +424,9 @@ class SetPlanRequest(BaseModel):
 
 @app.get("/api/token-usage")
 async def get_token_usage(authorization: str = Header(None)):
-    """Get current token usage stats"""
-    validate_api_key(authorization)
-    token_data = load_token_usage()
+    """Get current token usage stats of the caller's API key"""
+    api_key = validate_api_key(authorization)
+    token_data = await asyncio.to_thread(load_token_usage, usage_bucket(api_key))
     limit = PLAN_LIMITS.get(token_data["plan"], 100)
     percentage = round((token_data["used"] / limit) * 100, 1) if limit > 0 else 0
     
@@ -265,6 +434,7 @@ async def get_token_usage(authorization: str = Header(None)):
         "success": True,
         "plan": token_data["plan"],
         "used": token_data["used"],
+        "reserved": token_data.get("reserved", 0),
         "limit": limit,
         "percentage": percentage,
         "reset_date": token_data.get("reset_date"),
@@ -274,14 +444,12 @@ async def get_token_usage(authorization: str = Header(None)):
 @app.post("/api/set-plan")
 async def set_plan(request: SetPlanRequest, authorization: str = Header(None)):
     """Set user's subscription plan"""
-    validate_api_key(authorization)
+    api_key = validate_api_key(authorization)
     
     if request.plan not in PLAN_LIMITS:
         raise HTTPException(status_code=400, detail=f"Invalid plan. Must be one of: {list(PLAN_LIMITS.keys())}")
     
-    token_data = load_token_usage()
-    token_data["plan"] = request.plan
-    save_token_usage(token_data)
+    await asyncio.to_thread(token_ledger.update, usage_bucket(api_key), plan=request.plan)
     
     return {
         "success": True,
@@ -293,23 +461,18 @@ async def set_plan(request: SetPlanRequest, authorization: str = Header(None)):
 @app.post("/api/update-notified-threshold")
 async def update_notified_threshold(threshold: int = Body(..., embed=True), authorization: str = Header(None)):
     """Update the last notified usage threshold to prevent duplicate notifications"""
-    validate_api_key(authorization)
+    api_key = validate_api_key(authorization)
     
-    token_data = load_token_usage()
-    token_data["last_notified_threshold"] = threshold
-    save_token_usage(token_data)
+    await asyncio.to_thread(token_ledger.update, usage_bucket(api_key), last_notified_threshold=threshold)
     
     return {"success": True, "last_notified_threshold": threshold}
 
 @app.post("/api/reset-tokens")
 async def reset_tokens(authorization: str = Header(None)):
     """Reset token usage to 0"""
-    validate_api_key(authorization)
+    api_key = validate_api_key(authorization)
     
-    token_data = load_token_usage()
-    token_data["used"] = 0
-    token_data["last_notified_threshold"] = 0
-    save_token_usage(token_data)
+    token_data = await asyncio.to_thread(token_ledger.update, usage_bucket(api_key), used=0, last_notified_threshold=0)
     
     return {
         "success": True,
@@ -337,36 +500,22 @@ async def gemini_proxy(
     All business logic stays in React - this just forwards the request securely.
     """
     # Validate user's API key
-    validate_api_key(authorization)
+    bind_token_budget(validate_api_key(authorization))
     
     # Check if Gemini API key is configured
-    if not GEMINI_API_KEY:
+    if not GEMINI_API_KEYS:
         raise HTTPException(
             status_code=500,
             detail="Gemini API key not configured on server"
         )
     
-    # Debug: Check if key is being loaded
-    if GEMINI_API_KEY:
-         print(f"GEMINI_API_KEY loaded successfully (Length: {len(GEMINI_API_KEY)})")
-    else:
-         print("ERROR: GEMINI_API_KEY is not set")
     try:
-        # Configure Gemini with server's API key
-        genai.configure(api_key=GEMINI_API_KEY)
-        
         # Extract system_instruction from config (if present)
-        config = request.config or {}
+        config = dict(request.config or {})
         system_instruction = config.pop('system_instruction', None)
         
-        # Instantiate GenerationConfig if config is present
-        generation_config = GenerationConfig(**config) if config else None
-        
-        # Create model with system_instruction if provided
-        if system_instruction:
-            model = genai.GenerativeModel(request.model, system_instruction=system_instruction)
-        else:
-            model = genai.GenerativeModel(request.model)
+        # Shared model handle for this model / system_instruction / config
+        model = get_model(request.model, system_instruction, config or None)
         
         # Handle both formats:
         # 1. Single request: {"parts": [...]} - for image/document analysis
@@ -377,21 +526,21 @@ async def gemini_proxy(
         # If contents is a list, it's chat history - but we need to convert to proper format
         if isinstance(contents, dict) and 'parts' in contents:
             # Single request format - pass as-is
-            response = model.generate_content(
-                contents=contents['parts'],
-                generation_config=generation_config
+            response = await generate_content_async(
+                model,
+                contents['parts']
             )
         elif isinstance(contents, list):
             # Chat history format - pass as-is (Gemini expects list of Content objects)
-            response = model.generate_content(
-                contents=contents,
-                generation_config=generation_config
+            response = await generate_content_async(
+                model,
+                contents
             )
         else:
             # Fallback - pass as-is
-            response = model.generate_content(
-                contents=contents,
-                generation_config=generation_config
+            response = await generate_content_async(
+                model,
+                contents
             )
         
         # Safely get text content
@@ -404,7 +553,7 @@ async def gemini_proxy(
             pass
 
         # Track token usage
-        token_stats = track_token_usage(response)
+        token_stats = await track_token_usage(response)
 
         # Return the response
         return {
@@ -430,6 +579,10 @@ async def gemini_proxy(
             ]
         }
     
+    except CircuitOpenError as e:
+        raise _gemini_unavailable(e)
+    except (TokenBudgetExceeded, RequestTooLarge) as e:
+        raise _budget_error(e)
     except ResourceExhausted:
         raise HTTPException(
             status_code=429,
@@ -461,6 +614,75 @@ class ChatRequest(BaseModel):
     history: List[Dict[str, Any]]
     model: str = "gemini-2.5-flash"
     system_instruction: Optional[str] = None
+    # Stream the reply as Server-Sent Events instead of one JSON body
+    stream: bool = False
+
+
+def _sse_event(payload: dict) -> str:
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+def _chunk_text(chunk) -> str:
+    # .text raises when a chunk carries no text parts (e.g. only a finish reason)
+    try:
+        return chunk.text
+    except ValueError:
+        return ""
+
+
+async def _stream_chat(model, parts: List[Any]):
+    """
+    Stream a chat reply as SSE: {"type": "delta", "text"} per chunk, then
+    {"type": "done", "text", "usage"} or {"type": "error", "status", "detail"}.
+    A client disconnect closes the model stream, which stops generation.
+    """
+    from fastapi.responses import StreamingResponse
+
+    stream = generate_content_stream(model, parts)
+    try:
+        # Wait for the first chunk so quota / model errors still map to HTTP status codes
+        first_chunk = await stream.__anext__()
+    except StopAsyncIteration:
+        first_chunk = None
+    except BaseException:
+        await stream.aclose()
+        raise
+
+    async def events():
+        last_chunk = first_chunk
+        text_parts = []
+        try:
+            if first_chunk is not None:
+                text = _chunk_text(first_chunk)
+                text_parts.append(text)
+                yield _sse_event({"type": "delta", "text": text})
+                async for chunk in stream:
+                    last_chunk = chunk
+                    text = _chunk_text(chunk)
+                    if text:
+                        text_parts.append(text)
+                        yield _sse_event({"type": "delta", "text": text})
+
+            # Settle the reservation first so the reported total includes this reply;
+            # the last chunk carries the token totals
+            await stream.aclose()
+            usage = await track_token_usage(last_chunk) if last_chunk is not None else None
+            yield _sse_event({"type": "done", "text": "".join(text_parts), "usage": usage})
+        except ResourceExhausted:
+            yield _sse_event({"type": "error", "status": 429, "detail": "Gemini API quota exceeded. Please retry later or upgrade plan."})
+        except Exception as e:
+            print(f"CHAT STREAM ERROR: {str(e)}")
+            yield _sse_event({"type": "error", "status": 500, "detail": f"Internal Server Error: {str(e)}"})
+        finally:
+            # Settles the call's token reservation, including tokens generated before a disconnect or error
+            await stream.aclose()
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        # Keep proxies from buffering the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 
 @app.post("/ai/chat")
@@ -473,28 +695,21 @@ async def chat(
         print(f"DEBUG: Received chat request: {request}")
         
         # Validate API key
-        validate_api_key(authorization)
+        bind_token_budget(validate_api_key(authorization))
 
         # Check token limit before processing
-        limit_status = check_token_limit()
+        limit_status = await check_token_limit()
         if limit_status["limit_reached"]:
             raise HTTPException(
                 status_code=429,
                 detail=limit_status["message"]
             )
 
-        if not GEMINI_API_KEY:
-            print("ERROR: GEMINI_API_KEY is missing")
+        if not GEMINI_API_KEYS:
+            print("ERROR: No Gemini API key configured")
             raise HTTPException(status_code=500, detail="Gemini API key not configured on server")
 
-        if GEMINI_API_KEY:
-            print(f"DEBUG: Using Gemini Key (Length: {len(GEMINI_API_KEY)})")
-
-        genai.configure(api_key=GEMINI_API_KEY)
-        if request.system_instruction:
-            model = genai.GenerativeModel(request.model, system_instruction=request.system_instruction)
-        else:
-            model = genai.GenerativeModel(request.model)
+        model = get_model(request.model, request.system_instruction)
 
         # Convert history to model input format
         parts: List[Any] = []
@@ -507,14 +722,21 @@ async def chat(
                 parts.append(msg["text"])
 
         print(f"DEBUG: Sending to Gemini: {parts}")
-        response = model.generate_content(parts)
+        if request.stream:
+            return await _stream_chat(model, parts)
+
+        response = await generate_content_async(model, parts)
         print(f"DEBUG: Gemini Response: {response.text[:100]}...")
         
         # Track token usage
-        track_token_usage(response)
+        await track_token_usage(response)
         
         return {"success": True, "text": response.text}
         
+    except CircuitOpenError as e:
+        raise _gemini_unavailable(e)
+    except (TokenBudgetExceeded, RequestTooLarge) as e:
+        raise _budget_error(e)
     except ResourceExhausted:
         raise HTTPException(
             status_code=429,
@@ -537,27 +759,16 @@ async def unlock_pdf(
     file: UploadFile = File(...),
     password: Optional[str] = Form(None)
 ):
+    upload = await _spool(file)
     try:
-        file_bytes = await file.read()
-        
         if not password:
              raise HTTPException(status_code=400, detail="Password is required for unlocking")
 
-        import io
         import base64
-        import pypdf
-        
-        # Re-open with pypdf to decrypt
-        reader = pypdf.PdfReader(io.BytesIO(file_bytes), password=password)
-        writer = pypdf.PdfWriter()
-        
-        # Copy all pages to new writer (removes encryption)
-        for page in reader.pages:
-            writer.add_page(page)
-        
-        output_stream = io.BytesIO()
-        writer.write(output_stream)
-        decrypted_b64 = base64.b64encode(output_stream.getvalue()).decode('utf-8')
+
+        with open_pdf_session(upload.path, password=password, file_hash=upload.sha256) as session:
+            decrypted_bytes = await asyncio.to_thread(session.decrypted_bytes)
+        decrypted_b64 = base64.b64encode(decrypted_bytes).decode('utf-8')
         
         return {
             "success": True,
@@ -567,131 +778,51 @@ async def unlock_pdf(
 
     except Exception as e:
         print(f"Unlock Error: {e}")
-        # If password was wrong, pypdf raises generic error often, or specific one
+        # Wrong password raises PdfPasswordError; anything else is an unreadable file
         raise HTTPException(status_code=422, detail="Invalid password or failed to unlock")
+    finally:
+        upload.close()
 
-@app.post("/ai/process-document")
-async def process_document(
+
+# ------------------------------------------------------------------
+# PDF TRIAGE ENDPOINT
+# Encryption, page count and per-page text/scan routing in milliseconds,
+# without extracting text, rendering pages or calling the model (no tokens).
+# Clients use it to ask for a password or warn about size before processing.
+# ------------------------------------------------------------------
+@app.post("/ai/inspect-pdf")
+async def inspect_pdf(
     file: UploadFile = File(...),
     password: Optional[str] = Form(None),
     authorization: str = Header(None)
 ):
-    """Process a single document (invoice image/PDF) and return structured data"""
-    validate_api_key(authorization)
-
-    # Check token limit before processing
-    limit_status = check_token_limit()
-    if limit_status["limit_reached"]:
-        raise HTTPException(
-            status_code=429,
-            detail=limit_status["message"]
-        )
-
-    if not GEMINI_API_KEY:
-        raise HTTPException(status_code=500, detail="Gemini API key not configured on server")
-
-    try:
-        # Read file bytes
-        file_bytes = await file.read()
-        mime_type = file.content_type or "application/octet-stream"
+    """
+    Inspect a PDF without processing it.
 
-        
-        # Helper to prepare content for Gemini
-        gemini_content_parts = []
-        
-        # Handle PDF specifically for Password/Extraction
-        if mime_type == "application/pdf" or file.filename.lower().endswith(".pdf"):
-            import io
-            import pdfplumber
-            
-            extracted_text = ""
-            is_encrypted = False
-            
-            try:
-                # Try opening with password
-                with pdfplumber.open(io.BytesIO(file_bytes), password=password) as pdf:
-                    for page in pdf.pages:
-                        text = page.extract_text()
-                        if text:
-                            extracted_text += text + "\n"
-                    
-                    # If we opened it successfully but it has no text, it might be scanned.
-                    # If it WAS encrypted, we are now "in".
-                    
-            except Exception as e:
-                error_str = str(e).lower()
-                repr_str = repr(e).lower()
-                print(f"DEBUG PDF READ ERROR: {repr(e)}")
-                
-                # Enhanced detection for password protection
-                if "password" in error_str or "encrypted" in error_str or "auth" in error_str or "password" in repr_str:
-                    print(f"PASSWORD REQUIRED for {file.filename}")
-                    raise HTTPException(status_code=422, detail="Password required")
-                
-                # If we have NO password and read failed, it's highly likely it creates an issue.
-                print(f"PDF reading error (ignoring if not password related): {e}")
+    Returns the triage (see pdf_processor.triage_pdf): encrypted, locked
+    (password missing or wrong), size, pageCount, kind (digital, scanned,
+    mixed or empty), text/image/blank page counts and the per-page routes
+    the processing endpoints will use.
+    """
+    validate_api_key(authorization)
 
-            # Strategy:
-            # 1. If we have good text, send text (Cheap & Fast)
-            # 2. If valid PDF but no text (Scanned), convert to Images and send Images (Reliable)
-            # 3. If password was provided and worked, we MUST use Text or Images (can't send bytes)
-            # 4. If no password needed and text failed, we COULD send bytes, but Images are safer for consistency.
-            
-            if len(extracted_text.strip()) > 50:
-                print(f"Processing PDF as TEXT: {len(extracted_text)} chars")
-                gemini_content_parts.append(extracted_text)
-            else:
-                print("Processing PDF as IMAGES (Scanned or Low Text)")
-                # Convert to images using pdf_processor utils or local logic
-                from pdf_processor import split_pdf_to_images
-                try:
-                    # split_pdf_to_images now accepts password
-                    images = split_pdf_to_images(file_bytes, password=password)
-                    if not images:
-                         raise ValueError("No images extracted from PDF")
-                         
-                    for img_b64, _ in images:
-                         gemini_content_parts.append({
-                             "mime_type": "image/png",
-                             "data": img_b64
-                         })
-                except Exception as img_err:
-                     print(f"Image conversion failed: {img_err}")
-                     # If both Text and Image conversion failed, we cannot proceed.
-                     # If encryption was the cause, we should have caught it above OR simple logic:
-                     if not password:
-                         # Assume it MIGHT be password protected if everything failed
-                         print("Both Text and Image extraction failed. Assuming Password Required.")
-                         raise HTTPException(status_code=422, detail="Password required or file corrupted")
-                     else:
-                         raise HTTPException(status_code=422, detail="Failed to process document even with password")
-                     # Fallback to sending raw bytes if not encrypted? 
-                     # If it was encrypted, we are stuck.
-                     if password:
-                         raise HTTPException(status_code=422, detail="Failed to process password-protected PDF images")
-                     
-                     # Check if really encrypted again just in case
-                     import base64
-                     b64 = base64.b64encode(file_bytes).decode('utf-8')
-                     gemini_content_parts.append({
-                        "mime_type": "application/pdf",
-                        "data": b64
-                     })
+    with await _spool(file) as upload:
+        try:
+            triage = await asyncio.to_thread(triage_pdf, upload.path, password)
+        except Exception as e:
+            raise HTTPException(status_code=422, detail=f"Could not read PDF: {str(e)}")
 
-        else:
-            # Not a PDF (Image), send as is
-            import base64
-            b64 = base64.b64encode(file_bytes).decode('utf-8')
-            gemini_content_parts.append({
-                "mime_type": mime_type,
-                "data": b64
-            })
-            
-        
-        # Calculate file hash for duplicate detection
-        file_hash = hashlib.sha256(file_bytes).hexdigest()
+    return {
+        "success": True,
+        "filename": upload.filename,
+        **triage,
+        "uploadMaxMb": UPLOAD_MAX_MB
+    }
 
-        system_instruction = """1️⃣ INVOICE SYSTEM INSTRUCTION
+# ============================================================
+# DOCUMENT PROCESSING PROMPTS
+# ============================================================
+INVOICE_SYSTEM_INSTRUCTION = """1️⃣ INVOICE SYSTEM INSTRUCTION
 (Used during Gemini model initialization for invoice documents)
 
 You are an expert Indian GST Invoice Accountant.
@@ -737,40 +868,7 @@ RULES FOR INVOICE EXTRACTION:
 Goal:
 Return a clean, structured JSON object suitable for Tally Prime."""
 
-        # ------------------------------------------------------------------
-        # DECRYPTION FOR PREVIEW (One-Password Experience)
-        # If password was provided and we reached here (meaning it was valid),
-        # create a decrypted copy for the frontend to show without prompt.
-        # ------------------------------------------------------------------
-        decrypted_pdf_b64 = None
-        if password and (mime_type == "application/pdf" or file.filename.lower().endswith(".pdf")):
-             try:
-                 import io
-                 import base64
-                 import pypdf
-                 
-                 # Re-open with pypdf to decrypt
-                 # Note: pypdf expects a seekable stream, BytesIO is perfect
-                 reader = pypdf.PdfReader(io.BytesIO(file_bytes), password=password)
-                 writer = pypdf.PdfWriter()
-                 
-                 # Copy all pages to new writer (removes encryption)
-                 for page in reader.pages:
-                     writer.add_page(page)
-                 
-                 output_stream = io.BytesIO()
-                 writer.write(output_stream)
-                 decrypted_pdf_b64 = base64.b64encode(output_stream.getvalue()).decode('utf-8')
-                 print("✅ PDF Decrypted successfully for Preview")
-             except Exception as dec_err:
-                 print(f"⚠️ Failed to decrypt PDF for preview: {dec_err}")
-
-        # Configure Gemini LATE - only after we have content
-        genai.configure(api_key=GEMINI_API_KEY)
-        
-        model = genai.GenerativeModel('gemini-2.5-flash', system_instruction=system_instruction)
-
-        prompt = """3️⃣ INVOICE PARSING PROMPT (STRICT JSON)
+INVOICE_PARSING_PROMPT = """3️⃣ INVOICE PARSING PROMPT (STRICT JSON)
 
 You are a parser.
 
@@ -807,73 +905,303 @@ Rules:
 - USE THE PRINTED GRAND TOTAL FROM THE DOCUMENT.
 """
 
-        response = model.generate_content([
-            *gemini_content_parts,
-            prompt
-        ], generation_config={"response_mime_type": "application/json"})
+# Cached entries are {"invoice", "pageRouting"} ("cached-routing"), so a cache hit answers like a miss
+PROCESS_DOCUMENT_VERSION = make_version("gemini-2.5-flash", INVOICE_SYSTEM_INSTRUCTION, INVOICE_PARSING_PROMPT, "page-routing-3", "cached-routing")
 
-        # Track token usage
-        track_token_usage(response)
 
-        print(f"DEBUG AI RAW RESPONSE: {response.text}")
-        clean_json = clean_json_text(response.text)
-        data = json.loads(clean_json)
-        print(f"DEBUG EXTRACTED DATA: {data}")
-        
-        return {
+@app.post("/ai/process-document")
+async def process_document(
+    file: UploadFile = File(...),
+    password: Optional[str] = Form(None),
+    stream: bool = Form(False),
+    authorization: str = Header(None)
+):
+    """
+    Process a single document (invoice image/PDF) and return structured data.
+    PDF pages with a text layer are sent as text and only scanned pages as
+    images; "pageRouting" in the result reports how each page was sent.
+    With stream=true the response is an NDJSON progress stream (decrypted,
+    pages_detected, text_extracted / page_rendered, extracting, extracted)
+    ending in a "result" or "error" line.
+    """
+    bind_token_budget(validate_api_key(authorization))
+
+    # Spool the upload to disk (hashed on the way) instead of reading it into memory
+    upload = await _spool(file)
+
+    async def run(progress: ProgressCallback) -> dict:
+        try:
+            return await _process_document_file(upload, password, progress)
+        finally:
+            upload.close()
+
+    return await _respond(run, stream)
+
+
+async def _mixed_page_parts(session: PdfSession, page_routes: List[dict], progress: ProgressCallback = _no_progress) -> List[Any]:
+    """
+    Model parts for a document mixing digital and scanned pages.
+
+    Only the pages routed "image" are rasterized. Consecutive text pages are
+    joined into one text part, and each scanned page is labelled, so the model
+    reads the document in page order.
+
+    Args:
+        session: Open PdfSession (text layer already extracted)
+        page_routes: session.page_routes()
+        progress: Progress callback
+
+    Returns:
+        Text parts and {"mime_type", "data"} image parts, in page order
+    """
+    image_pages = [route["page"] for route in page_routes if route["mode"] == "image"]
+    images = {}
+    async for img_b64, page_num, encoding in _iterate_in_thread(session.iter_page_images(pages=image_pages)):
+        print(f"Page {page_num} encoded: {encoding}")
+        progress("page_rendered", page=page_num, encoding=encoding)
+        images[page_num] = {"mime_type": encoding["mime_type"], "data": img_b64}
+    if len(images) != len(image_pages):
+        raise ValueError(f"Rendered {len(images)} of {len(image_pages)} scanned pages")
+
+    parts = []
+    pending_text = []
+    for route in page_routes:
+        page_num = route["page"]
+        if route["mode"] == "text":
+            pending_text.append(f"--- Page {page_num} ---\n{session.page_text(page_num)}")
+        elif route["mode"] == "image":
+            if pending_text:
+                parts.append("\n".join(pending_text))
+                pending_text = []
+            parts.append(f"--- Page {page_num} (scanned image) ---")
+            parts.append(images[page_num])
+    if pending_text:
+        parts.append("\n".join(pending_text))
+    return parts
+
+
+async def _process_document_file(
+    upload: StoredFile,
+    password: Optional[str] = None,
+    progress: ProgressCallback = _no_progress
+) -> dict:
+    """Extraction behind /ai/process-document, shared with queued document jobs"""
+    filename = upload.filename
+    mime_type = upload.content_type
+    is_pdf = upload.is_pdf
+
+    # File hash (computed while spooling) for duplicate detection - repeat uploads
+    # are served from the result cache without a model call or token usage
+    file_hash = upload.sha256
+    cache_key = result_cache.make_key(file_hash, "process-document", PROCESS_DOCUMENT_VERSION, password)
+    cached_entry = await asyncio.to_thread(result_cache.get, cache_key)
+    if cached_entry is not None:
+        decrypted_pdf_b64 = None
+        if password and is_pdf:
+            try:
+                import base64
+                with open_pdf_session(upload.path, password=password, file_hash=file_hash) as session:
+                    decrypted_bytes = await asyncio.to_thread(session.decrypted_bytes)
+                decrypted_pdf_b64 = base64.b64encode(decrypted_bytes).decode('utf-8')
+            except Exception as dec_err:
+                print(f"⚠️ Failed to decrypt PDF for preview: {dec_err}")
+        print(f"⚡ Result cache hit for {filename}")
+        result = {
             "success": True,
-            "invoice": data,
+            "invoice": cached_entry["invoice"],
             "decrypted_pdf": decrypted_pdf_b64,
+            "cached": True,
             "message": "Document processed successfully"
         }
-    except ResourceExhausted:
+        if cached_entry.get("pageRouting") is not None:
+            result["pageRouting"] = cached_entry["pageRouting"]
+        return result
+
+    # Check token limit before processing
+    limit_status = await check_token_limit()
+    if limit_status["limit_reached"]:
         raise HTTPException(
             status_code=429,
-            detail="Gemini API quota exceeded. Please retry later or upgrade plan."
+            detail=limit_status["message"]
         )
-    except HTTPException as he:
-        # Re-raise HTTP exceptions (like 422 for password)
-        raise he
-    except Exception as e:
-        import traceback
-        print(f"PROCESS DOCUMENT ERROR: {str(e)}")
-        print(traceback.format_exc())
-        raise HTTPException(status_code=500, detail=f"Failed to process document: {str(e)}")
-
-
-@app.post("/ai/process-bulk")
-async def process_bulk(
-    files: List[UploadFile] = File(...),
-    authorization: str = Header(None)
-):
-    """Process multiple documents and return structured data"""
-    validate_api_key(authorization)
 
-    if not GEMINI_API_KEY:
+    if not GEMINI_API_KEYS:
         raise HTTPException(status_code=500, detail="Gemini API key not configured on server")
 
-    genai.configure(api_key=GEMINI_API_KEY)
-    
-    # Use standard flash model for consistency
-    model = genai.GenerativeModel('gemini-2.5-flash')
-
-    results = []
-    successful = 0
-    failed = 0
-
-    import base64, json
-
-    for f in files:
-        try:
-            file_bytes = await f.read()
-            b64 = base64.b64encode(file_bytes).decode('utf-8')
+    session = None
+    try:
+        # Helper to prepare content for Gemini
+        gemini_content_parts = []
+        
+        # Handle PDF specifically for Password/Extraction
+        if is_pdf:
+            # Opened once and shared by text extraction, rendering and the preview copy
+            session = open_pdf_session(upload.path, password=password, file_hash=file_hash)
+            extracted_text = ""
+            
+            try:
+                # Triage (milliseconds): validates the password and routes each page
+                # before any text extraction or rendering
+                triage = await asyncio.to_thread(session.triage)
+                # If it WAS encrypted, we are now "in".
+                if password:
+                    progress("decrypted")
+                progress("pages_detected", pages=triage["pageCount"], kind=triage["kind"])
+            except PdfPasswordError:
+                print(f"PASSWORD REQUIRED for {filename}")
+                raise HTTPException(status_code=422, detail="Invalid password" if password else "Password required")
+            except Exception as e:
+                print(f"PDF triage failed for {filename}: {e}")
+                raise HTTPException(status_code=422, detail=f"Could not read PDF: {str(e)}")
+
+            page_routes = triage["pages"]
+            text_pages = [route["page"] for route in page_routes if route["mode"] == "text"]
+            image_pages = [route["page"] for route in page_routes if route["mode"] == "image"]
+            if text_pages:
+                # Scanned documents skip the text pass entirely
+                try:
+                    extracted_text = await asyncio.to_thread(session.text, False, text_pages)
+                except Exception as e:
+                    print(f"PDF text extraction failed, using page images: {e}")
+                    # Every page goes as an image, the digital ones included
+                    text_pages = []
+                    image_pages = list(range(1, triage["pageCount"] + 1))
 
-            prompt = """Extract invoice data into this exact JSON structure:
-{
-  "supplierName": "string",
-  "supplierAddress": "string",
-  "supplierGstin": "string",
-  "buyerName": "string",
+            # Strategy:
+            # 1. If we have good text, send text (Cheap & Fast)
+            # 2. If valid PDF but no text (Scanned), convert to Images and send Images (Reliable)
+            # 3. If password was provided and worked, we MUST use Text or Images (can't send bytes)
+            # 4. If no password needed and text failed, we COULD send bytes, but Images are safer for consistency.
+            # 5. Mixed documents (digital pages + scanned pages): text for the text pages,
+            #    images only for the scanned ones, interleaved in page order
+            
+            if text_pages and image_pages:
+                print(f"Processing PDF as MIXED: {len(text_pages)} text pages, {len(image_pages)} scanned pages")
+                progress("text_extracted", chars=len(extracted_text), pages=text_pages)
+                try:
+                    gemini_content_parts.extend(await _mixed_page_parts(session, page_routes, progress))
+                except Exception as img_err:
+                    print(f"Image conversion failed: {img_err}")
+                    raise HTTPException(status_code=422, detail="Failed to render scanned pages of the document")
+            elif not image_pages and len(extracted_text.strip()) > 50:
+                print(f"Processing PDF as TEXT: {len(extracted_text)} chars")
+                progress("text_extracted", chars=len(extracted_text))
+                gemini_content_parts.append(extracted_text)
+            else:
+                print("Processing PDF as IMAGES (Scanned or Low Text)")
+                # Convert to images using pdf_processor utils or local logic
+                try:
+                    # Pages are rendered one at a time in a worker thread and
+                    # appended as they arrive - no intermediate list of all pages.
+                    # Blank pages are skipped when the routing found scanned pages.
+                    rendered_pages = set()
+                    async for img_b64, page_num, encoding in _iterate_in_thread(session.iter_page_images(pages=image_pages or None)):
+                         print(f"Page {page_num} encoded: {encoding}")
+                         progress("page_rendered", page=page_num, encoding=encoding)
+                         gemini_content_parts.append({
+                             "mime_type": encoding["mime_type"],
+                             "data": img_b64
+                         })
+                         rendered_pages.add(page_num)
+                    if not rendered_pages:
+                         raise ValueError("No images extracted from PDF")
+                    page_routes = [
+                        {**route, "mode": "image"} if route["page"] in rendered_pages else route
+                        for route in page_routes
+                    ]
+                except Exception as img_err:
+                     # The password was checked by the triage, so this is a damaged page
+                     print(f"Image conversion failed: {img_err}")
+                     raise HTTPException(status_code=422, detail="Failed to render the document's pages")
+
+        else:
+            # Not a PDF (Image), send as is
+            import base64
+            b64 = base64.b64encode(await asyncio.to_thread(upload.read)).decode('utf-8')
+            gemini_content_parts.append({
+                "mime_type": mime_type,
+                "data": b64
+            })
+            
+
+        # ------------------------------------------------------------------
+        # DECRYPTION FOR PREVIEW (One-Password Experience)
+        # If password was provided and we reached here (meaning it was valid),
+        # create a decrypted copy for the frontend to show without prompt.
+        # ------------------------------------------------------------------
+        decrypted_pdf_b64 = None
+        if password and is_pdf:
+             try:
+                 import base64
+                 decrypted_bytes = await asyncio.to_thread(session.decrypted_bytes)
+                 decrypted_pdf_b64 = base64.b64encode(decrypted_bytes).decode('utf-8')
+                 print("✅ PDF Decrypted successfully for Preview")
+             except Exception as dec_err:
+                 print(f"⚠️ Failed to decrypt PDF for preview: {dec_err}")
+
+        model = get_model('gemini-2.5-flash', INVOICE_SYSTEM_INSTRUCTION)
+
+        progress("extracting")
+        response = await generate_content_async(model, [
+            *gemini_content_parts,
+            INVOICE_PARSING_PROMPT
+        ], generation_config={"response_mime_type": "application/json"})
+
+        # Track token usage
+        await track_token_usage(response)
+
+        print(f"DEBUG AI RAW RESPONSE: {response.text}")
+        clean_json = clean_json_text(response.text)
+        data = json.loads(clean_json)
+        print(f"DEBUG EXTRACTED DATA: {data}")
+        progress("extracted")
+
+        await asyncio.to_thread(result_cache.set, cache_key, {"invoice": data, "pageRouting": page_routes if is_pdf else None})
+        
+        result = {
+            "success": True,
+            "invoice": data,
+            "decrypted_pdf": decrypted_pdf_b64,
+            "message": "Document processed successfully"
+        }
+        if is_pdf:
+            # How each page was sent: "text", "image" or "blank" (skipped)
+            result["pageRouting"] = page_routes
+        return result
+    except CircuitOpenError as e:
+        raise _gemini_unavailable(e)
+    except (TokenBudgetExceeded, RequestTooLarge) as e:
+        raise _budget_error(e)
+    except ResourceExhausted:
+        raise HTTPException(
+            status_code=429,
+            detail="Gemini API quota exceeded. Please retry later or upgrade plan."
+        )
+    except HTTPException as he:
+        # Re-raise HTTP exceptions (like 422 for password)
+        raise he
+    except Exception as e:
+        import traceback
+        print(f"PROCESS DOCUMENT ERROR: {str(e)}")
+        print(traceback.format_exc())
+        raise HTTPException(status_code=500, detail=f"Failed to process document: {str(e)}")
+    finally:
+        if session is not None:
+            session.close()
+
+
+# ============================================================
+# BULK PROCESSING
+# ============================================================
+# Max files of a bulk upload extracted at the same time
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", "8"))
+
+BULK_INVOICE_PROMPT = """Extract invoice data into this exact JSON structure:
+{
+  "supplierName": "string",
+  "supplierAddress": "string",
+  "supplierGstin": "string",
+  "buyerName": "string",
   "buyerAddress": "string",
   "buyerGstin": "string",
   "invoiceNumber": "string",
@@ -893,32 +1221,327 @@ async def process_bulk(
 }
 Ensure dates are YYYY-MM-DD.
 """
-            response = model.generate_content([
-                {"mime_type": f.content_type or "application/octet-stream", "data": b64},
-                prompt
+
+
+async def _extract_bulk_file(
+    model,
+    index: int,
+    upload: StoredFile,
+    semaphore: asyncio.Semaphore,
+    quota_exhausted: asyncio.Event
+) -> dict:
+    """
+    Extract one file of a bulk upload.
+    Never raises: failures are returned with their reason so the batch keeps going.
+    Once the quota is exhausted, files that have not started yet are skipped.
+    The file is only read into memory once its turn comes.
+    """
+    filename = upload.filename
+    result = {"index": index, "filename": filename}
+
+    async with semaphore:
+        if quota_exhausted.is_set():
+            return {**result, "status": "skipped", "error": "Gemini API quota exceeded during bulk processing."}
+
+        try:
+            if upload.is_pdf:
+                # Locked or unreadable PDFs fail here, before a model call is paid for
+                triage = await asyncio.to_thread(triage_pdf, upload.path)
+                if triage["locked"]:
+                    return {**result, "status": "failed", "error": "Password required"}
+
+            import base64
+            b64 = base64.b64encode(await asyncio.to_thread(upload.read)).decode('utf-8')
+
+            response = await generate_content_async(model, [
+                {"mime_type": upload.content_type, "data": b64},
+                BULK_INVOICE_PROMPT
             ], generation_config={"response_mime_type": "application/json"})
 
-            clean_json = clean_json_text(response.text)
-            data = json.loads(clean_json)
-            results.append(data)
-            successful += 1
+            data = json.loads(clean_json_text(response.text))
+            return {**result, "status": "ok", "invoice": data}
+        except CircuitOpenError:
+            return {**result, "status": "unavailable", "error": "AI service is temporarily unavailable. Please retry shortly."}
+        except TokenBudgetExceeded as e:
+            quota_exhausted.set()
+            return {**result, "status": "quota_exceeded", "error": e.message}
         except ResourceExhausted:
-            # If bulk processing hits limit, stop and raise error to save user from waiting
-            raise HTTPException(
-                status_code=429,
-                detail="Gemini API quota exceeded during bulk processing."
-            )
-        except Exception:
-            failed += 1
-            continue
+            quota_exhausted.set()
+            return {**result, "status": "quota_exceeded", "error": "Gemini API quota exceeded during bulk processing."}
+        except Exception as e:
+            print(f"Bulk file {filename} failed: {e}")
+            return {**result, "status": "failed", "error": str(e)}
+
+
+@app.post("/ai/process-bulk")
+async def process_bulk(
+    files: List[UploadFile] = File(...),
+    stream: bool = Form(False),
+    authorization: str = Header(None)
+):
+    """
+    Process multiple documents and return structured data.
+    Files are extracted concurrently (BULK_CONCURRENCY at a time).
+    With stream=true the response is NDJSON: one "result" line per file as soon
+    as it finishes (in completion order), then a final "summary" line.
+    """
+    bind_token_budget(validate_api_key(authorization))
+
+    # Check token limit before processing
+    limit_status = await check_token_limit()
+    if limit_status["limit_reached"]:
+        raise HTTPException(status_code=429, detail=limit_status["message"])
+
+    if not GEMINI_API_KEYS:
+        raise HTTPException(status_code=500, detail="Gemini API key not configured on server")
+
+    # Use standard flash model for consistency
+    model = get_model('gemini-2.5-flash')
+
+    # Spool uploads up front: FastAPI closes the form files once the handler returns,
+    # which happens before a streaming body is sent.
+    uploads: List[StoredFile] = []
+    try:
+        for f in files:
+            uploads.append(await _spool(f))
+    except BaseException:
+        for upload in uploads:
+            upload.close()
+        raise
+
+    def close_uploads():
+        for upload in uploads:
+            upload.close()
+
+    semaphore = asyncio.Semaphore(BULK_CONCURRENCY)
+    quota_exhausted = asyncio.Event()
+    tasks = [
+        asyncio.create_task(_extract_bulk_file(model, index, upload, semaphore, quota_exhausted))
+        for index, upload in enumerate(uploads)
+    ]
+
+    def summarize(results: List[dict]) -> dict:
+        successful = sum(1 for r in results if r["status"] == "ok")
+        return {
+            "total": len(results),
+            "successful": successful,
+            "failed": len(results) - successful,
+            "quota_exceeded": quota_exhausted.is_set(),
+            "message": "Bulk processing stopped early: Gemini API quota exceeded" if quota_exhausted.is_set() else "Bulk processing completed"
+        }
+
+    if stream:
+        from fastapi.responses import StreamingResponse
+
+        async def result_lines():
+            results = []
+            try:
+                for next_done in asyncio.as_completed(tasks):
+                    result = await next_done
+                    results.append(result)
+                    yield json.dumps({"type": "result", **result}) + "\n"
+                yield json.dumps({"type": "summary", "success": True, **summarize(results)}) + "\n"
+            finally:
+                # Client went away: stop paying for files nobody will read
+                for task in tasks:
+                    task.cancel()
+                close_uploads()
+
+        return StreamingResponse(result_lines(), media_type="application/x-ndjson")
+
+    try:
+        results = await asyncio.gather(*tasks)
+    finally:
+        close_uploads()
+    summary = summarize(results)
+
+    if quota_exhausted.is_set() and summary["successful"] == 0:
+        raise HTTPException(
+            status_code=429,
+            detail="Gemini API quota exceeded during bulk processing."
+        )
 
     return {
         "success": True,
-        "invoices": results,
-        "successful": successful,
-        "failed": failed,
-        "message": "Bulk processing completed"
+        "invoices": [r["invoice"] for r in results if r["status"] == "ok"],
+        "errors": [
+            {"index": r["index"], "filename": r["filename"], "status": r["status"], "error": r["error"]}
+            for r in results if r["status"] != "ok"
+        ],
+        **summary
+    }
+
+
+# Optimized prompt for Tally ({final_text} is filled with the extracted invoice text,
+# {table_note} with _table_note of it)
+INVOICE_PDF_PROMPT = """Extract invoice data and return ONLY valid JSON.
+
+Required fields (camelCase strictly):
+- supplierName
+- supplierAddress
+- supplierGstin
+- buyerName
+- buyerAddress
+- buyerGstin
+- invoiceNumber
+- invoiceDate (YYYY-MM-DD format)
+- taxableValue
+- totalAmount
+- lineItems: [{{"description": "", "quantity": 0, "rate": 0, "amount": 0, "gstRate": 0, "hsn": "", "unit": ""}}]
+
+GST EXTRACTION RULES:
+1. 'gstRate' must be a NUMBER (e.g. 18, 12, 5, 0).
+2. Look for columns "GST Rate", "IGST %", "CGST %", "SGST %".
+3. If CGST (9%) and SGST (9%) are separate, SUM them: gstRate = 18.
+4. If gstRate is NOT in the line item row, look at the tax summary at the bottom.
+5. If NO rate is found, CALCULATE it: (Tax Amount / Taxable Amount) * 100.
+6. Verify: (amount * gstRate/100) should approx equal the tax amount.
+
+{table_note}Invoice text:
+{final_text}
+
+Return ONLY the JSON object, no markdown formatting."""
+
+# Used for every part of a long invoice after the first; header fields come from part 1
+INVOICE_LINE_ITEMS_PROMPT = """This is part {part} of {parts} of a long invoice. Extract ONLY the line items in this part and return ONLY valid JSON.
+
+{{
+  "lineItems": [{{"description": "", "quantity": 0, "rate": 0, "amount": 0, "gstRate": 0, "hsn": "", "unit": ""}}],
+  "taxableValue": number or null (ONLY if the invoice's printed taxable value appears in this part),
+  "totalAmount": number or null (ONLY if the invoice's printed grand total appears in this part)
+}}
+
+RULES:
+1. 'gstRate' must be a NUMBER (e.g. 18, 12, 5, 0). If CGST and SGST are separate, SUM them.
+2. Do NOT include sub-totals, carried-forward or brought-forward rows as line items.
+3. If this part has no line items, return an empty lineItems array.
+
+{table_note}Invoice text (part {part} of {parts}):
+{final_text}
+
+Return ONLY the JSON object, no markdown formatting."""
+
+# Invoices longer than this are split on line boundaries and the parts extracted concurrently
+INVOICE_TEXT_CHUNK_CHARS = int(os.getenv("INVOICE_TEXT_CHUNK_CHARS", "8000"))
+INVOICE_CHUNK_CONCURRENCY = int(os.getenv("INVOICE_CHUNK_CONCURRENCY", "8"))
+INVOICE_CHUNK_MAX_ATTEMPTS = 2
+
+PROCESS_INVOICE_PDF_VERSION = make_version("gemini-2.5-flash", INVOICE_PDF_PROMPT, INVOICE_LINE_ITEMS_PROMPT, TABLE_LAYOUT_NOTE)
+
+
+async def _extract_invoice_chunk(model, prompt: str, part: int, semaphore: asyncio.Semaphore) -> dict:
+    """
+    Run one invoice part prompt, retrying once on bad output.
+    ResourceExhausted and CircuitOpenError are re-raised so the caller can abort the whole invoice.
+    """
+    attempts = 0
+    last_error = None
+    async with semaphore:
+        while attempts < INVOICE_CHUNK_MAX_ATTEMPTS:
+            attempts += 1
+            try:
+                response = await generate_content_async(
+                    model,
+                    prompt,
+                    generation_config={"response_mime_type": "application/json"}
+                )
+                return {
+                    "part": part,
+                    "status": "ok" if attempts == 1 else "retried",
+                    "attempts": attempts,
+                    "data": json.loads(clean_json_text(response.text))
+                }
+            except (ResourceExhausted, CircuitOpenError):
+                raise
+            except Exception as e:
+                last_error = str(e)
+                print(f"⚠️ Invoice part {part} extraction failed (attempt {attempts}): {e}")
+                if is_retryable(e):
+                    # Transient errors were already retried by the client; only bad output gets another attempt
+                    break
+
+    return {"part": part, "status": "failed", "attempts": attempts, "error": last_error, "data": {}}
+
+
+def _check_invoice_totals(invoice: dict) -> dict:
+    """
+    Compare the merged line items with the printed taxable value / grand total.
+    Line item amounts may be quoted before or after GST, so either form matching counts.
+    """
+    items = invoice.get("lineItems") or []
+    items_total = sum(parse_amount(item.get("amount")) or 0.0 for item in items)
+    items_total_with_tax = sum(
+        (parse_amount(item.get("amount")) or 0.0) * (1 + (parse_amount(item.get("gstRate")) or 0.0) / 100)
+        for item in items
+    )
+    taxable_value = parse_amount(invoice.get("taxableValue"))
+    total_amount = parse_amount(invoice.get("totalAmount"))
+
+    status = "unknown"
+    for printed, computed in ((taxable_value, items_total), (total_amount, items_total_with_tax), (total_amount, items_total)):
+        if printed is None or not items:
+            continue
+        # Allow for per-line rounding and round-off rows
+        if abs(printed - computed) <= max(1.0, abs(printed) * 0.005):
+            status = "ok"
+            break
+        status = "mismatch"
+
+    return {
+        "lineItemsTotal": round(items_total, 2),
+        "lineItemsTotalWithTax": round(items_total_with_tax, 2),
+        "taxableValue": taxable_value,
+        "totalAmount": total_amount,
+        "status": status
     }
+
+
+async def _extract_invoice_chunks(model, text_chunks: List[str]) -> Tuple[dict, List[dict]]:
+    """
+    Map-reduce extraction of a long invoice.
+
+    Header fields come from the first part (full invoice prompt); line items come
+    from every part, extracted concurrently and concatenated in order. A printed
+    taxable value / grand total found in a later part overrides the first part's,
+    since totals are printed at the end of the invoice.
+
+    Returns:
+        (merged invoice data, per-part status)
+    """
+    parts = len(text_chunks)
+    semaphore = asyncio.Semaphore(INVOICE_CHUNK_CONCURRENCY)
+    prompts = [INVOICE_PDF_PROMPT.format(final_text=text_chunks[0], table_note=_table_note(text_chunks[0]))] + [
+        INVOICE_LINE_ITEMS_PROMPT.format(part=index + 1, parts=parts, final_text=chunk, table_note=_table_note(chunk))
+        for index, chunk in enumerate(text_chunks) if index > 0
+    ]
+    await _preflight_tokens(sum(estimate_tokens(prompt) for prompt in prompts), len(prompts))
+    tasks = [
+        asyncio.create_task(_extract_invoice_chunk(model, prompt, index + 1, semaphore))
+        for index, prompt in enumerate(prompts)
+    ]
+    try:
+        chunk_results = await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    if chunk_results[0]["status"] == "failed":
+        raise ValueError(f"Invoice header extraction failed: {chunk_results[0]['error']}")
+
+    invoice = dict(chunk_results[0]["data"])
+    line_items = list(invoice.get("lineItems") or [])
+    for result in chunk_results[1:]:
+        data = result.pop("data")
+        line_items.extend(data.get("lineItems") or [])
+        for field in ("taxableValue", "totalAmount"):
+            if parse_amount(data.get(field)) is not None:
+                invoice[field] = data[field]
+    chunk_results[0].pop("data")
+    invoice["lineItems"] = line_items
+
+    return invoice, chunk_results
+
+
 @app.post("/ai/process-invoice-pdf")
 async def process_invoice_pdf(
     request: Dict[str, Any],
@@ -929,19 +1552,18 @@ async def process_invoice_pdf(
     Reduces token usage by 90-95% compared to sending base64 PDF.
     """
     # Validate user's API key
-    validate_api_key(authorization)
+    bind_token_budget(validate_api_key(authorization))
     
     # Check if Gemini API key is configured
-    if not GEMINI_API_KEY:
+    if not GEMINI_API_KEYS:
         raise HTTPException(
             status_code=500,
             detail="Gemini API key not configured on server"
         )
     
+    session = None
     try:
         import base64
-        import io
-        import pdfplumber
         import json
         
         # Extract base64 PDF from request
@@ -953,46 +1575,61 @@ async def process_invoice_pdf(
         
         # Decode base64 to PDF bytes
         pdf_bytes = base64.b64decode(pdf_base64)
+
+        file_hash = hashlib.sha256(pdf_bytes).hexdigest()
+        cache_key = result_cache.make_key(file_hash, "process-invoice-pdf", PROCESS_INVOICE_PDF_VERSION, password)
+        cached_result = await asyncio.to_thread(result_cache.get, cache_key)
+        if cached_result is not None:
+            print("⚡ Result cache hit for invoice PDF")
+            return {**cached_result, "cached": True}
+
+        # Check token limit before processing
+        limit_status = await check_token_limit()
+        if limit_status["limit_reached"]:
+            raise HTTPException(status_code=429, detail=limit_status["message"])
         
-        # Extract text from PDF using pdfplumber
-        extracted_text = ""
+        # Open (and decrypt) once; text extraction and OCR rendering share it
+        session = open_pdf_session(pdf_bytes, password=password, file_hash=file_hash)
+
+        # Triage first (milliseconds): validates the password and finds the pages
+        # with a text layer, so scanned invoices skip the pdfplumber pass
         try:
-            with pdfplumber.open(io.BytesIO(pdf_bytes), password=password) as pdf:
-                for page in pdf.pages:
-                    page_text = page.extract_text()
-                    if page_text:
-                        extracted_text += page_text + "\n"
+            triage = await asyncio.to_thread(session.triage)
+        except PdfPasswordError:
+            raise HTTPException(status_code=422, detail="Password required")
         except Exception as e:
-            error_str = str(e).lower()
-            if "password" in error_str or "encrypted" in error_str:
-                raise HTTPException(status_code=422, detail="Password required")
-            # If generic error (e.g. not a valid PDF or other issue), just log and continue to OCR fallback? 
-            # If password failed, we definitely can't do OCR either as images are also locked.
-            # So simple check:
-            print(f"PDFPlumber failed: {e}")
-            if "password" in error_str or "encrypted" in error_str:
-                raise HTTPException(status_code=422, detail="Password required")
+            raise HTTPException(status_code=422, detail=f"Could not read PDF: {str(e)}")
+        text_pages = [route["page"] for route in triage["pages"] if route["mode"] == "text"]
+        image_pages = [route["page"] for route in triage["pages"] if route["mode"] == "image"]
+
+        # Extract text from PDF using pdfplumber (tables as TSV when compact).
+        # One pass fills both: the plain text is cached while the layout is built.
+        extracted_text = ""
+        layout_text = ""
+        if text_pages:
+            try:
+                layout_text = await asyncio.to_thread(session.text, COMPACT_TEXT_LAYOUT)
+                extracted_text = await asyncio.to_thread(session.text)
+            except Exception as e:
+                # Damaged text layer: log and continue to OCR fallback
+                print(f"PDFPlumber failed: {e}")
         
         # If no text extracted (scanned PDF), fall back to OCR
         if not extracted_text.strip():
-             # Check if it was password locked but we missed it (unlikely with pdfplumber check above)
-             pass 
-
              try:
                 import pytesseract
-                from pdf2image import convert_from_bytes
-                
-                # Note: convert_from_bytes also needs password if encrypted
-                images = convert_from_bytes(pdf_bytes, userpw=password) if password else convert_from_bytes(pdf_bytes)
-                extracted_text = "\n".join(
-                    pytesseract.image_to_string(img) 
-                    for img in images
-                )
+
+                def ocr_pages() -> str:
+                    return "\n".join(
+                        pytesseract.image_to_string(session.page_image(page_num))
+                        for page_num in image_pages or range(1, session.page_count + 1)
+                    )
+
+                extracted_text = layout_text = await asyncio.to_thread(ocr_pages)
+             except PdfPasswordError:
+                raise HTTPException(status_code=422, detail="Password required")
              except Exception as ocr_error:
                 print(f"OCR failed: {str(ocr_error)}")
-                ocr_str = str(ocr_error).lower()
-                if "password" in ocr_str or "encrypted" in ocr_str:
-                     raise HTTPException(status_code=422, detail="Password required")
                 raise HTTPException(status_code=500, detail="Could not extract text from PDF")
         
         # ✅ IMPORTANT: Extract ALL text - do NOT filter anything
@@ -1000,257 +1637,790 @@ async def process_invoice_pdf(
         
         # Clean up the text (remove excessive whitespace, but keep all content)
         lines = []
-        for line in extracted_text.splitlines():
-            cleaned_line = line.strip()
-            if cleaned_line:  # Only remove completely empty lines
+        for line in layout_text.splitlines():
+            # Strip each TSV cell separately so empty leading cells keep their tab
+            cleaned_line = "\t".join(cell.strip() for cell in line.split("\t"))
+            if cleaned_line.strip():  # Only remove completely empty lines
                 lines.append(cleaned_line)
         
         # Join all lines - this is the COMPLETE invoice text
         complete_text = "\n".join(lines)
         
-        # Smart chunking: If text is too large (>8000 chars), intelligently split
-        # but NEVER drop data - we'll process in chunks if needed
-        max_chars = 8000  # Safe limit for Gemini
+        # Smart chunking: text larger than one prompt is split on line boundaries
+        # and every part is extracted - NEVER drop data
+        text_chunks = split_text(complete_text, INVOICE_TEXT_CHUNK_CHARS)
+
+        text_layout = _text_layout_stats(extracted_text, complete_text)
+        print(f"📄 Extracted text: {len(extracted_text)} chars (~{text_layout['plain_tokens_est']} tokens) → Cleaned: {len(complete_text)} chars (~{text_layout['prompt_tokens_est']} tokens) → Parts: {len(text_chunks)}")
+
         
-        if len(complete_text) <= max_chars:
-            # Text fits in one request - use it all
-            final_text = complete_text
+        model = get_model('gemini-2.5-flash')
+
+        chunk_status = None
+        if len(text_chunks) <= 1:
+            prompt = INVOICE_PDF_PROMPT.format(final_text=complete_text, table_note=_table_note(complete_text))
+
+            # Call Gemini with compressed text
+            response = await generate_content_async(
+                model,
+                prompt,
+                generation_config={"response_mime_type": "application/json"}
+            )
+
+            print(f"DEBUG INVOICE PDF RAW: {response.text}")
+            clean_json = clean_json_text(response.text)
+            invoice_data = json.loads(clean_json)
         else:
-            # Text is large - take first 8000 chars which usually contains all invoice data
-            # (Invoice metadata is always at the top)
-            final_text = complete_text[:max_chars]
-            print(f"⚠️ Large invoice: Using first {max_chars} chars (full text: {len(complete_text)} chars)")
+            print(f"📄 Large invoice: extracting {len(text_chunks)} parts concurrently")
+            invoice_data, chunk_status = await _extract_invoice_chunks(model, text_chunks)
+        print(f"DEBUG INVOICE PDF DATA: {invoice_data}")
+
+        totals_check = _check_invoice_totals(invoice_data)
+        if totals_check["status"] == "mismatch":
+            print(f"⚠️ Invoice line items do not add up to the printed totals: {totals_check}")
+
+        failed_parts = [c["part"] for c in chunk_status or [] if c["status"] == "failed"]
         
-        print(f"📄 Extracted text: {len(extracted_text)} chars → Cleaned: {len(complete_text)} chars → Final: {len(final_text)} chars")
+        result = {
+            "success": True,
+            "documentType": "INVOICE",
+            "data": invoice_data,
+            "totalsCheck": totals_check,
+            "stats": {
+                "original_text_length": len(extracted_text),
+                "final_text_length": len(complete_text),
+                "parts": len(text_chunks),
+                "text_layout": text_layout,
+                "text_preserved": "100% - All invoice data extracted" if not failed_parts else f"Incomplete - parts {failed_parts} failed"
+            }
+        }
+        if chunk_status is not None:
+            result["parts"] = chunk_status
 
+        # Only complete results are cached, so a retry can recover failed parts
+        if not failed_parts:
+            await asyncio.to_thread(result_cache.set, cache_key, result)
+        return result
+        
+    except CircuitOpenError as e:
+        raise _gemini_unavailable(e)
+    except (TokenBudgetExceeded, RequestTooLarge) as e:
+        raise _budget_error(e)
+    except ResourceExhausted:
+        raise HTTPException(
+            status_code=429,
+            detail="Gemini API quota exceeded. Please retry later or upgrade plan."
+        )
+    except HTTPException:
+        # Re-raise HTTP exceptions (like 422 for password)
+        raise
+    except Exception as e:
+        import traceback
+        import uuid
+        error_msg = str(e)
+        error_trace = traceback.format_exc()
         
-        # Configure Gemini
-        genai.configure(api_key=GEMINI_API_KEY)
-        model = genai.GenerativeModel('gemini-2.5-flash')
+        print(f"ERROR processing invoice: {error_msg}")
+        print(f"Traceback: {error_trace}")
+        
+        # Save error to database
+        # (Database logging disabled)
         
-        # Optimized prompt for Tally
-        prompt = f"""Extract invoice data and return ONLY valid JSON.
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error processing invoice: {error_msg}"
+        )
+    finally:
+        if session is not None:
+            session.close()
 
-Required fields (camelCase strictly):
-- supplierName
-- supplierAddress
-- supplierGstin
-- buyerName
-- buyerAddress
-- buyerGstin
-- invoiceNumber
-- invoiceDate (YYYY-MM-DD format)
-- taxableValue
-- totalAmount
-- lineItems: [{{"description": "", "quantity": 0, "rate": 0, "amount": 0, "gstRate": 0, "hsn": "", "unit": ""}}]
 
-GST EXTRACTION RULES:
-1. 'gstRate' must be a NUMBER (e.g. 18, 12, 5, 0).
-2. Look for columns "GST Rate", "IGST %", "CGST %", "SGST %".
-3. If CGST (9%) and SGST (9%) are separate, SUM them: gstRate = 18.
-4. If gstRate is NOT in the line item row, look at the tax summary at the bottom.
-5. If NO rate is found, CALCULATE it: (Tax Amount / Taxable Amount) * 100.
-6. Verify: (amount * gstRate/100) should approx equal the tax amount.
 
-Invoice text:
-{final_text}
+# ============================================================
+# BANK STATEMENT PROMPTS
+# ============================================================
+# {extracted_text} is filled with the statement text, {table_note} with _table_note of it
+BANK_STATEMENT_TEXT_PROMPT = """5️⃣ BANK STATEMENT TEXT PARSING PROMPT (STRICT JSON)
+
+You are a bank statement analyzer.
+Extract data from the following text into this exact JSON structure:
+
+{{
+  "documentType": "BANK_STATEMENT" or "INVOICE",
+  "bankName": "string (Extract from top header. DO NOT output 'Unknown Bank' unless impossible to find)",
+  "accountNumber": "string (full or masked)",
+  "accountNumberLast4": "string (last 4 digits)",
+  "totalWithdrawals": number (sum of all debits),
+  "totalDeposits": number (sum of all credits),
+  "transactions": [
+    {{
+      "id": "string (generate unique ID)",
+      "date": "YYYY-MM-DD",
+      "description": "string",
+      "withdrawal": number (0 if deposit),
+      "deposit": number (0 if withdrawal),
+      "balance": number,
+      "voucherType": "Payment" (if withdrawal) or "Receipt" (if deposit),
+      "contraLedger": "string (suggest category e.g. 'Bank Charges', 'Salary', 'Vendor Name', or 'Suspense A/c')"
+    }}
+  ]
+}}
+
+RULES:
+1. **CRITICAL CHECK**: If this document contains "Tax Invoice", "Bill To", "GSTIN", "Supply", and is clearly a bill from a vendor, set "documentType" to "INVOICE" and return immediately.
+2. Detect Date Format: Normalize all dates to YYYY-MM-DD.
+3. **Bank Name**: Look at the FIRST FEW LINES. Common banks: HDFC, ICICI, SBI, Axis, Kotak, Canara, Yes Bank.
+4. **Columns**:
+   - 'Debit', 'Dr', 'Withdrawal', 'Payments' -> withdrawal
+   - 'Credit', 'Cr', 'Deposit', 'Receipts' -> deposit
+5. **Transactions**:
+   - Combine multi-line descriptions.
+   - If a row has NO amount in neither Debit nor Credit, SKIP IT (it might be a header or sub-header).
+   - Ensure no commas in numbers.
+
+PRIORITY INSTRUCTION:
+Check the document type FIRST.
+If it is an invoice, set "documentType": "INVOICE" and ignore other fields.
+If it is a bank statement, set "documentType": "BANK_STATEMENT" and extract all fields.
+
+{table_note}Text Content:
+{extracted_text}
+
+JSON OUTPUT ONLY:
+"""
+
+BANK_STATEMENT_PAGE_PROMPT = "Extract bank statement JSON only with transactions array. Fields: date, description, withdrawal, deposit, balance."
+
+# Prepended to each part of a statement too long for one prompt
+BANK_STATEMENT_CHUNK_NOTE = """NOTE: This is part {part} of {parts} of a longer statement (pages {first_page}-{last_page}).
+Extract every transaction row in this part, including rows at the very start that may repeat the end of the previous part.
+
+"""
+
+PROCESS_BANK_STATEMENT_PDF_VERSION = make_version(
+    "gemini-2.5-flash", BANK_STATEMENT_TEXT_PROMPT, BANK_STATEMENT_PAGE_PROMPT, BANK_STATEMENT_CHUNK_NOTE, TABLE_LAYOUT_NOTE,
+    f"bank-parsers-{BANK_PARSER_VERSION}", "page-routing-3"
+)
+
+# Digital statements from banks with a registered layout (bank_parsers) are parsed
+# locally; the model is only used when detection or balance validation fails
+LOCAL_BANK_PARSERS = os.getenv("LOCAL_BANK_PARSERS", "true").lower() != "false"
+
+
+async def _parse_bank_statement_locally(session: PdfSession) -> Tuple[Optional[dict], dict]:
+    """
+    Run the local layout parsers over an opened statement's tables.
+
+    Returns:
+        (statement or None, {"bank", "status", "reason", "ms"}); see bank_parsers.parse_statement
+    """
+    def parse() -> Tuple[Optional[dict], dict]:
+        tables = [
+            rows
+            for page_num in range(1, session.page_count + 1)
+            for rows in session.page_tables(page_num)
+        ]
+        return parse_statement(session.page_text(1), tables)
+
+    started = time.perf_counter()
+    try:
+        statement, info = await asyncio.to_thread(parse)
+    except Exception as e:
+        statement, info = None, {"bank": None, "status": "error", "reason": str(e)}
+    info["ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return statement, info
+
+
+# ============================================================
+# BANK STATEMENT PAGE FAN-OUT
+# ============================================================
+# Max pages of a scanned statement sent to Gemini at the same time
+BANK_PAGE_CONCURRENCY = int(os.getenv("BANK_PAGE_CONCURRENCY", "4"))
+# Input tokens of one rendered statement page (A4 at 150 DPI), for the pre-flight budget check
+PAGE_IMAGE_TOKENS_EST = estimate_image_tokens(1240, 1754)
+BANK_PAGE_MAX_ATTEMPTS = 2
+
+# Digital statements longer than this many characters are split on page
+# boundaries and the parts are extracted concurrently
+BANK_TEXT_CHUNK_CHARS = int(os.getenv("BANK_TEXT_CHUNK_CHARS", "30000"))
+BANK_TEXT_CHUNK_OVERLAP_LINES = 4
+BANK_CHUNK_CONCURRENCY = int(os.getenv("BANK_CHUNK_CONCURRENCY", "8"))
+
+
+async def _extract_bank_statement_page(
+    model,
+    img_base64: str,
+    page_num: int,
+    encoding: dict,
+    semaphore: asyncio.Semaphore,
+    progress: ProgressCallback = _no_progress
+) -> dict:
+    """
+    Extract transactions from one statement page image.
+    Pages with unreadable output are retried once; failed pages are reported instead of silently dropped.
+    ResourceExhausted and CircuitOpenError are re-raised so the caller can abort the whole statement.
+    The caller acquires the semaphore before rendering the page; it is released here.
+    """
+    attempts = 0
+    last_error = None
+    result = None
+
+    try:
+        while attempts < BANK_PAGE_MAX_ATTEMPTS:
+            attempts += 1
+            try:
+                response = await generate_content_async(
+                    model,
+                    [
+                        {"mime_type": encoding["mime_type"], "data": img_base64},
+                        BANK_STATEMENT_PAGE_PROMPT
+                    ],
+                    generation_config={"response_mime_type": "application/json"}
+                )
+
+                data = json.loads(clean_json_text(response.text))
+                result = {
+                    "page": page_num,
+                    "status": "ok" if attempts == 1 else "retried",
+                    "attempts": attempts,
+                    "encoding": encoding,
+                    "transactions": data.get("transactions") or []
+                }
+                break
+            except (ResourceExhausted, CircuitOpenError):
+                raise
+            except Exception as e:
+                last_error = str(e)
+                print(f"⚠️ Page {page_num} extraction failed (attempt {attempts}): {e}")
+                if is_retryable(e):
+                    # Transient errors were already retried by the client; only bad output gets another attempt
+                    break
+    finally:
+        semaphore.release()
+
+    if result is None:
+        result = {
+            "page": page_num,
+            "status": "failed",
+            "attempts": attempts,
+            "encoding": encoding,
+            "error": last_error,
+            "transactions": []
+        }
+    progress("page_extracted", page=page_num, status=result["status"], transactions=result["transactions"])
+    return result
+
+
+async def _extract_bank_statement_images(
+    model,
+    session: PdfSession,
+    pages: Optional[List[int]] = None,
+    progress: ProgressCallback = _no_progress,
+    preflight: bool = True
+) -> List[dict]:
+    """
+    Render statement pages (default: all) and extract each page image concurrently.
+
+    Args:
+        preflight: Check the pages against the token budget first; False when the
+            caller already preflighted them with the rest of the statement
+
+    Returns:
+        _extract_bank_statement_page results, in page order
+    """
+    page_total = len(pages) if pages is not None else session.page_count
+    if preflight:
+        try:
+            await _preflight_tokens(page_total * (PAGE_IMAGE_TOKENS_EST + estimate_tokens(BANK_STATEMENT_PAGE_PROMPT)), page_total)
+        except TokenBudgetExceeded as e:
+            raise _budget_error(e)
+
+    # Pages are rendered lazily: a page is only rendered once a model slot is free,
+    # so at most BANK_PAGE_CONCURRENCY page images are held in memory at a time.
+    semaphore = asyncio.Semaphore(BANK_PAGE_CONCURRENCY)
+    tasks = []
+    page_iter = session.iter_page_images(pages=pages)
+
+    try:
+        while True:
+            await semaphore.acquire()
+            try:
+                page = await asyncio.to_thread(next, page_iter, None)
+            except BaseException:
+                semaphore.release()
+                raise
+            if page is None:
+                semaphore.release()
+                break
+
+            img_base64, page_num, encoding = page
+            progress("page_rendered", page=page_num, encoding=encoding)
+            tasks.append(asyncio.create_task(_extract_bank_statement_page(model, img_base64, page_num, encoding, semaphore, progress)))
+            del page, img_base64
+        print(f"DEBUG: Rendered {len(tasks)} page images.")
+    except asyncio.CancelledError:
+        for task in tasks:
+            task.cancel()
+        raise
+    except Exception as e:
+        for task in tasks:
+            task.cancel()
+        print(f"📸 Page rendering failed: {e}")
+
+        if isinstance(e, PdfPasswordError):
+             raise HTTPException(status_code=422, detail="Password required")
+        
+        raise HTTPException(status_code=500, detail=f"Failed to convert PDF to images: {str(e)}")
+    finally:
+        _close_iterator(page_iter)
+
+    try:
+        # gather() keeps results in page order regardless of completion order
+        page_results = await asyncio.gather(*tasks)
+    except CircuitOpenError as e:
+        for task in tasks:
+            task.cancel()
+        raise _gemini_unavailable(e)
+    except (TokenBudgetExceeded, RequestTooLarge) as e:
+        for task in tasks:
+            task.cancel()
+        raise _budget_error(e)
+    except ResourceExhausted:
+        for task in tasks:
+            task.cancel()
+        raise HTTPException(
+            status_code=429,
+            detail="AI quota exceeded. Please wait or upgrade plan."
+        )
+
+    return page_results
+
+
+async def _extract_bank_statement_chunk(model, chunk: dict, parts: int, semaphore: asyncio.Semaphore) -> dict:
+    """
+    Extract one text part of a long statement, retrying once on bad output.
+    ResourceExhausted and CircuitOpenError are re-raised so the caller can abort the whole statement.
+    """
+    prompt = BANK_STATEMENT_CHUNK_NOTE.format(
+        part=chunk["index"] + 1,
+        parts=parts,
+        first_page=chunk["first_page"],
+        last_page=chunk["last_page"]
+    ) + BANK_STATEMENT_TEXT_PROMPT.format(extracted_text=chunk["text"], table_note=_table_note(chunk["text"]))
+
+    attempts = 0
+    last_error = None
+    async with semaphore:
+        while attempts < BANK_PAGE_MAX_ATTEMPTS:
+            attempts += 1
+            try:
+                response = await generate_content_async(
+                    model,
+                    prompt,
+                    generation_config={"response_mime_type": "application/json"}
+                )
+                data = json.loads(clean_json_text(response.text))
+                return {
+                    "chunk": chunk["index"],
+                    "pages": [chunk["first_page"], chunk["last_page"]],
+                    "status": "ok" if attempts == 1 else "retried",
+                    "attempts": attempts,
+                    "data": data
+                }
+            except (ResourceExhausted, CircuitOpenError):
+                raise
+            except Exception as e:
+                last_error = str(e)
+                print(f"⚠️ Statement part {chunk['index'] + 1} extraction failed (attempt {attempts}): {e}")
+                if is_retryable(e):
+                    # Transient errors were already retried by the client; only bad output gets another attempt
+                    break
+
+    return {
+        "chunk": chunk["index"],
+        "pages": [chunk["first_page"], chunk["last_page"]],
+        "status": "failed",
+        "attempts": attempts,
+        "error": last_error,
+        "data": {}
+    }
+
+
+def _chunk_tokens_est(chunks: List[dict]) -> int:
+    """Estimated input tokens of the text parts of a statement"""
+    prompt_tokens = estimate_tokens(BANK_STATEMENT_CHUNK_NOTE) + estimate_tokens(BANK_STATEMENT_TEXT_PROMPT) + estimate_tokens(TABLE_LAYOUT_NOTE)
+    return sum(estimate_tokens(chunk["text"]) + prompt_tokens for chunk in chunks)
+
+
+async def _extract_bank_statement_chunks(model, chunks: List[dict], progress: ProgressCallback = _no_progress) -> Optional[dict]:
+    """
+    Map-reduce extraction of a long digital statement.
+
+    Parts are extracted concurrently, transactions are merged in page order with
+    rows repeated across part boundaries dropped, and running balances are
+    checked where the parts meet. Returns None if every part failed.
+    Each part's raw transactions are reported as it finishes, before de-duplication.
+    """
+    await _preflight_tokens(_chunk_tokens_est(chunks), len(chunks))
+    semaphore = asyncio.Semaphore(BANK_CHUNK_CONCURRENCY)
+
+    async def extract(chunk: dict) -> dict:
+        result = await _extract_bank_statement_chunk(model, chunk, len(chunks), semaphore)
+        progress(
+            "chunk_extracted",
+            part=chunk["index"] + 1,
+            parts=len(chunks),
+            pages=result["pages"],
+            status=result["status"],
+            transactions=result["data"].get("transactions") or []
+        )
+        return result
 
-Return ONLY the JSON object, no markdown formatting."""
+    tasks = [asyncio.create_task(extract(chunk)) for chunk in chunks]
+    try:
+        chunk_results = await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    succeeded = [r for r in chunk_results if r["status"] != "failed"]
+    if not succeeded:
+        return None
+
+    # The statement header (bank, account, document type) is read from the first part
+    header = dict(succeeded[0]["data"])
+    if header.get("documentType") == "INVOICE":
+        return {"success": True, **header}
+
+    transactions, boundaries, duplicates = merge_chunk_transactions(
+        [r["data"].get("transactions") or [] for r in chunk_results]
+    )
+    balance_checks = check_boundary_balances(transactions, boundaries)
+
+    chunk_status = []
+    for r in chunk_results:
+        r.pop("data")
+        chunk_status.append(r)
+
+    failed_chunks = [r["chunk"] for r in chunk_status if r["status"] == "failed"]
+    if failed_chunks:
+        print(f"⚠️ Bank statement parts failed: {failed_chunks}")
+    mismatches = [c["index"] for c in balance_checks if c["status"] == "mismatch"]
+    if mismatches:
+        print(f"⚠️ Running balance breaks at transactions {mismatches}")
+
+    header.pop("transactions", None)
+    return {
+        "success": True,
+        **header,
+        "documentType": "BANK_STATEMENT",
+        "totalWithdrawals": round(sum(parse_amount(t.get("withdrawal")) or 0.0 for t in transactions), 2),
+        "totalDeposits": round(sum(parse_amount(t.get("deposit")) or 0.0 for t in transactions), 2),
+        "transactions": transactions,
+        "chunks": chunk_status,
+        "duplicatesRemoved": duplicates,
+        "balanceChecks": balance_checks
+    }
+
+
+async def _extract_mixed_bank_statement(model, session: PdfSession, page_routes: List[dict], progress: ProgressCallback = _no_progress) -> Optional[dict]:
+    """
+    Extract a statement whose digital pages have scanned pages in between.
 
-        # Call Gemini with compressed text
-        response = model.generate_content(
-            prompt,
-            generation_config={"response_mime_type": "application/json"}
+    Each run of text pages is split into text parts as a digital statement would
+    be, only the scanned pages are rendered, and both run concurrently. Results
+    are merged in page order like the parts of a long statement. Returns None if
+    every part and page failed.
+    """
+    # Runs of text pages between scanned pages (blank pages do not break a run)
+    segments, current = [], []
+    for route in page_routes:
+        if route["mode"] == "text":
+            current.append(route["page"])
+        elif route["mode"] == "image" and current:
+            segments.append(current)
+            current = []
+    if current:
+        segments.append(current)
+    image_pages = [route["page"] for route in page_routes if route["mode"] == "image"]
+
+    def plan_chunks() -> List[dict]:
+        chunks = []
+        for segment in segments:
+            chunks.extend(session.text_chunks(BANK_TEXT_CHUNK_CHARS, BANK_TEXT_CHUNK_OVERLAP_LINES, COMPACT_TEXT_LAYOUT, pages=segment))
+        for index, chunk in enumerate(chunks):
+            chunk["index"] = index
+        return chunks
+
+    chunks = await asyncio.to_thread(plan_chunks)
+    progress("chunks_planned", parts=len(chunks), image_pages=image_pages)
+
+    # The whole statement must fit in the budget before any part is sent
+    try:
+        await _preflight_tokens(
+            _chunk_tokens_est(chunks) + len(image_pages) * (PAGE_IMAGE_TOKENS_EST + estimate_tokens(BANK_STATEMENT_PAGE_PROMPT)),
+            len(chunks) + len(image_pages)
         )
+    except TokenBudgetExceeded as e:
+        raise _budget_error(e)
 
-        print(f"DEBUG INVOICE PDF RAW: {response.text}")
-        clean_json = clean_json_text(response.text)
-        invoice_data = json.loads(clean_json)
-        print(f"DEBUG INVOICE PDF DATA: {invoice_data}")
-        
-        return {
-            "success": True,
-            "documentType": "INVOICE",
-            "data": invoice_data,
-            "stats": {
-                "original_text_length": len(extracted_text),
-                "final_text_length": len(final_text),
-                "text_preserved": "100% - All invoice data extracted"
-            }
-        }
-        
+    semaphore = asyncio.Semaphore(BANK_CHUNK_CONCURRENCY)
+    tasks = [asyncio.create_task(_extract_bank_statement_chunk(model, chunk, len(chunks), semaphore)) for chunk in chunks]
+    try:
+        page_results = await _extract_bank_statement_images(model, session, image_pages, progress, preflight=False)
+        chunk_results = await asyncio.gather(*tasks)
+    except CircuitOpenError as e:
+        raise _gemini_unavailable(e)
+    except (TokenBudgetExceeded, RequestTooLarge) as e:
+        raise _budget_error(e)
     except ResourceExhausted:
         raise HTTPException(
             status_code=429,
-            detail="Gemini API quota exceeded. Please retry later or upgrade plan."
-        )
-    except Exception as e:
-        import traceback
-        import uuid
-        error_msg = str(e)
-        error_trace = traceback.format_exc()
-        
-        print(f"ERROR processing invoice: {error_msg}")
-        print(f"Traceback: {error_trace}")
-        
-        # Save error to database
-        # (Database logging disabled)
-        
-        raise HTTPException(
-            status_code=500,
-            detail=f"Error processing invoice: {error_msg}"
+            detail="AI quota exceeded. Please wait or upgrade plan."
         )
-
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    for r in chunk_results:
+        progress("chunk_extracted", part=r["chunk"] + 1, parts=len(chunks), pages=r["pages"], status=r["status"], transactions=r["data"].get("transactions") or [])
+
+    succeeded = [r for r in chunk_results if r["status"] != "failed"]
+    if not succeeded and all(p["status"] == "failed" for p in page_results):
+        return None
+
+    # The statement header is read from the first text part (the page prompt has none)
+    header = dict(succeeded[0]["data"]) if succeeded else {}
+    if header.get("documentType") == "INVOICE":
+        return {"success": True, **header}
+
+    # Text parts and page images, in page order
+    units = sorted(
+        [(r["pages"][0], r["data"].get("transactions") or []) for r in chunk_results]
+        + [(p["page"], p["transactions"]) for p in page_results],
+        key=lambda unit: unit[0]
+    )
+    transactions, boundaries, duplicates = merge_chunk_transactions([unit[1] for unit in units])
+    balance_checks = check_boundary_balances(transactions, boundaries)
+
+    chunk_status = []
+    for r in chunk_results:
+        r.pop("data")
+        chunk_status.append(r)
+    page_status = []
+    for p in page_results:
+        p.pop("transactions")
+        page_status.append(p)
+
+    failed = [r["pages"] for r in chunk_status if r["status"] == "failed"] + [p["page"] for p in page_status if p["status"] == "failed"]
+    if failed:
+        print(f"⚠️ Bank statement parts/pages failed: {failed}")
+    progress("merged", transactions=len(transactions), failed=failed)
+
+    header.pop("transactions", None)
+    return {
+        "success": True,
+        **header,
+        "documentType": "BANK_STATEMENT",
+        "totalWithdrawals": round(sum(parse_amount(t.get("withdrawal")) or 0.0 for t in transactions), 2),
+        "totalDeposits": round(sum(parse_amount(t.get("deposit")) or 0.0 for t in transactions), 2),
+        "transactions": transactions,
+        "chunks": chunk_status,
+        "pages": page_status,
+        "duplicatesRemoved": duplicates,
+        "balanceChecks": balance_checks,
+        "engine": "gemini-mixed",
+        "pageRouting": page_routes
+    }
 
 
 @app.post("/ai/process-bank-statement-pdf")
 async def process_bank_statement_pdf(
     file: UploadFile = File(...),
     password: Optional[str] = Form(None),
+    stream: bool = Form(False),
     authorization: str = Header(None)
 ):
     """
     Process Bank Statement PDF.
-    Prioritizes TEXT extraction (pdfplumber) for digital PDFs to save tokens/speed.
-    Falls back to IMAGE processing for scanned PDFs.
+    Digital statements from supported banks (bank_parsers) are parsed locally,
+    without the model, when their running balances check out.
+    Otherwise prioritizes TEXT extraction (pdfplumber) for digital PDFs to save tokens/speed.
+    Falls back to IMAGE processing for scanned PDFs; in mixed PDFs only the scanned
+    pages are rendered and the rest is sent as text ("pageRouting" lists each page).
+    "engine" in the result reports which path was used (local, gemini-text, gemini-images, gemini-mixed).
+    With stream=true the response is an NDJSON progress stream (decrypted,
+    pages_detected, page_rendered, page_extracted / chunk_extracted with partial
+    transactions, merged) ending in a "result" or "error" line.
     """
-    validate_api_key(authorization)
+    bind_token_budget(validate_api_key(authorization))
+
+    # Spool the uploaded PDF to disk; the PDF engines read it from there
+    upload = await _spool(file)
+
+    async def run(progress: ProgressCallback) -> dict:
+        try:
+            return await _process_bank_statement_pdf_file(upload, password, progress)
+        finally:
+            upload.close()
 
-    if not GEMINI_API_KEY:
+    return await _respond(run, stream)
+
+
+async def _process_bank_statement_pdf_file(
+    upload: StoredFile,
+    password: Optional[str] = None,
+    progress: ProgressCallback = _no_progress
+) -> dict:
+    """Extraction behind /ai/process-bank-statement-pdf, shared with queued statement jobs"""
+    if not GEMINI_API_KEYS:
         raise HTTPException(500, "Gemini API key not configured")
 
-    genai.configure(api_key=GEMINI_API_KEY)
-    
+    file_hash = upload.sha256
+    cache_key = result_cache.make_key(file_hash, "process-bank-statement-pdf", PROCESS_BANK_STATEMENT_PDF_VERSION, password)
+    cached_result = await asyncio.to_thread(result_cache.get, cache_key)
+    if cached_result is not None:
+        print(f"⚡ Result cache hit for {upload.filename}")
+        return {**cached_result, "cached": True}
+
+    # Check token limit before processing
+    limit_status = await check_token_limit()
+    if limit_status["limit_reached"]:
+        raise HTTPException(status_code=429, detail=limit_status["message"])
+
     # Use flash model for speed and large context window
-    model = genai.GenerativeModel("gemini-2.5-flash")
+    model = get_model("gemini-2.5-flash")
 
-    # Read uploaded PDF
-    pdf_bytes = await file.read()
-    
     # ------------------------------------------------------------------
-    # UNIFIED DECRYPTION LOGIC (Same as Invoices)
+    # SHARED PDF SESSION
+    # Opened and decrypted once; text extraction and the image fallback
+    # both read from it, so no decrypted copy is re-serialized and re-parsed.
     # ------------------------------------------------------------------
-    if password:
-        try:
-            import io
-            import pypdf
-            print(f"DEBUG: Attempting decryption with password: {password}")
-            
-            # Decrypt to new bytes
-            reader = pypdf.PdfReader(io.BytesIO(pdf_bytes), password=password)
-            writer = pypdf.PdfWriter()
-            for page in reader.pages:
-                writer.add_page(page)
-            
-            output_stream = io.BytesIO()
-            writer.write(output_stream)
-            pdf_bytes = output_stream.getvalue()
-            
-            # Clear password since we now have unlocked bytes
-            password = None 
-            print("✅ Bank Statement Decrypted Successfully")
-            
-        except Exception as e:
-            print(f"❌ Decryption Failed: {e}")
-            raise HTTPException(status_code=422, detail="Invalid password")
-    
-    # Attempt Text Extraction first
-    import io
-    import pdfplumber
-    import json
-    
-    extracted_text = ""
-    
+    session = open_pdf_session(upload.path, password=password, file_hash=file_hash)
     try:
-        # Open with None password (already decrypted if needed)
-        with pdfplumber.open(io.BytesIO(pdf_bytes), password=None) as pdf:
-            print(f"DEBUG: PDF Opened Successfully. Pages: {len(pdf.pages)}")
-            for page in pdf.pages:
-                text = page.extract_text()
-                if text:
-                    extracted_text += text + "\n"
+        # Validates the password and routes each page up front (milliseconds: no text
+        # extraction or rendering, see pdf_processor.triage_pdf)
+        triage = await asyncio.to_thread(session.triage)
+        print(f"DEBUG: PDF Opened Successfully. Pages: {triage['pageCount']} ({triage['kind']}, {triage['ms']}ms)")
+    except PdfPasswordError:
+        session.close()
+        raise HTTPException(status_code=422, detail="Invalid password" if password else "Password required")
     except Exception as e:
-        print(f"PDF Text extraction failed: {e}")
-        error_str = str(e).lower()
-        if "password" in error_str or "encrypted" in error_str:
-            raise HTTPException(status_code=422, detail="Password required")
-        # Continue to image fallback ONLY if not a password error
-    
-    # Check if we have enough text to consider it a digital PDF
-    # (Scanned docs might have a few chars of noise)
-    if len(extracted_text.strip()) > 50:
-        print(f"📄 Processing Bank Statement as TEXT ({len(extracted_text)} chars)")
-        
-        # Limit text if it's insanely large
-        if len(extracted_text) > 100000:
-            extracted_text = extracted_text[:100000] + "\n...(truncated)"
-            
-        prompt = f"""5️⃣ BANK STATEMENT TEXT PARSING PROMPT (STRICT JSON)
+        session.close()
+        raise HTTPException(status_code=422, detail=f"Could not read PDF: {str(e)}")
 
-You are a bank statement analyzer.
-Extract data from the following text into this exact JSON structure:
+    if password:
+        progress("decrypted")
+    progress("pages_detected", pages=triage["pageCount"], kind=triage["kind"])
 
-{{
-  "documentType": "BANK_STATEMENT" or "INVOICE",
-  "bankName": "string (Extract from top header. DO NOT output 'Unknown Bank' unless impossible to find)",
-  "accountNumber": "string (full or masked)",
-  "accountNumberLast4": "string (last 4 digits)",
-  "totalWithdrawals": number (sum of all debits),
-  "totalDeposits": number (sum of all credits),
-  "transactions": [
-    {{
-      "id": "string (generate unique ID)",
-      "date": "YYYY-MM-DD",
-      "description": "string",
-      "withdrawal": number (0 if deposit),
-      "deposit": number (0 if withdrawal),
-      "balance": number,
-      "voucherType": "Payment" (if withdrawal) or "Receipt" (if deposit),
-      "contraLedger": "string (suggest category e.g. 'Bank Charges', 'Salary', 'Vendor Name', or 'Suspense A/c')"
-    }}
-  ]
-}}
+    try:
+        return await _process_bank_statement_session(model, session, cache_key, progress)
+    finally:
+        session.close()
 
-RULES:
-1. **CRITICAL CHECK**: If this document contains "Tax Invoice", "Bill To", "GSTIN", "Supply", and is clearly a bill from a vendor, set "documentType" to "INVOICE" and return immediately.
-2. Detect Date Format: Normalize all dates to YYYY-MM-DD.
-3. **Bank Name**: Look at the FIRST FEW LINES. Common banks: HDFC, ICICI, SBI, Axis, Kotak, Canara, Yes Bank.
-4. **Columns**:
-   - 'Debit', 'Dr', 'Withdrawal', 'Payments' -> withdrawal
-   - 'Credit', 'Cr', 'Deposit', 'Receipts' -> deposit
-5. **Transactions**:
-   - Combine multi-line descriptions.
-   - If a row has NO amount in neither Debit nor Credit, SKIP IT (it might be a header or sub-header).
-   - Ensure no commas in numbers.
 
-PRIORITY INSTRUCTION:
-Check the document type FIRST.
-If it is an invoice, set "documentType": "INVOICE" and ignore other fields.
-If it is a bank statement, set "documentType": "BANK_STATEMENT" and extract all fields.
+async def _process_bank_statement_session(model, session: PdfSession, cache_key: str, progress: ProgressCallback = _no_progress) -> dict:
+    """Text-first extraction of an opened bank statement, with the image fallback"""
+    # Page routes from the triage (cached on the session)
+    page_routes = (await asyncio.to_thread(session.triage))["pages"]
+    text_pages = [route["page"] for route in page_routes if route["mode"] == "text"]
+    image_pages = [route["page"] for route in page_routes if route["mode"] == "image"]
 
-Text Content:
-{extracted_text}
+    # Attempt Text Extraction first (digital statements only: scans skip the text pass)
+    extracted_text = ""
+    statement_text = ""
+    
+    if text_pages and not image_pages:
+        try:
+            # Tables as TSV when compact; the plain text is cached in the same pass
+            statement_text = await asyncio.to_thread(session.text, COMPACT_TEXT_LAYOUT)
+            extracted_text = await asyncio.to_thread(session.text)
+        except Exception as e:
+            print(f"PDF Text extraction failed: {e}")
+
+    if text_pages and image_pages:
+        # Digital pages with scanned pages in between: text parts for the digital
+        # pages, images only for the scanned ones
+        print(f"📄 Processing Bank Statement as MIXED: {len(text_pages)} text pages, {len(image_pages)} scanned pages")
+        progress("text_extracted", pages=text_pages)
+        result = await _extract_mixed_bank_statement(model, session, page_routes, progress)
+        if result is not None:
+            if not any(unit["status"] == "failed" for unit in result.get("chunks", []) + result.get("pages", [])):
+                await asyncio.to_thread(result_cache.set, cache_key, result)
+            return result
+        print("⚠️ Every part of the mixed statement failed")
+
+    # Check if we have enough text to consider it a digital PDF
+    # (Scanned docs might have a few chars of noise)
+    elif not image_pages and len(extracted_text.strip()) > 50:
+        text_layout = _text_layout_stats(extracted_text, statement_text)
+        print(f"📄 Processing Bank Statement as TEXT ({len(extracted_text)} chars, ~{text_layout['plain_tokens_est']} tokens → {len(statement_text)} chars, ~{text_layout['prompt_tokens_est']} tokens)")
+        progress("text_extracted", chars=len(extracted_text), prompt_chars=len(statement_text))
+
+        local_parse = None
+        if LOCAL_BANK_PARSERS:
+            statement, local_parse = await _parse_bank_statement_locally(session)
+            progress("local_parse", **local_parse)
+            if statement is not None:
+                print(f"⚡ Parsed {local_parse['bank']} statement locally: {len(statement['transactions'])} transactions in {local_parse['ms']}ms")
+                result = {
+                    "success": True,
+                    **statement,
+                    "engine": "local",
+                    "localParse": local_parse,
+                    "textLayout": text_layout,
+                    "pageRouting": page_routes
+                }
+                progress("merged", transactions=len(statement["transactions"]))
+                await asyncio.to_thread(result_cache.set, cache_key, result)
+                return result
+            print(f"🤖 Local parser not used ({local_parse['status']}: {local_parse['reason']}), asking the model")
 
-JSON OUTPUT ONLY:
-"""
         try:
-            response = model.generate_content(
-                prompt,
-                generation_config={"response_mime_type": "application/json"}
-            )
-            
-            clean_json = clean_json_text(response.text)
-            data = json.loads(clean_json)
-            
-            # Ensure transactions array exists
-            if "transactions" not in data or data["transactions"] is None:
-                data["transactions"] = []
-                
-            return {
-                "success": True,
-                **data
-            }
-            
+            if len(statement_text) > BANK_TEXT_CHUNK_CHARS:
+                # Too long for one prompt: extract page-aligned parts concurrently
+                chunks = await asyncio.to_thread(session.text_chunks, BANK_TEXT_CHUNK_CHARS, BANK_TEXT_CHUNK_OVERLAP_LINES, COMPACT_TEXT_LAYOUT)
+                print(f"📄 Splitting statement into {len(chunks)} parts")
+                progress("chunks_planned", parts=len(chunks))
+                result = await _extract_bank_statement_chunks(model, chunks, progress)
+                if result is None:
+                    raise ValueError("every statement part failed")
+            else:
+                prompt = BANK_STATEMENT_TEXT_PROMPT.format(extracted_text=statement_text, table_note=_table_note(statement_text))
+                response = await generate_content_async(
+                    model,
+                    prompt,
+                    generation_config={"response_mime_type": "application/json"}
+                )
+
+                clean_json = clean_json_text(response.text)
+                data = json.loads(clean_json)
+
+                # Ensure transactions array exists
+                if "transactions" not in data or data["transactions"] is None:
+                    data["transactions"] = []
+
+                result = {
+                    "success": True,
+                    **data
+                }
+            result["engine"] = "gemini-text"
+            result["textLayout"] = text_layout
+            result["pageRouting"] = page_routes
+            if local_parse is not None:
+                result["localParse"] = local_parse
+
+            progress("merged", transactions=len(result.get("transactions") or []))
+
+            # Only complete results are cached, so a retry can recover failed parts
+            if not any(c["status"] == "failed" for c in result.get("chunks", [])):
+                await asyncio.to_thread(result_cache.set, cache_key, result)
+            return result
+
+        except CircuitOpenError as e:
+            raise _gemini_unavailable(e)
+        except (TokenBudgetExceeded, RequestTooLarge) as e:
+            raise _budget_error(e)
         except ResourceExhausted:
             raise HTTPException(
                 status_code=429,
@@ -1262,76 +2432,43 @@ JSON OUTPUT ONLY:
             pass
 
     # ================= FALLBACK: IMAGE PROCESSING =================
-    print(f"📸 Fallback: Processing Bank Statement as IMAGES. Password providing: {password}")
+    print("📸 Fallback: Processing Bank Statement as IMAGES")
+    progress("image_fallback")
     
-    try:
-        print("DEBUG: Calling split_pdf_to_images...")
-        pages = split_pdf_to_images(pdf_bytes, password=password)
-        print(f"DEBUG: split_pdf_to_images success. {len(pages)} images.")
-    except Exception as e:
-        import traceback
-        print(f"📸 Image Fallback Failed: {e}")
-        # traceback.print_exc() # Optional: keep logs clean if we handle it
-        
-        # Check both str and repr to catch "pdfminer.pdfdocument.PDFPasswordIncorrect"
-        error_str = (str(e) + " " + repr(e)).lower()
-        
-        if "password" in error_str or "encrypted" in error_str or "decryption" in error_str or "incorrect" in error_str:
-             raise HTTPException(status_code=422, detail="Password required")
-        
-        raise HTTPException(status_code=500, detail=f"Failed to convert PDF to images: {str(e)}")
-        
-    transactions = []
+    # Scanned statements skip blank pages; after a failed text pass every page is sent
+    page_results = await _extract_bank_statement_images(model, session, None if text_pages else (image_pages or None), progress)
+    sent_pages = {result["page"] for result in page_results}
+    page_routes = [{**route, "mode": "image"} if route["page"] in sent_pages else route for route in page_routes]
 
-    for img_base64, _ in pages:
-        try:
-            response = model.generate_content(
-                [
-                    {"mime_type": "image/png", "data": img_base64},
-                    "Extract bank statement JSON only with transactions array. Fields: date, description, withdrawal, deposit, balance."
-                ],
-                generation_config={"response_mime_type": "application/json"}
-            )
+    transactions = []
+    page_status = []
+    for result in page_results:
+        transactions.extend(result.pop("transactions"))
+        page_status.append(result)
 
-            data = json.loads(clean_json_text(response.text))
-            transactions.extend(data.get("transactions", []))
-        except ResourceExhausted:
-            raise HTTPException(
-                status_code=429,
-                detail="AI quota exceeded. Please wait or upgrade plan."
-            )
-        except:
-            continue
+    failed_pages = [p["page"] for p in page_status if p["status"] == "failed"]
+    if failed_pages:
+        print(f"⚠️ Bank statement pages failed: {failed_pages}")
+    progress("merged", transactions=len(transactions), failed_pages=failed_pages)
 
     # Return combined transactions from images
-    return {
+    result = {
         "success": True,
         "documentType": "BANK_STATEMENT",
         "transactions": transactions,
+        "pages": page_status,
+        "engine": "gemini-images",
+        "pageRouting": page_routes,
         "note": "Processed via Image Fallback"
     }
 
+    # Only complete results are cached, so a retry can recover failed pages
+    if not failed_pages:
+        await asyncio.to_thread(result_cache.set, cache_key, result)
+    return result
 
-@app.post("/ai/process-bank-statement")
-async def process_bank_statement(
-    file: UploadFile = File(...),
-    authorization: str = Header(None)
-):
-    """Process a single bank statement image (PNG/JPG)"""
-    validate_api_key(authorization)
-
-    if not GEMINI_API_KEY:
-        raise HTTPException(status_code=500, detail="Gemini API key not configured on server")
-
-    try:
-        genai.configure(api_key=GEMINI_API_KEY)
-        model = genai.GenerativeModel('gemini-2.5-flash')
-
-        file_bytes = await file.read()
-        import base64, json
-        img_base64 = base64.b64encode(file_bytes).decode('utf-8')
 
-        prompt = """4️⃣ BANK STATEMENT PARSING PROMPT (STRICT JSON)
+BANK_STATEMENT_IMAGE_PROMPT = """4️⃣ BANK STATEMENT PARSING PROMPT (STRICT JSON)
 You are a bank statement parser.
 
 Return VALID JSON ONLY with the following fields (matches React Schema):
@@ -1372,9 +2509,42 @@ If it is an invoice, set "documentType": "INVOICE" and ignore other fields.
 If it is a bank statement, set "documentType": "BANK_STATEMENT" and extract all fields.
 """
 
-        response = model.generate_content([
+PROCESS_BANK_STATEMENT_VERSION = make_version("gemini-2.5-flash", BANK_STATEMENT_IMAGE_PROMPT)
+
+
+@app.post("/ai/process-bank-statement")
+async def process_bank_statement(
+    file: UploadFile = File(...),
+    authorization: str = Header(None)
+):
+    """Process a single bank statement image (PNG/JPG)"""
+    bind_token_budget(validate_api_key(authorization))
+
+    if not GEMINI_API_KEYS:
+        raise HTTPException(status_code=500, detail="Gemini API key not configured on server")
+
+    upload = await _spool(file)
+    try:
+        file_hash = upload.sha256
+        cache_key = result_cache.make_key(file_hash, "process-bank-statement", PROCESS_BANK_STATEMENT_VERSION)
+        cached_result = await asyncio.to_thread(result_cache.get, cache_key)
+        if cached_result is not None:
+            print(f"⚡ Result cache hit for {file.filename}")
+            return {**cached_result, "cached": True}
+
+        # Check token limit before processing
+        limit_status = await check_token_limit()
+        if limit_status["limit_reached"]:
+            raise HTTPException(status_code=429, detail=limit_status["message"])
+
+        model = get_model('gemini-2.5-flash')
+
+        import base64, json
+        img_base64 = base64.b64encode(await asyncio.to_thread(upload.read)).decode('utf-8')
+
+        response = await generate_content_async(model, [
             {"mime_type": file.content_type or "image/png", "data": img_base64},
-            prompt
+            BANK_STATEMENT_IMAGE_PROMPT
         ], generation_config={"response_mime_type": "application/json"})
 
         print(f"DEBUG BANK IMG RAW: {response.text}")
@@ -1386,10 +2556,18 @@ If it is a bank statement, set "documentType": "BANK_STATEMENT" and extract all
         if "transactions" not in data or data["transactions"] is None:
              data["transactions"] = []
 
-        return {
+        result = {
             "success": True,
             **data
         }
+        await asyncio.to_thread(result_cache.set, cache_key, result)
+        return result
+    except HTTPException:
+        raise
+    except CircuitOpenError as e:
+        raise _gemini_unavailable(e)
+    except (TokenBudgetExceeded, RequestTooLarge) as e:
+        raise _budget_error(e)
     except ResourceExhausted:
         raise HTTPException(
             status_code=429,
@@ -1397,6 +2575,228 @@ If it is a bank statement, set "documentType": "BANK_STATEMENT" and extract all
         )
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to process bank statement: {str(e)}")
+    finally:
+        upload.close()
+
+# ============================================================
+# EXTRACTION JOBS
+# ============================================================
+# POST /jobs queues a document or bank statement and returns immediately; a
+# bounded pool of workers runs the same extraction as the synchronous endpoints
+# and GET /jobs/{id} reports status and results. Jobs and their files are kept
+# in SQLite and a directory next to it, so queued work survives a restart.
+# Password-protected PDFs are kept there decrypted until their job finishes
+# (see job_store.py); point JOBS_DIR at private, non-backed-up storage.
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_QUEUE_MAX = int(os.getenv("JOB_QUEUE_MAX", "200"))
+JOB_RETENTION_HOURS = float(os.getenv("JOB_RETENTION_HOURS", "24"))
+JOB_LEASE_SECONDS = 120
+JOB_POLL_SECONDS = 2
+JOB_MAX_ATTEMPTS = 3
+
+JOBS_DB = os.getenv("JOBS_DB", os.path.join(os.path.dirname(__file__), "jobs.db"))
+JOBS_DIR = os.getenv("JOBS_DIR", os.path.join(os.path.dirname(__file__), "job_files"))
+job_store = JobStore(JOBS_DB, JOBS_DIR)
+
+JOB_KINDS = ("document", "bank_statement_pdf")
+
+_job_wakeup = asyncio.Event()
+_job_workers: List[asyncio.Task] = []
+# Latest progress stage of each job running in this process
+_job_progress: Dict[str, dict] = {}
+_last_job_purge = 0.0
+
+
+def _job_owner(api_key: str) -> str:
+    # Jobs are only visible to the API key that created them; the key itself is not stored
+    return usage_bucket(api_key)
+
+
+async def _execute_job(job: dict):
+    """Run one claimed job through the endpoint's extraction and record the outcome"""
+    job_id = job["id"]
+    print(f"🧾 Job {job_id} ({job['kind']}) started, attempt {job['attempts']}")
+
+    def progress(stage: str, **fields):
+        fields.pop("transactions", None)
+        _job_progress[job_id] = {"stage": stage, **fields}
+
+    async def renew_lease():
+        while True:
+            await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+            await asyncio.to_thread(job_store.renew, job_id, JOB_LEASE_SECONDS)
+
+    renewer = asyncio.create_task(renew_lease())
+    # Model calls are charged to the API key that submitted the job
+    bind_usage(UsageScope(token_ledger, job["owner"], plan_limit))
+    try:
+        upload = await asyncio.to_thread(StoredFile.from_path, job_store.input_path(job_id), job["filename"], job["mime_type"])
+        if job["kind"] == "bank_statement_pdf":
+            result = await _process_bank_statement_pdf_file(upload, None, progress)
+        else:
+            result = await _process_document_file(upload, None, progress)
+        await asyncio.to_thread(job_store.finish, job_id, result)
+        print(f"🧾 Job {job_id} succeeded")
+    except asyncio.CancelledError:
+        # Server shutting down: hand the job back so the next start picks it up.
+        # Shielded so a second cancellation neither skips the release nor blocks the loop on the DB lock
+        await asyncio.shield(asyncio.to_thread(job_store.release, job_id))
+        raise
+    except HTTPException as e:
+        if e.status_code == 503 and e.headers and "Retry-After" in e.headers:
+            # Gemini circuit breaker open: hand the job back after the cooldown instead of failing it
+            print(f"🧾 Job {job_id} paused: {e.detail}")
+            await asyncio.sleep(float(e.headers["Retry-After"]))
+            await asyncio.to_thread(job_store.release, job_id)
+            return
+        print(f"🧾 Job {job_id} failed: {e.status_code} {e.detail}")
+        await asyncio.to_thread(job_store.finish, job_id, None, {"status": e.status_code, "detail": e.detail})
+    except Exception as e:
+        print(f"🧾 Job {job_id} failed: {e}")
+        await asyncio.to_thread(job_store.finish, job_id, None, {"status": 500, "detail": str(e)})
+    finally:
+        renewer.cancel()
+        _job_progress.pop(job_id, None)
+
+
+async def _job_worker():
+    """Claim and run jobs one at a time; sleeps until a job is submitted or the poll interval passes"""
+    global _last_job_purge
+    while True:
+        try:
+            job = await asyncio.to_thread(job_store.claim, JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS)
+        except Exception as e:
+            print(f"Job claim error: {e}")
+            job = None
+
+        if job is not None:
+            await _execute_job(job)
+            continue
+
+        if time.time() - _last_job_purge > 3600:
+            _last_job_purge = time.time()
+            purged = await asyncio.to_thread(job_store.purge, JOB_RETENTION_HOURS * 3600)
+            if purged:
+                print(f"🧾 Purged {purged} finished jobs")
+
+        _job_wakeup.clear()
+        try:
+            await asyncio.wait_for(_job_wakeup.wait(), JOB_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+
+@app.on_event("startup")
+async def start_job_workers():
+    for _ in range(JOB_WORKERS):
+        _job_workers.append(asyncio.create_task(_job_worker()))
+    print(f"🧾 Started {JOB_WORKERS} job workers")
+
+
+@app.on_event("shutdown")
+async def stop_job_workers():
+    for task in _job_workers:
+        task.cancel()
+    await asyncio.gather(*_job_workers, return_exceptions=True)
+    _job_workers.clear()
+
+
+@app.post("/jobs", status_code=202)
+async def create_job(
+    file: UploadFile = File(...),
+    kind: str = Form("document"),
+    password: Optional[str] = Form(None),
+    authorization: str = Header(None)
+):
+    """
+    Queue a document ("document") or bank statement PDF ("bank_statement_pdf")
+    for extraction. Returns the job id immediately; poll GET /jobs/{job_id}.
+    """
+    api_key = validate_api_key(authorization)
+
+    if kind not in JOB_KINDS:
+        raise HTTPException(status_code=400, detail=f"Unknown job kind. Use one of: {', '.join(JOB_KINDS)}")
+
+    # Refuse work the key has no tokens left for instead of queueing it
+    limit_status = await check_token_limit(usage_bucket(api_key))
+    if limit_status["limit_reached"]:
+        raise HTTPException(status_code=429, detail=limit_status["message"])
+
+    counts = await asyncio.to_thread(job_store.counts)
+    if counts["queued"] >= JOB_QUEUE_MAX:
+        raise HTTPException(
+            status_code=503,
+            detail="Job queue is full. Please retry shortly.",
+            headers={"Retry-After": str(JOB_POLL_SECONDS * 5)}
+        )
+
+    with await _spool(file) as upload:
+        # Without a password the spooled file itself is moved into job storage
+        job_input = upload.path
+
+        if password and upload.is_pdf:
+            # Passwords are never persisted: the PDF is decrypted now (which also
+            # validates the password) and the job stores the decrypted copy
+            def decrypt() -> bytes:
+                with open_pdf_session(upload.path, password=password, file_hash=upload.sha256) as session:
+                    return session.decrypted_bytes()
+
+            try:
+                job_input = await asyncio.to_thread(decrypt)
+            except PdfPasswordError:
+                raise HTTPException(status_code=422, detail="Invalid password")
+            except Exception as e:
+                raise HTTPException(status_code=422, detail=f"Could not read PDF: {str(e)}")
+        elif upload.is_pdf:
+            # A locked or unreadable PDF is rejected now instead of failing in the queue
+            try:
+                triage = await asyncio.to_thread(triage_pdf, upload.path)
+            except Exception as e:
+                raise HTTPException(status_code=422, detail=f"Could not read PDF: {str(e)}")
+            if triage["locked"]:
+                raise HTTPException(status_code=422, detail="Password required")
+
+        job_id = await asyncio.to_thread(
+            job_store.create, kind, _job_owner(api_key), upload.filename, upload.content_type, job_input
+        )
+    _job_wakeup.set()
+
+    return {
+        "success": True,
+        "job_id": job_id,
+        "status": "queued",
+        "status_url": f"/jobs/{job_id}"
+    }
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, authorization: str = Header(None)):
+    """Status of a queued job; includes the extraction result once it has succeeded"""
+    api_key = validate_api_key(authorization)
+
+    job = await asyncio.to_thread(job_store.get, job_id)
+    if job is None or job["owner"] != _job_owner(api_key):
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    response = {
+        "success": True,
+        "job_id": job["id"],
+        "kind": job["kind"],
+        "filename": job["filename"],
+        "status": job["status"],
+        "attempts": job["attempts"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"]
+    }
+    if job["status"] == "running" and job_id in _job_progress:
+        response["progress"] = _job_progress[job_id]
+    if job["status"] == "succeeded":
+        response["result"] = job["result"]
+    if job["status"] == "failed":
+        response["error"] = job["error"]
+    return response
+
 
 if __name__ == "__main__":
     import uvicorn
@@ -2,56 +2,871 @@
 # Splits multi-page PDFs and processes them page-by-page to avoid API limits
 
 import io
+import os
+import re
 import base64
-from typing import List, Tuple
+import ctypes
+import multiprocessing
+import threading
+import time
+import hashlib
+import hmac
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Optional, Tuple, Union
 import pdfplumber
+import pypdfium2 as pdfium
+import pypdfium2.raw as pdfium_c
+from PIL import Image, ImageChops, ImageStat, features
 
-def split_pdf_to_images(pdf_bytes: bytes, max_size_mb: float = 3.5, password: str = None) -> List[Tuple[str, int]]:
+
+# Process-pool rendering. Rasterization is CPU-bound and holds the GIL, so
+# spreading pages across processes keeps request handling responsive.
+# 1 = render serially in the calling thread (default, lowest memory).
+PDF_RENDER_WORKERS = int(os.getenv("PDF_RENDER_WORKERS", "1"))
+# Pages sent to a worker per task; the PDF is parsed once per batch
+PDF_RENDER_BATCH_SIZE = int(os.getenv("PDF_RENDER_BATCH_SIZE", "4"))
+
+# Per-page routing (triage): a page with a text layer is sent as text unless
+# images cover at least PAGE_SCAN_IMAGE_COVERAGE of it (a scan); a scan is still
+# sent as text when its (OCR) text layer has at least PAGE_TEXT_MIN_CHARS characters
+PAGE_TEXT_MIN_CHARS = int(os.getenv("PAGE_TEXT_MIN_CHARS", "50"))
+PAGE_SCAN_IMAGE_COVERAGE = float(os.getenv("PAGE_SCAN_IMAGE_COVERAGE", "0.3"))
+
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+
+def _get_render_pool(workers: int) -> ProcessPoolExecutor:
+    """Create the shared render pool on first use"""
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            # spawn: forking a server process that already runs threads is unsafe
+            _render_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        return _render_pool
+
+
+class PdfPasswordError(Exception):
+    """The PDF is encrypted and the password is missing or wrong"""
+
+
+def _is_password_error(e: Exception) -> bool:
+    # pdfminer raises PDFPasswordIncorrect, pdfium raises PdfiumError("... password ...")
+    error_str = (str(e) + " " + repr(e)).lower()
+    return "password" in error_str or "encrypted" in error_str or "decryption" in error_str
+
+
+# A PDF given as bytes or as a path to the file
+PdfSource = Union[bytes, str]
+
+
+def _plumber_input(source: PdfSource):
+    return source if isinstance(source, str) else io.BytesIO(source)
+
+
+def _read_source(source: PdfSource) -> bytes:
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            return f.read()
+    return source
+
+
+def _hash_source(source: PdfSource) -> str:
+    if isinstance(source, str):
+        digest = hashlib.sha256()
+        with open(source, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+    return hashlib.sha256(source).hexdigest()
+
+
+class PdfSession:
     """
-    Split PDF into individual page images.
+    A PDF opened and decrypted once, shared by every stage of a request.
+
+    Engines are opened lazily and at most once each: pypdfium2 for page count,
+    rendering and the decrypted copy; pdfplumber only when page text is needed.
+    Page text is cached per page. Use from one thread at a time; page operations
+    and close() are serialized by a lock, so closing a session (e.g. when a
+    request is cancelled) waits for a page still being read in a worker thread.
+
+    Raises PdfPasswordError (from whichever engine is opened first) when the
+    document is encrypted and the password is missing or wrong.
+    """
+
+    def __init__(self, pdf: PdfSource, password: Optional[str] = None, file_hash: Optional[str] = None):
+        # Bytes, or a file path: each engine then reads the file from disk itself
+        # and the document is never copied into Python memory
+        self.source = pdf
+        self.password = password or None
+        # When set, a decrypted copy is shared through decrypted_pdf_cache
+        self.file_hash = file_hash
+        self._pdfium = None
+        self._plumber = None
+        self._page_texts = {}
+        self._compact_texts = {}
+        self._page_tables = {}
+        self._triage = None
+        self._decrypted = None
+        self._lock = threading.RLock()
+        self._closed = False
+
+    def __enter__(self) -> "PdfSession":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            if self._plumber is not None:
+                self._plumber.close()
+                self._plumber = None
+            if self._pdfium is not None:
+                self._pdfium.close()
+                self._pdfium = None
+
+    @property
+    def pdfium(self) -> pdfium.PdfDocument:
+        if self._closed:
+            raise ValueError("PdfSession is closed")
+        if self._pdfium is None:
+            try:
+                self._pdfium = pdfium.PdfDocument(self.source, password=self.password)
+            except Exception as e:
+                if getattr(e, "err_code", None) == pdfium_c.FPDF_ERR_PASSWORD or _is_password_error(e):
+                    raise PdfPasswordError(str(e)) from e
+                raise
+        return self._pdfium
+
+    @property
+    def plumber(self) -> pdfplumber.PDF:
+        if self._closed:
+            raise ValueError("PdfSession is closed")
+        if self._plumber is None:
+            try:
+                self._plumber = pdfplumber.open(_plumber_input(self.source), password=self.password or "")
+            except Exception as e:
+                if _is_password_error(e):
+                    raise PdfPasswordError(str(e)) from e
+                raise
+        return self._plumber
+
+    @property
+    def page_count(self) -> int:
+        if self._plumber is not None:
+            return len(self._plumber.pages)
+        return len(self.pdfium)
+
+    def page_text(self, page_num: int, compact: bool = False) -> str:
+        """
+        Text layer of a 1-based page ('' when the page has none).
+        With compact=True, ruled tables are rendered as TSV (see compact_layout_text).
+        """
+        with self._lock:
+            texts = self._compact_texts if compact else self._page_texts
+            if page_num not in texts:
+                page = self.plumber.pages[page_num - 1]
+                try:
+                    if page_num not in self._page_texts:
+                        self._page_texts[page_num] = page.extract_text() or ""
+                    if compact:
+                        # Pages without a usable table keep their plain text
+                        plain = self._page_texts[page_num]
+                        tables, compact_text = [], None
+                        if plain:
+                            try:
+                                tables = extract_page_tables(page)
+                                if tables:
+                                    compact_text = compact_layout_text(page, tables)
+                            except Exception as e:
+                                tables = []
+                                print(f"⚠️ Table layout failed on page {page_num}, using plain text: {e}")
+                        self._page_tables[page_num] = [rows for _, rows in tables]
+                        self._compact_texts[page_num] = compact_text or plain
+                finally:
+                    # Drop parsed layout objects cached on the page
+                    page.close()
+            return texts[page_num]
+
+    def page_tables(self, page_num: int) -> List[List[List[str]]]:
+        """Ruled tables of a 1-based page as cleaned rows (see clean_table), top to bottom"""
+        with self._lock:
+            if page_num not in self._page_tables:
+                self.page_text(page_num, compact=True)
+            return self._page_tables[page_num]
+
+    def triage(self) -> dict:
+        """
+        Structural triage of the document (see triage_pdf), computed once.
+
+        Raises:
+            PdfPasswordError: The password is missing or wrong
+        """
+        with self._lock:
+            if self._triage is None:
+                started = time.perf_counter()
+                self._triage = _triage_document(self.pdfium, _source_size(self.source), started)
+            return self._triage
+
+    def page_route(self, page_num: int) -> dict:
+        """
+        How a 1-based page should be sent to the model (from the triage).
+
+        Returns:
+            {"page", "mode", "chars", "hasText", "imageCoverage"} where mode is "text" (usable
+            text layer), "image" (scanned: rasterize it) or "blank" (nothing to send)
+        """
+        return self.triage()["pages"][page_num - 1]
+
+    def page_routes(self) -> List[dict]:
+        """page_route of every page, in order"""
+        return self.triage()["pages"]
+
+    def text(self, compact: bool = False, pages: Optional[List[int]] = None) -> str:
+        """Text of all pages (or the given 1-based pages), one newline after each page that has text"""
+        parts = []
+        for page_num in pages if pages is not None else range(1, self.page_count + 1):
+            page_text = self.page_text(page_num, compact)
+            if page_text:
+                parts.append(page_text + "\n")
+        return "".join(parts)
+
+    def text_chunks(self, max_chars: int, overlap_lines: int = 0, compact: bool = False, pages: Optional[List[int]] = None) -> List[dict]:
+        """
+        Split the text layer into chunks of at most ~max_chars on page boundaries.
+
+        A page longer than max_chars is split on line boundaries. Each chunk after
+        the first is prefixed with the last overlap_lines lines of the previous
+        chunk so rows broken across a boundary are seen whole at least once.
+
+        pages restricts the chunks to those 1-based pages (default: all).
+
+        Returns:
+            List of {"index", "first_page", "last_page", "text"}; empty if no text
+        """
+        pieces = []  # (page_num, text) units no larger than max_chars
+        for page_num in pages if pages is not None else range(1, self.page_count + 1):
+            page_text = self.page_text(page_num, compact)
+            if not page_text:
+                continue
+            for piece in split_text(page_text + "\n", max_chars):
+                pieces.append((page_num, piece))
+
+        chunks = []
+        current_pages, current_text = [], ""
+        for page_num, piece in pieces:
+            if current_text and len(current_text) + len(piece) > max_chars:
+                chunks.append((current_pages, current_text))
+                current_pages, current_text = [], ""
+            current_pages.append(page_num)
+            current_text += piece
+        if current_text:
+            chunks.append((current_pages, current_text))
+
+        result = []
+        previous_tail = ""
+        for index, (pages, text) in enumerate(chunks):
+            result.append({
+                "index": index,
+                "first_page": pages[0],
+                "last_page": pages[-1],
+                "text": previous_tail + text
+            })
+            if overlap_lines:
+                previous_tail = "".join(text.splitlines(keepends=True)[-overlap_lines:])
+        return result
+
+    def page_image(self, page_num: int, resolution: int = 150) -> Image.Image:
+        """Render a 1-based page to an RGB PIL image"""
+        with self._lock:
+            page = self.pdfium[page_num - 1]
+            try:
+                return page.render(
+                    scale=resolution / 72,
+                    no_smoothtext=True,
+                    no_smoothpath=True,
+                    no_smoothimage=True,
+                    prefer_bgrx=True
+                ).to_pil().convert("RGB")
+            finally:
+                page.close()
+
+    def iter_page_images(
+        self,
+        max_size_mb: float = 3.5,
+        workers: Optional[int] = None,
+        batch_size: Optional[int] = None,
+        pages: Optional[List[int]] = None
+    ) -> Iterator[Tuple[str, int, dict]]:
+        """Same as iter_pdf_page_images, reusing this session's open document; pages limits the 1-based pages rendered"""
+        workers = workers or PDF_RENDER_WORKERS
+        batch_size = max(1, batch_size or PDF_RENDER_BATCH_SIZE)
+        page_numbers = list(pages) if pages is not None else list(range(1, self.page_count + 1))
+
+        if workers > 1 and len(page_numbers) > batch_size:
+            yield from _iter_pages_parallel(self.source, page_numbers, max_size_mb, self.password, workers, batch_size)
+            return
+
+        for page_num in page_numbers:
+            img_base64, encoding = _encode_page_base64(self.page_image(page_num), max_size_mb)
+            yield img_base64, page_num, encoding
+
+    def decrypted_bytes(self) -> bytes:
+        """Unencrypted copy of the document (the original bytes if it was never encrypted)"""
+        with self._lock:
+            return self._decrypted_bytes()
+
+    def _decrypted_bytes(self) -> bytes:
+        if self._decrypted is None:
+            if not self.password:
+                # Opening succeeds without a password only for unencrypted PDFs
+                # (or those with an empty user password, which viewers open anyway)
+                self.pdfium
+                self._decrypted = _read_source(self.source)
+            else:
+                output_stream = io.BytesIO()
+                self.pdfium.save(output_stream, flags=pdfium_c.FPDF_REMOVE_SECURITY)
+                self._decrypted = output_stream.getvalue()
+                if self.file_hash:
+                    decrypted_pdf_cache.put(self.file_hash, self.password, self._decrypted)
+        return self._decrypted
+
+
+def split_text(text: str, max_chars: int) -> List[str]:
+    """
+    Split text into pieces of at most ~max_chars, only on line boundaries.
+    A single line longer than max_chars becomes its own piece.
+    """
+    pieces = []
+    current = ""
+    for line in text.splitlines(keepends=True):
+        if current and len(current) + len(line) > max_chars:
+            pieces.append(current)
+            current = ""
+        current += line
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+# ============================================================
+# COMPACT TABLE LAYOUT
+# ============================================================
+# extract_text() flattens table rows into space-separated text and drops empty
+# cells. Bank statements are almost entirely tables, so rendering each ruled table
+# as TSV (one header row, one line per row) cuts the prompt size and keeps columns
+# unambiguous. The same cleaned rows feed the local statement parsers.
+
+# "1,23,456.78", "-500.00", "2,000.00 Cr"
+_AMOUNT_CELL = re.compile(r"^-?\d{1,3}(,\d{2,3})+(\.\d+)?( ?(Cr|Dr|CR|DR))?$")
+
+
+def _clean_cell(cell) -> str:
+    # Multi-line cells (wrapped narrations) become one line; tabs would split the cell
+    text = " ".join(str(cell or "").split())
+    if _AMOUNT_CELL.match(text):
+        # Grouping commas cost tokens and every prompt asks for plain numbers anyway
+        text = text.replace(",", "")
+    return text
+
+
+def clean_table(rows: List[List[Optional[str]]]) -> Optional[List[List[str]]]:
+    """
+    Normalize extracted table rows to single-line string cells.
+
+    Empty rows and empty columns are dropped, as is a column whose values repeat
+    an earlier column in every row below the header (e.g. "Value Dt" = "Date").
+
+    Returns:
+        Rows of equal width, or None if fewer than 2 rows or 2 columns remain (not a real table)
+    """
+    rows = [[_clean_cell(cell) for cell in row] for row in rows]
+    rows = [row for row in rows if any(row)]
+    if len(rows) < 2:
+        return None
+
+    width = max(len(row) for row in rows)
+    rows = [row + [""] * (width - len(row)) for row in rows]
+    columns = []
+    for i in range(width):
+        values = [row[i] for row in rows[1:]]
+        if not any(values) and not rows[0][i]:
+            continue
+        if any(values) and any(values == [row[j] for row in rows[1:]] for j in columns):
+            continue
+        columns.append(i)
+    if len(columns) < 2:
+        return None
+    return [[row[i] for i in columns] for row in rows]
+
+
+def extract_page_tables(page) -> List[Tuple[tuple, List[List[str]]]]:
+    """Ruled tables of a pdfplumber page as (bbox, cleaned rows), top to bottom"""
+    tables = []
+    for table in page.find_tables():
+        rows = clean_table(table.extract())
+        if rows:
+            tables.append((table.bbox, rows))
+    return tables
+
+
+def compact_layout_text(page, tables: List[Tuple[tuple, List[List[str]]]]) -> str:
+    """
+    Text of a pdfplumber page with its tables (from extract_page_tables) as TSV.
+
+    Text outside the tables (headers, account details, footers) is kept as lines,
+    and tables are placed where they appear on the page.
+    """
+    outside = page
+    for bbox, _ in tables:
+        outside = outside.outside_bbox(bbox)
+
+    blocks = [(line["top"], line["text"]) for line in outside.extract_text_lines()]
+    blocks += [(bbox[1], "\n".join("\t".join(row) for row in rows)) for bbox, rows in tables]
+    blocks.sort(key=lambda block: block[0])
+    return "\n".join(text for _, text in blocks)
+
+
+# ============================================================
+# TRIAGE
+# ============================================================
+# Encryption, page count and per-page content from pdfium's object model:
+# only the trailer, xref, page tree and page content streams are read (no
+# text layout, no rendering), so it takes milliseconds even for long files.
+def _source_size(source: PdfSource) -> int:
+    return os.path.getsize(source) if isinstance(source, str) else len(source)
+
+
+def _object_content(obj, page_width: float, page_height: float, depth: int = 0) -> Tuple[bool, float, bool]:
+    """(has text, image area clipped to the page, has vector paths) of a page object"""
+    kind = pdfium_c.FPDFPageObj_GetType(obj)
+    if kind == pdfium_c.FPDF_PAGEOBJ_TEXT:
+        return True, 0.0, False
+    if kind == pdfium_c.FPDF_PAGEOBJ_PATH:
+        return False, 0.0, True
+    if kind == pdfium_c.FPDF_PAGEOBJ_FORM and depth < 4:
+        has_text, has_image, has_paths = False, False, False
+        for index in range(pdfium_c.FPDFFormObj_CountObjects(obj)):
+            text, image_area, paths = _object_content(pdfium_c.FPDFFormObj_GetObject(obj, index), page_width, page_height, depth + 1)
+            has_text, has_image, has_paths = has_text or text, has_image or image_area > 0, has_paths or paths
+        # Children of a form are in the form's space; its own bounds are on the page
+        return has_text, _object_area(obj, page_width, page_height) if has_image else 0.0, has_paths
+    if kind == pdfium_c.FPDF_PAGEOBJ_IMAGE:
+        return False, _object_area(obj, page_width, page_height), False
+    return False, 0.0, False
+
+
+def _object_area(obj, page_width: float, page_height: float) -> float:
+    left, bottom, right, top = (ctypes.c_float() for _ in range(4))
+    if not pdfium_c.FPDFPageObj_GetBounds(obj, left, bottom, right, top):
+        return 0.0
+    # Clip to the page: scans are often placed slightly larger than it
+    width = min(right.value, page_width) - max(left.value, 0.0)
+    height = min(top.value, page_height) - max(bottom.value, 0.0)
+    return width * height if width > 0 and height > 0 else 0.0
+
+
+def _text_layer_chars(page) -> int:
+    """Non-whitespace characters in a loaded page's text layer (one FPDFText_GetText call)"""
+    text_page = pdfium_c.FPDFText_LoadPage(page)
+    try:
+        count = pdfium_c.FPDFText_CountChars(text_page)
+        if count <= 0:
+            return 0
+        buffer = ctypes.create_string_buffer((count + 1) * 2)
+        pdfium_c.FPDFText_GetText(text_page, 0, count, ctypes.cast(buffer, ctypes.POINTER(ctypes.c_ushort)))
+        text = buffer.raw[:count * 2].decode("utf-16-le", errors="ignore")
+        return len(text) - sum(map(str.isspace, text))
+    finally:
+        pdfium_c.FPDFText_ClosePage(text_page)
+
+
+def _triage_page(doc: pdfium.PdfDocument, page_num: int) -> dict:
+    page = pdfium_c.FPDF_LoadPage(doc.raw, page_num - 1)
+    if not page:
+        raise ValueError(f"Could not load page {page_num}")
+    try:
+        width, height = pdfium_c.FPDF_GetPageWidthF(page), pdfium_c.FPDF_GetPageHeightF(page)
+        has_text, image_area, has_paths = False, 0.0, False
+        for index in range(pdfium_c.FPDFPage_CountObjects(page)):
+            text, area, paths = _object_content(pdfium_c.FPDFPage_GetObject(page, index), width, height)
+            has_text, image_area, has_paths = has_text or text, image_area + area, has_paths or paths
+        coverage = round(min(image_area / ((width * height) or 1.0), 1.0), 2)
+        chars = _text_layer_chars(page) if has_text else 0
+
+        if has_text and coverage < PAGE_SCAN_IMAGE_COVERAGE:
+            mode = "text"
+        elif has_text:
+            # A scan with a text layer: OCR'd scans carry enough text to use it
+            mode = "text" if chars >= PAGE_TEXT_MIN_CHARS else "image"
+        elif coverage > 0 or has_paths:
+            # Scanned, or vector drawings only (e.g. text converted to outlines)
+            mode = "image"
+        else:
+            mode = "blank"
+        return {"page": page_num, "mode": mode, "chars": chars, "hasText": has_text, "imageCoverage": coverage}
+    finally:
+        pdfium_c.FPDF_ClosePage(page)
+
+
+def _triage_document(doc: pdfium.PdfDocument, size: int, started: float) -> dict:
+    pages = [_triage_page(doc, page_num) for page_num in range(1, len(doc) + 1)]
+    counts = {mode: sum(1 for p in pages if p["mode"] == mode) for mode in ("text", "image", "blank")}
+    if counts["text"] and counts["image"]:
+        kind = "mixed"
+    elif counts["text"]:
+        kind = "digital"
+    elif counts["image"]:
+        kind = "scanned"
+    else:
+        kind = "empty"
+    return {
+        "encrypted": pdfium_c.FPDF_GetSecurityHandlerRevision(doc.raw) != -1,
+        "locked": False,
+        "size": size,
+        "pageCount": len(pages),
+        "kind": kind,
+        "textPages": counts["text"],
+        "imagePages": counts["image"],
+        "blankPages": counts["blank"],
+        "pages": pages,
+        "ms": round((time.perf_counter() - started) * 1000, 1)
+    }
+
+
+def triage_pdf(pdf: PdfSource, password: Optional[str] = None) -> dict:
+    """
+    Inspect a PDF without extracting text or rendering anything.
+
+    Args:
+        pdf: PDF bytes or file path
+        password: Password, if the caller has one
+
+    Returns:
+        {"encrypted", "locked", "size", "pageCount", "kind", "textPages",
+        "imagePages", "blankPages", "pages", "ms"}. locked means the password is
+        missing or wrong; only encrypted and size are known then. kind is
+        "digital", "scanned", "mixed" or "empty"; pages holds a
+        {"page", "mode", "chars", "hasText", "imageCoverage"} route per page
+        (chars: non-whitespace characters in the page's text layer).
+
+    Raises:
+        pdfium.PdfiumError: The file is not a readable PDF
+    """
+    started = time.perf_counter()
+    size = _source_size(pdf)
+    try:
+        doc = pdfium.PdfDocument(pdf, password=password or None)
+    except pdfium.PdfiumError as e:
+        if getattr(e, "err_code", None) != pdfium_c.FPDF_ERR_PASSWORD:
+            raise
+        return {
+            "encrypted": True,
+            "locked": True,
+            "size": size,
+            "pageCount": None,
+            "kind": None,
+            "textPages": None,
+            "imagePages": None,
+            "blankPages": None,
+            "pages": [],
+            "ms": round((time.perf_counter() - started) * 1000, 1)
+        }
+    try:
+        return _triage_document(doc, size, started)
+    finally:
+        doc.close()
+
+
+# ============================================================
+# DECRYPTED PDF CACHE
+# ============================================================
+# The frontend unlocks a PDF for preview and then uploads the same file with the
+# same password for processing. Keeping the decrypted copy briefly lets the
+# second request skip decryption entirely.
+DECRYPTED_PDF_CACHE_TTL_SECONDS = int(os.getenv("DECRYPTED_PDF_CACHE_TTL_SECONDS", "300"))
+DECRYPTED_PDF_CACHE_MAX_MB = float(os.getenv("DECRYPTED_PDF_CACHE_MAX_MB", "64"))
+
+
+class DecryptedPdfCache:
+    """
+    Short-lived, byte-bounded LRU of decrypted PDFs.
+
+    Keyed by the encrypted file's SHA-256 plus an HMAC of the password under a
+    random per-process salt: plaintext passwords are never stored, keys are
+    useless outside this process, and a wrong password simply misses.
+    """
+
+    def __init__(self, max_bytes: int, ttl_seconds: int):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._salt = os.urandom(32)
+        self._entries: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, file_hash: str, password: str) -> str:
+        password_digest = hmac.new(self._salt, password.encode("utf-8"), hashlib.sha256).hexdigest()
+        return f"{file_hash}:{password_digest}"
+
+    def get(self, file_hash: str, password: str) -> Optional[bytes]:
+        key = self._key(file_hash, password)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[0] <= self.ttl_seconds:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def put(self, file_hash: str, password: str, decrypted: bytes):
+        if len(decrypted) > self.max_bytes:
+            return
+        key = self._key(file_hash, password)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.time(), decrypted)
+            self._bytes += len(decrypted)
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str):
+        _, decrypted = self._entries.pop(key)
+        self._bytes -= len(decrypted)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "hits": self.hits, "misses": self.misses}
+
+
+decrypted_pdf_cache = DecryptedPdfCache(
+    max_bytes=int(DECRYPTED_PDF_CACHE_MAX_MB * 1024 * 1024),
+    ttl_seconds=DECRYPTED_PDF_CACHE_TTL_SECONDS
+)
+
+
+def open_pdf_session(pdf: PdfSource, password: Optional[str] = None, file_hash: Optional[str] = None) -> PdfSession:
+    """
+    Open a PdfSession, reusing a recently decrypted copy of the same file when
+    the same password was used (e.g. by /ai/unlock-pdf moments earlier).
+    """
+    if not password:
+        return PdfSession(pdf)
+
+    file_hash = file_hash or _hash_source(pdf)
+    decrypted = decrypted_pdf_cache.get(file_hash, password)
+    if decrypted is not None:
+        session = PdfSession(decrypted)
+        session._decrypted = decrypted
+        return session
+    return PdfSession(pdf, password=password, file_hash=file_hash)
+
+
+def iter_pdf_page_images(
+    pdf_bytes: PdfSource,
+    max_size_mb: float = 3.5,
+    password: str = None,
+    workers: Optional[int] = None,
+    batch_size: Optional[int] = None
+) -> Iterator[Tuple[str, int, dict]]:
+    """
+    Lazily render PDF pages to images, in page order.
+
+    Serial mode holds only the page currently being rendered: the PIL image
+    and encode buffers are released before the next page is rendered, so peak
+    memory is bounded by a single page, not the document.
+    With workers > 1, batches of pages are rendered in a process pool and at
+    most `workers` batches are in flight at once.
     
     Args:
-        pdf_bytes: PDF file as bytes
+        pdf_bytes: PDF file as bytes, or a path to it
         max_size_mb: Maximum size per image in MB (default 3.5MB to stay under 4MB base64 limit)
         password: Optional password for the PDF file
+        workers: Render processes to use (default PDF_RENDER_WORKERS)
+        batch_size: Pages per worker task (default PDF_RENDER_BATCH_SIZE)
     
+    Yields:
+        Tuples of (base64_image_string, page_number, encoding) where encoding
+        describes the chosen format / mime_type / colour / scale (see encode_page_image)
+    """
+    with PdfSession(pdf_bytes, password=password) as session:
+        yield from session.iter_page_images(max_size_mb=max_size_mb, workers=workers, batch_size=batch_size)
+
+
+def _iter_pages_parallel(
+    pdf: PdfSource,
+    page_numbers: List[int],
+    max_size_mb: float,
+    password: Optional[str],
+    workers: int,
+    batch_size: int
+) -> Iterator[Tuple[str, int, dict]]:
+    """
+    Render page batches in the process pool and yield them back in page order.
+    A path source is sent to workers as-is, so each opens the file itself
+    instead of receiving a pickled copy of the document per batch.
+    """
+    pool = _get_render_pool(workers)
+    batches = [page_numbers[start:start + batch_size] for start in range(0, len(page_numbers), batch_size)]
+
+    pending = deque()
+    next_batch = 0
+    try:
+        while next_batch < len(batches) or pending:
+            # Keep every worker busy, but never queue the whole document
+            while next_batch < len(batches) and len(pending) < workers:
+                pending.append(pool.submit(_render_page_batch, pdf, password, batches[next_batch], max_size_mb))
+                next_batch += 1
+
+            # Futures are consumed in submission order, so pages stay ordered
+            for page in pending.popleft().result():
+                yield page
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def _render_page_batch(pdf: PdfSource, password: Optional[str], page_numbers: List[int], max_size_mb: float) -> List[Tuple[str, int, dict]]:
+    """Process-pool task: open the PDF once and render the given 1-based pages"""
+    rendered = []
+    with PdfSession(pdf, password=password) as session:
+        for page_num in page_numbers:
+            img_base64, encoding = _encode_page_base64(session.page_image(page_num), max_size_mb)
+            rendered.append((img_base64, page_num, encoding))
+    return rendered
+
+
+def _encode_page_base64(img: Image.Image, max_size_mb: float) -> Tuple[str, dict]:
+    """Encode a page rendered at 150 DPI to fit the byte budget"""
+    target_bytes = min(int(max_size_mb * 1024 * 1024), PAGE_IMAGE_TARGET_KB * 1024)
+    image_bytes, encoding = encode_page_image(img, target_bytes)
+    del img
+
+    # Convert to base64
+    return base64.b64encode(image_bytes).decode('utf-8'), encoding
+
+
+# ============================================================
+# SIZE-TARGETED PAGE ENCODER
+# ============================================================
+# Byte budget per page image. Smaller uploads are faster; the encoder picks the
+# cheapest colour mode, then format, then scale that fits.
+PAGE_IMAGE_TARGET_KB = int(os.getenv("PAGE_IMAGE_TARGET_KB", "1024"))
+# Never shrink a page below this fraction of the 150 DPI render
+PAGE_IMAGE_MIN_SCALE = 0.5
+
+_MIME_TYPES = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+
+def _classify_colour(img: Image.Image) -> str:
+    """Return 'bilevel', 'grayscale' or 'color' for a rendered page"""
+    thumb = img.convert("RGB")
+    thumb.thumbnail((256, 256))
+    r, g, b = thumb.split()
+    channel_spread = max(
+        ImageStat.Stat(ImageChops.difference(r, g)).mean[0],
+        ImageStat.Stat(ImageChops.difference(g, b)).mean[0],
+        ImageStat.Stat(ImageChops.difference(r, b)).mean[0]
+    )
+    if channel_spread > 4:
+        return "color"
+
+    # Text scans are almost entirely paper-white or ink-dark pixels
+    histogram = img.convert("L").histogram()
+    extremes = sum(histogram[:64]) + sum(histogram[192:])
+    if extremes / max(1, sum(histogram)) > 0.97:
+        return "bilevel"
+    return "grayscale"
+
+
+def _encoding_candidates(colour: str) -> List[Tuple[str, dict]]:
+    """Formats to try, best quality first"""
+    if colour == "bilevel":
+        return [("PNG", {"optimize": True})]
+
+    lossy = [("JPEG", {"quality": 85}), ("JPEG", {"quality": 70})]
+    if features.check("webp"):
+        lossy.insert(0, ("WEBP", {"quality": 80}))
+    if colour == "grayscale":
+        # Clean digital renders compress best losslessly
+        return [("PNG", {"optimize": True})] + lossy
+    return lossy
+
+
+def encode_page_image(img: Image.Image, target_bytes: int) -> Tuple[bytes, dict]:
+    """
+    Encode a rendered page to fit within target_bytes, without re-rendering.
+
+    Tries colour reduction first (bilevel / grayscale for text scans), then
+    format (lossless PNG, then WebP / JPEG), then downscaling in 25% steps.
+    If nothing fits, the smallest encoding at minimum scale is returned.
+
     Returns:
-        List of tuples: (base64_image_string, page_number)
+        (image_bytes, encoding) where encoding reports format, mime_type, colour
+        mode, scale, quality and size in bytes
     """
-    images = []
+    colour = _classify_colour(img)
+    base = img.convert("RGB" if colour == "color" else "L")
+    candidates = _encoding_candidates(colour)
+
+    scale = 1.0
+    smallest = None
+    while True:
+        if scale < 1.0:
+            size = (max(1, int(base.width * scale)), max(1, int(base.height * scale)))
+            scaled = base.resize(size, Image.LANCZOS)
+        else:
+            scaled = base
+        if colour == "bilevel":
+            scaled = scaled.point(lambda v: 255 if v > 160 else 0, mode="1")
+
+        for fmt, params in candidates:
+            buffered = io.BytesIO()
+            scaled.save(buffered, format=fmt, **params)
+            data = buffered.getvalue()
+            encoding = {
+                "format": fmt,
+                "mime_type": _MIME_TYPES[fmt],
+                "colour": colour,
+                "scale": round(scale, 3),
+                "quality": params.get("quality"),
+                "bytes": len(data)
+            }
+            if len(data) <= target_bytes:
+                return data, encoding
+            if smallest is None or len(data) < len(smallest[0]):
+                smallest = (data, encoding)
+
+        if scale * 0.75 < PAGE_IMAGE_MIN_SCALE:
+            return smallest
+        scale *= 0.75
+
+
+def split_pdf_to_images(pdf_bytes: bytes, max_size_mb: float = 3.5, password: str = None) -> List[Tuple[str, int, dict]]:
+    """
+    Split PDF into individual page images.
+    Prefer iter_pdf_page_images when pages can be consumed one at a time.
     
-    # Open PDF with pdfplumber
-    pdf_file = io.BytesIO(pdf_bytes)
+    Args:
+        pdf_bytes: PDF file as bytes
+        max_size_mb: Maximum size per image in MB (default 3.5MB to stay under 4MB base64 limit)
+        password: Optional password for the PDF file
     
-    with pdfplumber.open(pdf_file, password=password) as pdf:
-        total_pages = len(pdf.pages)
-        
-        for page_num, page in enumerate(pdf.pages, start=1):
-            # Convert page to image with pdfplumber's built-in method
-            # This returns a PIL Image, but we convert it immediately
-            img = page.to_image(resolution=150)  # 150 DPI for good quality
-            
-            # Save to bytes
-            buffered = io.BytesIO()
-            img.save(buffered, format="PNG")
-            
-            # Convert to base64
-            img_base64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
-            
-            # Check size
-            size_mb = len(buffered.getvalue()) / (1024 * 1024)
-            
-            # If too large, reduce resolution
-            if size_mb > max_size_mb:
-                # Try with lower resolution
-                img = page.to_image(resolution=100)
-                buffered = io.BytesIO()
-                img.save(buffered, format="PNG")
-                img_base64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
-            
-            images.append((img_base64, page_num))
-            
-    return images
+    Returns:
+        List of tuples: (base64_image_string, page_number, encoding)
+    """
+    return list(iter_pdf_page_images(pdf_bytes, max_size_mb=max_size_mb, password=password))
 
 
 def get_pdf_page_count(pdf_bytes: bytes, password: str = None) -> int:
@@ -66,9 +881,9 @@ def get_pdf_page_count(pdf_bytes: bytes, password: str = None) -> int:
         Number of pages
     """
     try:
-        pdf_file = io.BytesIO(pdf_bytes)
-        with pdfplumber.open(pdf_file, password=password) as pdf:
-            return len(pdf.pages)
+        with PdfSession(pdf_bytes, password=password) as session:
+            return session.page_count
+    except PdfPasswordError:
+        raise
     except Exception as e:
         raise Exception(f"Error reading PDF: {str(e)}")
-
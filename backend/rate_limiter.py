@@ -0,0 +1,343 @@
+# Gemini Rate Limiter
+# Admission control in front of every model call: a requests-per-minute and a
+# tokens-per-minute token bucket with a bounded FIFO wait queue. A burst above
+# the provider's per-minute limits waits a few seconds here instead of
+# failing with ResourceExhausted. With a database path the bucket levels live
+# in SQLite and are shared by every worker process. Each API key of the
+# credential pool (credential_pool.py) has its own limiter.
+
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+from google.api_core.exceptions import ResourceExhausted
+
+# Limits of one API key; defaults match gemini-2.5-flash on paid tier 1; 0 disables a bucket
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "1000"))
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", "1000000"))
+# Longest a call may wait for capacity, and most calls allowed to wait at once
+GEMINI_QUEUE_MAX_WAIT_SECONDS = float(os.getenv("GEMINI_QUEUE_MAX_WAIT_SECONDS", "30"))
+GEMINI_QUEUE_MAX_DEPTH = int(os.getenv("GEMINI_QUEUE_MAX_DEPTH", "256"))
+# Share the buckets between worker processes (unset: per process)
+GEMINI_RATE_LIMIT_DB = os.getenv("GEMINI_RATE_LIMIT_DB") or None
+
+# Bucket name -> (capacity per minute, amount to take)
+BucketRequest = Dict[str, Tuple[float, float]]
+
+
+class RateLimitExceeded(ResourceExhausted):
+    """
+    No capacity within the wait budget, or the wait queue is full.
+    A ResourceExhausted, so callers handle it like the provider's own 429.
+    """
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _current_level(entry: Optional[Tuple[float, float]], capacity: float, now: float) -> float:
+    """Level of a stored (level, updated) bucket after refilling; new buckets start full"""
+    if entry is None:
+        return capacity
+    level, updated = entry
+    return min(capacity, level + capacity * max(now - updated, 0.0) / 60.0)
+
+
+def _take(levels: Dict[str, float], request: BucketRequest) -> float:
+    """
+    Take from every bucket if all have enough (updating levels), else from none.
+
+    A request larger than a bucket's capacity is admitted once the bucket is
+    full and drives it negative, so it is delayed but never refused outright.
+
+    Returns:
+        0 when taken, else seconds until the slowest bucket has enough
+    """
+    wait = 0.0
+    for name, (capacity, amount) in request.items():
+        needed = min(amount, capacity)
+        if levels[name] < needed:
+            wait = max(wait, (needed - levels[name]) * 60.0 / capacity)
+    if wait:
+        return wait
+    for name, (_, amount) in request.items():
+        levels[name] -= amount
+    return 0.0
+
+
+class MemoryBuckets:
+    """Bucket levels of this process"""
+
+    shared = False
+
+    def __init__(self):
+        self._buckets: Dict[str, Tuple[float, float]] = {}  # name -> (level, updated)
+        self._lock = threading.Lock()
+
+    def take(self, request: BucketRequest) -> float:
+        now = time.monotonic()
+        with self._lock:
+            levels = {name: _current_level(self._buckets.get(name), capacity, now) for name, (capacity, _) in request.items()}
+            wait = _take(levels, request)
+            if not wait:
+                self._buckets.update((name, (level, now)) for name, level in levels.items())
+            return wait
+
+    def adjust(self, name: str, capacity: float, amount: float):
+        """Give back (positive) or take (negative) tokens after the fact"""
+        now = time.monotonic()
+        with self._lock:
+            level = _current_level(self._buckets.get(name), capacity, now)
+            self._buckets[name] = (min(capacity, level + amount), now)
+
+    def levels(self, capacities: Dict[str, float]) -> Dict[str, float]:
+        now = time.monotonic()
+        with self._lock:
+            return {name: round(_current_level(self._buckets.get(name), capacity, now), 1) for name, capacity in capacities.items()}
+
+
+class SqliteBuckets:
+    """
+    Bucket levels in SQLite, shared by every process using the same file.
+    Each operation runs in one IMMEDIATE transaction (as in TokenLedger).
+    """
+
+    shared = True
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._local = threading.local()
+        with self._transaction() as conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS rate_buckets (
+                    name TEXT PRIMARY KEY,
+                    level REAL NOT NULL,
+                    updated REAL NOT NULL
+                )"""
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=10000")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _read(self, conn: sqlite3.Connection, capacities: Dict[str, float], now: float) -> Dict[str, float]:
+        stored = {name: (level, updated) for name, level, updated in conn.execute("SELECT name, level, updated FROM rate_buckets")}
+        return {name: _current_level(stored.get(name), capacity, now) for name, capacity in capacities.items()}
+
+    def _write(self, conn: sqlite3.Connection, levels: Dict[str, float], now: float):
+        conn.executemany(
+            "INSERT OR REPLACE INTO rate_buckets (name, level, updated) VALUES (?, ?, ?)",
+            [(name, level, now) for name, level in levels.items()]
+        )
+
+    def take(self, request: BucketRequest) -> float:
+        # Wall clock: the timestamps are compared across processes
+        now = time.time()
+        with self._transaction() as conn:
+            levels = self._read(conn, {name: capacity for name, (capacity, _) in request.items()}, now)
+            wait = _take(levels, request)
+            if not wait:
+                self._write(conn, levels, now)
+            return wait
+
+    def adjust(self, name: str, capacity: float, amount: float):
+        now = time.time()
+        with self._transaction() as conn:
+            level = self._read(conn, {name: capacity}, now)[name]
+            self._write(conn, {name: min(capacity, level + amount)}, now)
+
+    def levels(self, capacities: Dict[str, float]) -> Dict[str, float]:
+        with self._transaction() as conn:
+            return {name: round(level, 1) for name, level in self._read(conn, capacities, time.time()).items()}
+
+
+class RateLimiter:
+    """
+    RPM/TPM admission for model calls.
+
+    acquire() waits (FIFO) until both buckets can cover the call: one request
+    and its estimated input tokens. Calls that would wait longer than max_wait,
+    or arrive while max_queue calls are already waiting, are refused with
+    RateLimitExceeded. reconcile() corrects the TPM bucket with the token count
+    the response reports. pause() holds every call back for a while (the
+    provider's own 429 on the last usable key), within the same wait budget.
+
+    Args:
+        rpm: Requests per minute (0 = unlimited)
+        tpm: Input tokens per minute (0 = unlimited)
+        max_wait: Longest wait for capacity, in seconds
+        max_queue: Most calls waiting at once
+        buckets: MemoryBuckets (default) or SqliteBuckets to share across workers
+        name: Prefix of the bucket names, so limiters can share one buckets store
+    """
+
+    def __init__(self, rpm: int, tpm: int, max_wait: float, max_queue: int, buckets=None, name: str = ""):
+        self.name = name
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.buckets = buckets or MemoryBuckets()
+        self._queue_lock = asyncio.Lock()
+        self._waiting = 0
+        self._paused_until = 0.0
+        self.admitted = 0
+        self.rejected = 0
+        self.delayed = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+        self.max_wait_seen = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.rpm or self.tpm)
+
+    def paused_for(self) -> float:
+        return max(self._paused_until - time.monotonic(), 0.0)
+
+    def pause(self, seconds: float):
+        """Admit no call for the next `seconds` (this process); calls wait instead of failing"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def _request(self, tokens: int) -> BucketRequest:
+        request = {}
+        if self.rpm:
+            request[self.name + "rpm"] = (float(self.rpm), 1.0)
+        if self.tpm:
+            request[self.name + "tpm"] = (float(self.tpm), float(tokens))
+        return request
+
+    def levels(self) -> Dict[str, float]:
+        """Current bucket levels by bucket name (blocking for SqliteBuckets)"""
+        return self.buckets.levels({name: capacity for name, (capacity, _) in self._request(0).items()})
+
+    def headroom(self, tokens: int, levels: Dict[str, float]) -> float:
+        """
+        Fraction of capacity left in the tightest bucket once the calls already
+        waiting and one more with ~tokens input tokens are admitted
+        (1.0 = unlimited, negative = the call would wait).
+
+        Args:
+            tokens: Estimated input tokens of the call
+            levels: Result of levels()
+        """
+        paused = self.paused_for()
+        if paused:
+            return -1.0 - paused
+        request = self._request(tokens)
+        if not request:
+            return 1.0
+        calls = self._waiting + 1
+        return min((levels[name] - amount * calls) / capacity for name, (capacity, amount) in request.items())
+
+    async def _try_take(self, request: BucketRequest) -> float:
+        if self.buckets.shared:
+            return await asyncio.to_thread(self.buckets.take, request)
+        return self.buckets.take(request)
+
+    async def acquire(self, tokens: int):
+        """
+        Wait for capacity for one call with ~tokens input tokens.
+
+        Raises:
+            RateLimitExceeded: Queue full, or no capacity (or pause) within max_wait
+        """
+        if not self.enabled and not self.paused_for():
+            return
+        if self._waiting >= self.max_queue:
+            self.rejected += 1
+            raise RateLimitExceeded(f"Gemini rate limit queue is full ({self._waiting} calls waiting)", retry_after=self.max_wait)
+
+        request = self._request(tokens)
+        started = time.monotonic()
+        deadline = started + self.max_wait
+        self._waiting += 1
+        self.max_depth = max(self.max_depth, self._waiting)
+        try:
+            # Bounds the time spent queued behind earlier calls as well
+            async with asyncio.timeout(self.max_wait):
+                # One waiter polls the buckets at a time, in arrival order
+                async with self._queue_lock:
+                    while True:
+                        wait = self.paused_for() or (await self._try_take(request) if request else 0.0)
+                        if not wait:
+                            break
+                        if time.monotonic() + wait > deadline:
+                            raise RateLimitExceeded(f"Gemini rate limit: no capacity within {self.max_wait:g}s", retry_after=wait)
+                        # Shared buckets may be drained by another worker meanwhile: re-check at least every second
+                        await asyncio.sleep(min(wait, 1.0) if self.buckets.shared else wait)
+        except TimeoutError:
+            self.rejected += 1
+            raise RateLimitExceeded(f"Gemini rate limit: no capacity within {self.max_wait:g}s", retry_after=self.max_wait)
+        except RateLimitExceeded:
+            self.rejected += 1
+            raise
+        finally:
+            self._waiting -= 1
+
+        waited = time.monotonic() - started
+        self.admitted += 1
+        if waited >= 0.01:
+            self.delayed += 1
+            self.total_wait += waited
+            self.max_wait_seen = max(self.max_wait_seen, waited)
+
+    async def reconcile(self, estimated_tokens: int, actual_tokens: Optional[int]):
+        """Give back (or take) the difference between the estimated and reported input tokens"""
+        if not self.tpm or actual_tokens is None or actual_tokens == estimated_tokens:
+            return
+        try:
+            args = (self.name + "tpm", float(self.tpm), float(estimated_tokens - actual_tokens))
+            if self.buckets.shared:
+                await asyncio.to_thread(self.buckets.adjust, *args)
+            else:
+                self.buckets.adjust(*args)
+        except Exception as e:
+            print(f"⚠️ Rate limiter reconcile failed: {e}")
+
+    def stats(self) -> dict:
+        try:
+            levels = {name[len(self.name):]: level for name, level in self.levels().items()}
+        except Exception as e:
+            levels = {"error": str(e)}
+        return {
+            "rpm": self.rpm,
+            "tpm": self.tpm,
+            "shared": self.buckets.shared,
+            "pausedForSeconds": round(self.paused_for(), 1),
+            "queueDepth": self._waiting,
+            "maxQueueDepth": self.max_depth,
+            "admitted": self.admitted,
+            "delayed": self.delayed,
+            "rejected": self.rejected,
+            "avgWaitSeconds": round(self.total_wait / self.delayed, 3) if self.delayed else 0.0,
+            "maxWaitSeconds": round(self.max_wait_seen, 3),
+            "levels": levels
+        }
+
+
+def make_buckets():
+    """Bucket store for the limiters: SQLite when GEMINI_RATE_LIMIT_DB is set, else per process"""
+    return SqliteBuckets(GEMINI_RATE_LIMIT_DB) if GEMINI_RATE_LIMIT_DB else MemoryBuckets()
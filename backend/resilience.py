@@ -0,0 +1,227 @@
+# Model Call Resilience
+# Retries with exponential backoff and full jitter for transient Gemini errors,
+# per-call deadlines, and a circuit breaker that fails fast while the
+# provider is erroring instead of letting every request wait out a timeout.
+
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import deque
+from typing import Awaitable, Callable, Optional, TypeVar
+
+from google.api_core.exceptions import Aborted, DeadlineExceeded, ServerError, ServiceUnavailable
+
+# Attempts per model call (1 = no retry)
+GEMINI_RETRY_ATTEMPTS = int(os.getenv("GEMINI_RETRY_ATTEMPTS", "3"))
+# Backoff before retry n is uniform in [0, min(MAX, BASE * 2**n)] seconds
+GEMINI_RETRY_BASE_SECONDS = float(os.getenv("GEMINI_RETRY_BASE_SECONDS", "0.5"))
+GEMINI_RETRY_MAX_SECONDS = float(os.getenv("GEMINI_RETRY_MAX_SECONDS", "8"))
+# Deadline of a single model call (for streams: until the first chunk)
+GEMINI_CALL_TIMEOUT_SECONDS = float(os.getenv("GEMINI_CALL_TIMEOUT_SECONDS", "120"))
+
+# The breaker opens when at least MIN_CALLS calls ended in the last WINDOW
+# seconds and FAILURE_RATE of them failed transiently; it lets a probe call
+# through after COOLDOWN seconds and closes again when the probe succeeds
+GEMINI_BREAKER_FAILURE_RATE = float(os.getenv("GEMINI_BREAKER_FAILURE_RATE", "0.5"))
+GEMINI_BREAKER_MIN_CALLS = int(os.getenv("GEMINI_BREAKER_MIN_CALLS", "10"))
+GEMINI_BREAKER_WINDOW_SECONDS = float(os.getenv("GEMINI_BREAKER_WINDOW_SECONDS", "60"))
+GEMINI_BREAKER_COOLDOWN_SECONDS = float(os.getenv("GEMINI_BREAKER_COOLDOWN_SECONDS", "30"))
+
+T = TypeVar("T")
+
+
+class CircuitOpenError(ServiceUnavailable):
+    """The breaker is open: the call was not attempted"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def is_retryable(e: BaseException) -> bool:
+    """
+    Transient failures worth another attempt: provider 5xx (including its
+    deadline), aborted calls, dropped connections and our own attempt deadline.
+    Quota errors (ResourceExhausted) are left to the rate limiter and 4xx to the caller.
+    """
+    if isinstance(e, CircuitOpenError):
+        return False
+    return isinstance(e, (ServerError, Aborted, ConnectionError, TimeoutError))
+
+
+class CircuitBreaker:
+    """
+    Closed / open / half-open breaker over a sliding window of call outcomes.
+
+    Only transient failures (is_retryable) count against the provider; client
+    errors and quota errors mean it is up. While open, before_call() raises
+    CircuitOpenError; after the cooldown one probe at a time is let through.
+    """
+
+    def __init__(self, failure_rate: float, min_calls: int, window: float, cooldown: float):
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.cooldown = cooldown
+        self.state = "closed"
+        self._outcomes = deque()  # (time, failed)
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+        self.opens = 0
+        self.rejected = 0
+
+    def _trim(self, now: float):
+        while self._outcomes and self._outcomes[0][0] < now - self.window:
+            self._outcomes.popleft()
+
+    def before_call(self):
+        """
+        Raises:
+            CircuitOpenError: The breaker is open (or a half-open probe is already running)
+        """
+        with self._lock:
+            if self.state == "closed":
+                return
+            now = time.monotonic()
+            if self.state == "open" and now - self._opened_at >= self.cooldown:
+                self.state = "half_open"
+            if self.state == "half_open" and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return
+            self.rejected += 1
+            retry_after = max(self.cooldown - (now - self._opened_at), 1.0)
+            raise CircuitOpenError(f"Gemini is failing; calls paused for {retry_after:.0f}s", retry_after)
+
+    def record(self, failed: bool):
+        """Outcome of a call let through by before_call()"""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == "half_open":
+                self._probe_in_flight = False
+                if failed:
+                    self._open(now)
+                else:
+                    self.state = "closed"
+                    self._outcomes.clear()
+                return
+
+            self._outcomes.append((now, failed))
+            self._trim(now)
+            failures = sum(1 for _, f in self._outcomes if f)
+            if (
+                self.state == "closed"
+                and len(self._outcomes) >= self.min_calls
+                and failures / len(self._outcomes) >= self.failure_rate
+            ):
+                self._open(now)
+
+    def abandon(self):
+        """A call let through by before_call() was cancelled: no verdict, free the probe slot"""
+        with self._lock:
+            if self.state == "half_open":
+                self._probe_in_flight = False
+
+    def _open(self, now: float):
+        self.state = "open"
+        self._opened_at = now
+        self.opens += 1
+        print(f"⚡ Gemini circuit breaker OPEN for {self.cooldown:g}s")
+
+    def stats(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            self._trim(now)
+            failures = sum(1 for _, f in self._outcomes if f)
+            return {
+                "state": self.state,
+                "windowCalls": len(self._outcomes),
+                "windowFailures": failures,
+                "failureRate": round(failures / len(self._outcomes), 3) if self._outcomes else 0.0,
+                "retryAfterSeconds": round(max(self.cooldown - (now - self._opened_at), 0.0), 1) if self.state == "open" else 0.0,
+                "opens": self.opens,
+                "rejected": self.rejected
+            }
+
+
+gemini_breaker = CircuitBreaker(
+    GEMINI_BREAKER_FAILURE_RATE,
+    GEMINI_BREAKER_MIN_CALLS,
+    GEMINI_BREAKER_WINDOW_SECONDS,
+    GEMINI_BREAKER_COOLDOWN_SECONDS
+)
+
+retry_stats = {"calls": 0, "retries": 0, "gave_up": 0}
+
+
+def backoff_seconds(retry: int) -> float:
+    """Full-jitter exponential backoff before the given retry (1-based)"""
+    return random.uniform(0, min(GEMINI_RETRY_MAX_SECONDS, GEMINI_RETRY_BASE_SECONDS * 2 ** retry))
+
+
+async def with_deadline(awaitable: Awaitable[T], timeout: Optional[float] = None) -> T:
+    """
+    Await a model call, giving up after timeout seconds (default GEMINI_CALL_TIMEOUT_SECONDS).
+
+    Raises:
+        DeadlineExceeded: The call took longer (the call is cancelled)
+    """
+    timeout = timeout or GEMINI_CALL_TIMEOUT_SECONDS
+    try:
+        async with asyncio.timeout(timeout):
+            return await awaitable
+    except TimeoutError:
+        raise DeadlineExceeded(f"Gemini call exceeded its {timeout:g}s deadline")
+
+
+async def call_with_retry(
+    attempt: Callable[[], Awaitable[T]],
+    breaker: Optional[CircuitBreaker] = gemini_breaker,
+    attempts: Optional[int] = None
+) -> T:
+    """
+    Run attempt() until it succeeds, fails permanently or runs out of attempts.
+
+    Each attempt is checked against the breaker first and its outcome recorded.
+    Only is_retryable errors are retried, after a jittered backoff; the last
+    error is raised as is.
+
+    Args:
+        attempt: Coroutine factory making one model call
+        breaker: Circuit breaker (None: no breaker)
+        attempts: Max attempts (default GEMINI_RETRY_ATTEMPTS)
+
+    Raises:
+        CircuitOpenError: The breaker is open (the call was not attempted)
+    """
+    attempts = max(1, attempts or GEMINI_RETRY_ATTEMPTS)
+    retry_stats["calls"] += 1
+
+    for number in range(1, attempts + 1):
+        if breaker is not None:
+            breaker.before_call()
+        try:
+            result = await attempt()
+        except asyncio.CancelledError:
+            if breaker is not None:
+                breaker.abandon()
+            raise
+        except Exception as e:
+            retryable = is_retryable(e)
+            if breaker is not None:
+                breaker.record(retryable)
+            if not retryable:
+                raise
+            if number == attempts:
+                retry_stats["gave_up"] += 1
+                raise
+            delay = backoff_seconds(number)
+            retry_stats["retries"] += 1
+            print(f"🔁 Gemini call failed ({type(e).__name__}: {e}); retry {number}/{attempts - 1} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+        else:
+            if breaker is not None:
+                breaker.record(False)
+            return result
@@ -0,0 +1,215 @@
+# Extraction Result Cache
+# Content-addressed cache of model extraction results, keyed on the uploaded file hash.
+# Memory tier is an LRU bounded by bytes; the optional disk tier survives restarts.
+# get() and set() block on the disk tier: async callers run them with asyncio.to_thread.
+
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+
+def make_version(model_name: str, *prompts: str) -> str:
+    """
+    Build a short version tag from the model name and prompt texts.
+    Any prompt edit or model change produces a new tag, so stale results are never served.
+    """
+    digest = hashlib.sha256(model_name.encode("utf-8"))
+    for prompt in prompts:
+        digest.update(b"\x00")
+        digest.update(prompt.encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+class ResultCache:
+    """
+    Two-tier cache of JSON-serializable extraction results.
+
+    Values are stored serialized, so every get() returns a fresh copy that callers
+    can mutate freely, and the memory budget is measured in real bytes.
+
+    get() and set() read and write the disk tier synchronously (and parse or
+    serialize the value); call them from a worker thread in async code.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = 64 * 1024 * 1024,
+        ttl_seconds: int = 24 * 3600,
+        disk_dir: Optional[str] = None,
+        max_disk_bytes: int = 512 * 1024 * 1024
+    ):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (created, payload)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._salt = os.urandom(32)
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._disk_bytes = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._disk_bytes = sum(e.stat().st_size for e in os.scandir(self.disk_dir) if e.name.endswith(".json"))
+
+    def make_key(self, file_hash: str, endpoint: str, version: str, password: Optional[str] = None) -> str:
+        """
+        Build the cache key for one extraction.
+        An HMAC of the password under a random per-process salt is folded into the
+        digest (the password is never stored), so an encrypted file's result is only
+        served to callers that know its password, and a key cannot be used to check
+        a guessed password. Such results are not found again after a restart.
+        """
+        password_digest = hmac.new(self._salt, password.encode("utf-8"), hashlib.sha256).hexdigest() if password else ""
+        material = "\x00".join([file_hash, endpoint, version, password_digest])
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Any]:
+        """Return a copy of the cached value, or None on miss/expiry"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                created, payload = entry
+                if now - created <= self.ttl_seconds:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return json.loads(payload)
+                self._remove(key)
+
+        if self.disk_dir:
+            payload = self._disk_get(key, now)
+            if payload is not None:
+                created, payload = payload
+                with self._lock:
+                    self._store(key, created, payload)
+                    self.hits += 1
+                    self.disk_hits += 1
+                return json.loads(payload)
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key: str, value: Any):
+        """Cache a JSON-serializable value in memory (and on disk if enabled)"""
+        payload = json.dumps(value, separators=(",", ":"))
+        created = time.time()
+        with self._lock:
+            self._store(key, created, payload)
+        if self.disk_dir:
+            self._disk_set(key, created, payload)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "disk_enabled": bool(self.disk_dir),
+                "disk_bytes": self._disk_bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0
+            }
+
+    # ---------------- memory tier (caller holds the lock) ----------------
+
+    def _store(self, key: str, created: float, payload: str):
+        size = len(payload)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (created, payload)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        _, payload = self._entries.pop(key)
+        self._bytes -= len(payload)
+
+    # ---------------- disk tier ----------------
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _disk_get(self, key: str, now: float) -> Optional[tuple]:
+        path = self._disk_path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                record = json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Result cache read error: {e}")
+            return None
+
+        if now - record["created"] > self.ttl_seconds:
+            self._disk_remove(path)
+            return None
+        return record["created"], record["payload"]
+
+    def _disk_set(self, key: str, created: float, payload: str):
+        path = self._disk_path(key)
+        tmp_path = f"{path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"created": created, "payload": payload}, f)
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp_path, path)
+            with self._lock:
+                self._disk_bytes += os.path.getsize(path) - old_size
+            if self._disk_bytes > self.max_disk_bytes:
+                self._disk_evict()
+        except Exception as e:
+            print(f"Result cache write error: {e}")
+
+    def _disk_remove(self, path: str):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            with self._lock:
+                self._disk_bytes -= size
+        except FileNotFoundError:
+            pass
+
+    def _disk_evict(self):
+        """Drop the least recently written files until the disk tier is under 90% of budget"""
+        files = sorted(
+            (e for e in os.scandir(self.disk_dir) if e.name.endswith(".json")),
+            key=lambda e: e.stat().st_mtime
+        )
+        target = int(self.max_disk_bytes * 0.9)
+        for entry in files:
+            if self._disk_bytes <= target:
+                break
+            self._disk_remove(entry.path)
+            with self._lock:
+                self.evictions += 1
+
+
+# Process-wide cache instance configured from the environment
+result_cache = ResultCache(
+    max_bytes=int(float(os.getenv("RESULT_CACHE_MAX_MB", "64")) * 1024 * 1024),
+    ttl_seconds=int(os.getenv("RESULT_CACHE_TTL_SECONDS", str(24 * 3600))),
+    disk_dir=os.getenv("RESULT_CACHE_DIR") or None,
+    max_disk_bytes=int(float(os.getenv("RESULT_CACHE_DISK_MAX_MB", "512")) * 1024 * 1024)
+)
@@ -0,0 +1,122 @@
+# Bank Statement Merging
+# Combines transactions extracted from consecutive chunks of one statement:
+# drops rows repeated across chunk boundaries and checks running-balance continuity.
+
+from typing import List, Optional, Tuple
+
+# Balances are compared to the paisa/cent
+BALANCE_TOLERANCE = 0.01
+
+
+def parse_amount(value) -> Optional[float]:
+    """Parse a model-returned amount (number, "1,234.50", "" or None)"""
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = str(value).replace(",", "").replace("₹", "").strip()
+    if not text:
+        return None
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+def transaction_key(txn: dict) -> tuple:
+    """
+    Identity of a transaction row for de-duplication.
+    Date, amounts and running balance identify a row; the description is only a
+    tie-breaker when no balance was extracted (descriptions vary between reads).
+    """
+    balance = parse_amount(txn.get("balance"))
+    key = (
+        str(txn.get("date") or "").strip(),
+        round(parse_amount(txn.get("withdrawal")) or 0.0, 2),
+        round(parse_amount(txn.get("deposit")) or 0.0, 2),
+        None if balance is None else round(balance, 2)
+    )
+    if balance is None:
+        key += (" ".join(str(txn.get("description") or "").lower().split()),)
+    return key
+
+
+def merge_chunk_transactions(chunk_transactions: List[List[dict]], overlap_window: int = 10) -> Tuple[List[dict], List[int], int]:
+    """
+    Merge per-chunk transaction lists, in chunk order.
+
+    Chunks overlap by a few lines, so the leading rows of a chunk may repeat the
+    trailing rows of the previous one. Leading rows that match one of the last
+    overlap_window merged rows are dropped; the first new row stops the scan.
+
+    Args:
+        chunk_transactions: Transactions of each chunk, in statement order
+        overlap_window: How many trailing merged rows a repeated row may match
+
+    Returns:
+        (merged transactions, index in merged where each chunk's rows start, duplicates removed)
+    """
+    merged: List[dict] = []
+    boundaries: List[int] = []
+    seen_ids = set()
+    duplicates = 0
+
+    for chunk_index, transactions in enumerate(chunk_transactions):
+        recent = {transaction_key(txn) for txn in merged[-overlap_window:]}
+        start = 0
+        while start < len(transactions) and transaction_key(transactions[start]) in recent:
+            start += 1
+        duplicates += start
+
+        boundaries.append(len(merged))
+        for txn in transactions[start:]:
+            txn_id = txn.get("id")
+            if txn_id in seen_ids:
+                txn["id"] = f"{txn_id}-{chunk_index}"
+            seen_ids.add(txn.get("id"))
+            merged.append(txn)
+
+    return merged, boundaries, duplicates
+
+
+def balance_continuity(prev: dict, cur: dict) -> str:
+    """
+    Check that cur's balance follows from prev's: "ok", "mismatch" or "unknown".
+    Statements listed newest-first are accepted too.
+    """
+    prev_balance = parse_amount(prev.get("balance"))
+    balance = parse_amount(cur.get("balance"))
+    if prev_balance is None or balance is None:
+        return "unknown"
+
+    # Oldest first: this row's movement applies to the previous balance
+    expected = prev_balance - (parse_amount(cur.get("withdrawal")) or 0.0) + (parse_amount(cur.get("deposit")) or 0.0)
+    if abs(expected - balance) <= BALANCE_TOLERANCE:
+        return "ok"
+
+    # Newest first: the previous row's movement applies to this balance
+    expected = balance - (parse_amount(prev.get("withdrawal")) or 0.0) + (parse_amount(prev.get("deposit")) or 0.0)
+    if abs(expected - prev_balance) <= BALANCE_TOLERANCE:
+        return "ok"
+    return "mismatch"
+
+
+def check_boundary_balances(transactions: List[dict], boundaries: List[int]) -> List[dict]:
+    """
+    Check running-balance continuity where each chunk's rows meet the previous chunk's.
+
+    Returns:
+        One {"index", "previousBalance", "balance", "status"} per boundary
+    """
+    checks = []
+    for index in boundaries:
+        if index <= 0 or index >= len(transactions):
+            continue
+        prev, cur = transactions[index - 1], transactions[index]
+        checks.append({
+            "index": index,
+            "previousBalance": parse_amount(prev.get("balance")),
+            "balance": parse_amount(cur.get("balance")),
+            "status": balance_continuity(prev, cur)
+        })
+    return checks
@@ -0,0 +1,64 @@
+# Test setup
+# The app reads its configuration at import time, so the environment is set
+# before main is imported: a fake Gemini key, a known backend key and
+# throwaway databases. Model calls go to FakeModel (fake_model fixture), which
+# is handed out by gemini_client.model_registry in place of the SDK model.
+#
+# Run from backend/: python -m pytest tests
+
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import types
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+_tmp = tempfile.mkdtemp(prefix="backend-tests-")
+os.environ["GEMINI_API_KEY"] = "test-gemini-key"
+os.environ["GEMINI_API_KEYS"] = ""
+os.environ["BACKEND_API_KEY"] = "test-key"
+os.environ["TOKEN_USAGE_DB"] = os.path.join(_tmp, "token_usage.db")
+os.environ["JOBS_DB"] = os.path.join(_tmp, "jobs.db")
+os.environ["JOBS_DIR"] = os.path.join(_tmp, "job_files")
+
+AUTH = {"Authorization": "Bearer test-key"}
+
+
+class FakeModel:
+    """
+    Stands in for genai.GenerativeModel: every call sleeps for delay seconds
+    (without blocking the event loop) and answers with response_json.
+    """
+
+    def __init__(self):
+        self.delay = 0.0
+        self.response_json = {"transactions": []}
+        self.in_flight = 0
+        self.calls = 0
+
+    async def generate_content_async(self, contents, **kwargs):
+        self.calls += 1
+        self.in_flight += 1
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.in_flight -= 1
+        return types.SimpleNamespace(
+            text=json.dumps(self.response_json),
+            usage_metadata=types.SimpleNamespace(total_token_count=10, prompt_token_count=5),
+            candidates=[]
+        )
+
+
+@pytest.fixture
+def fake_model(monkeypatch):
+    import gemini_client
+
+    model = FakeModel()
+    monkeypatch.setattr(gemini_client.model_registry, "get", lambda credential, spec: model)
+    return model
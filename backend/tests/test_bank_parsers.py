@@ -0,0 +1,86 @@
+# Local statement parsers: every registered layout parses a statement whose
+# balances add up, and hands anything else back to the model (statement None).
+
+import pytest
+
+from bank_parsers import BANK_LAYOUTS, parse_statement
+
+ROWS = [
+    # date, description, withdrawal, deposit, balance
+    ("01/04/2024", "Opening Balance", "", "", "10000.00"),
+    ("02/04/2024", "NEFT SALARY APRIL", "", "50000.00", "60000.00"),
+    ("03/04/2024", "ATM WDL MG ROAD", "2000.00", "", "58000.00"),
+    ("05/04/2024", "UPI-GROCERY STORE", "1,250.50", "", "56749.50"),
+]
+
+
+def _header_text(layout) -> str:
+    return f"{layout.name.upper()}\nStatement of account  Account No: XXXX1234\n"
+
+
+def _table(layout, rows=ROWS):
+    """A statement table using the first header alias of each of the layout's columns"""
+    fields = ("date", "description", "withdrawal", "deposit", "balance")
+    header = [layout.columns[field][0] for field in fields]
+    # Aliases are stored normalized; capitalize them the way a statement prints them
+    return [[cell.title() for cell in header]] + [list(row) for row in rows]
+
+
+@pytest.mark.parametrize("layout", BANK_LAYOUTS, ids=lambda layout: layout.name)
+def test_layout_parses_a_balanced_statement(layout):
+    statement, info = parse_statement(_header_text(layout), [_table(layout)])
+
+    assert info == {"bank": layout.name, "status": "parsed", "reason": None}
+    assert statement["bankName"] == layout.name
+    assert statement["accountNumberLast4"] == "1234"
+    # The opening balance row has no amount and is not a transaction
+    assert [t["date"] for t in statement["transactions"]] == ["2024-04-02", "2024-04-03", "2024-04-05"]
+    assert statement["transactions"][2]["withdrawal"] == 1250.50
+    assert statement["totalDeposits"] == 50000.0
+    assert statement["totalWithdrawals"] == 3250.50
+    assert [t["contraLedger"] for t in statement["transactions"]] == ["Salary", "Cash", "Suspense A/c"]
+
+
+@pytest.mark.parametrize("layout", BANK_LAYOUTS, ids=lambda layout: layout.name)
+def test_layout_falls_back_when_balances_do_not_add_up(layout):
+    rows = ROWS[:3] + [("05/04/2024", "UPI-GROCERY STORE", "1250.50", "", "50000.00")]
+
+    statement, info = parse_statement(_header_text(layout), [_table(layout, rows)])
+
+    assert statement is None
+    assert info["bank"] == layout.name
+    assert info["status"] == "balance_mismatch"
+    assert "transaction 3" in info["reason"]
+
+
+def test_table_without_repeated_header_continues_the_previous_page():
+    layout = BANK_LAYOUTS[0]
+    next_page = [["06/04/2024", "IMPS REFUND", "", "500.00", "57249.50"]]
+
+    statement, info = parse_statement(_header_text(layout), [_table(layout), next_page])
+
+    assert info["status"] == "parsed"
+    assert statement["transactions"][-1]["description"] == "IMPS REFUND"
+
+
+def test_wrapped_narration_joins_the_previous_transaction():
+    layout = BANK_LAYOUTS[0]
+    rows = ROWS[:2] + [("", "REF 998877", "", "", "")] + ROWS[2:]
+
+    statement, _ = parse_statement(_header_text(layout), [_table(layout, rows)])
+
+    assert statement["transactions"][0]["description"] == "NEFT SALARY APRIL REF 998877"
+
+
+def test_unknown_bank_and_unreadable_rows_fall_back():
+    layout = BANK_LAYOUTS[0]
+
+    statement, info = parse_statement("SOME OTHER BANK LTD", [_table(layout)])
+    assert statement is None and info["status"] == "unsupported_bank"
+
+    rows = ROWS[:2] + [("03/04/2024", "ATM WDL", "two thousand", "", "58000.00")]
+    statement, info = parse_statement(_header_text(layout), [_table(layout, rows)])
+    assert statement is None and info["status"] == "layout_mismatch"
+
+    statement, info = parse_statement(_header_text(layout), [[["Name", "Value"], ["a", "b"]]])
+    assert statement is None and info["status"] == "layout_mismatch"
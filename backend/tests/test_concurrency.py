@@ -0,0 +1,65 @@
+# Event loop responsiveness: model calls are awaited natively, so slow
+# extractions must not hold up other requests on the same worker.
+
+import asyncio
+import io
+import time
+
+import httpx
+from PIL import Image
+
+import main
+from conftest import AUTH
+
+EXTRACTIONS = 8
+MODEL_SECONDS = 1.0
+
+
+def _statement_image(seed: int) -> bytes:
+    # Distinct bytes per upload, so no request is served from the result cache
+    buf = io.BytesIO()
+    Image.new("RGB", (64, 64), (seed, 255 - seed, 128)).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def test_healthz_stays_fast_during_extractions(fake_model):
+    fake_model.delay = MODEL_SECONDS
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            extractions = [
+                asyncio.create_task(client.post(
+                    "/ai/process-bank-statement",
+                    files={"file": (f"s{i}.png", _statement_image(i), "image/png")},
+                    headers=AUTH
+                ))
+                for i in range(EXTRACTIONS)
+            ]
+            # All calls reach the model together only if none blocks the loop
+            deadline = time.perf_counter() + MODEL_SECONDS / 2
+            while fake_model.in_flight < EXTRACTIONS and time.perf_counter() < deadline:
+                await asyncio.sleep(0.01)
+            assert fake_model.in_flight == EXTRACTIONS
+
+            latencies = []
+            for _ in range(5):
+                started = time.perf_counter()
+                response = await client.get("/healthz")
+                latencies.append(time.perf_counter() - started)
+                assert response.status_code == 200
+            in_flight_after = fake_model.in_flight
+
+            started = time.perf_counter()
+            responses = await asyncio.gather(*extractions)
+            return latencies, in_flight_after, responses, time.perf_counter() - started
+
+    latencies, in_flight_after, responses, remaining = asyncio.run(scenario())
+
+    # /healthz answered while every extraction was still waiting on the model
+    assert in_flight_after == EXTRACTIONS
+    assert max(latencies) < 0.1
+    assert [r.status_code for r in responses] == [200] * EXTRACTIONS
+    # The extractions overlapped instead of running one after another
+    assert remaining < MODEL_SECONDS * 2
+    assert fake_model.calls == EXTRACTIONS
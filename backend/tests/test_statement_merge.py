@@ -0,0 +1,64 @@
+# Merging the transactions of overlapping statement parts: rows repeated at a
+# part's start are dropped once, and balance breaks at part boundaries are flagged.
+
+from statement_merge import balance_continuity, check_boundary_balances, merge_chunk_transactions
+
+
+def _txn(id_, date, withdrawal, deposit, balance, description="UPI"):
+    return {"id": id_, "date": date, "description": description, "withdrawal": withdrawal, "deposit": deposit, "balance": balance}
+
+
+PART_1 = [
+    _txn("txn-1", "2024-04-01", 0, 1000, 11000),
+    _txn("txn-2", "2024-04-02", 500, 0, 10500),
+    _txn("txn-3", "2024-04-03", 200, 0, 10300),
+]
+# Starts with the last two rows of part 1 (the chunk overlap), read slightly differently
+PART_2 = [
+    _txn("txn-1", "2024-04-02", "500.00", "", "10,500.00", description="UPI PAYMENT"),
+    _txn("txn-2", "2024-04-03", 200.0, None, 10300.0),
+    _txn("txn-3", "2024-04-04", 0, 700, 11000),
+    _txn("txn-4", "2024-04-05", 1000, 0, 10000),
+]
+
+
+def test_overlapping_rows_are_dropped_once():
+    merged, boundaries, duplicates = merge_chunk_transactions([PART_1, PART_2])
+
+    assert duplicates == 2
+    assert boundaries == [0, 3]
+    assert [t["date"] for t in merged] == ["2024-04-01", "2024-04-02", "2024-04-03", "2024-04-04", "2024-04-05"]
+    # Ids repeated across parts are made unique
+    assert len({t["id"] for t in merged}) == len(merged)
+    assert check_boundary_balances(merged, boundaries) == [
+        {"index": 3, "previousBalance": 10300.0, "balance": 11000.0, "status": "ok"}
+    ]
+
+
+def test_identical_rows_after_new_ones_are_kept():
+    # Two real, identical transactions in a row are not an overlap once a new row was seen
+    repeat = _txn("txn-9", "2024-04-06", 100, 0, 9900)
+    part_3 = [repeat, dict(repeat, balance=9800)]
+
+    merged, _, duplicates = merge_chunk_transactions([PART_1, part_3])
+
+    assert duplicates == 0
+    assert len(merged) == 5
+
+
+def test_boundary_balance_break_is_flagged():
+    # Part 2 misses a row: its first balance does not follow from part 1's last
+    part_2 = [_txn("txn-1", "2024-04-05", 1000, 0, 10000)]
+
+    merged, boundaries, _ = merge_chunk_transactions([PART_1, part_2])
+    checks = check_boundary_balances(merged, boundaries)
+
+    assert checks == [{"index": 3, "previousBalance": 10300.0, "balance": 10000.0, "status": "mismatch"}]
+
+
+def test_balance_continuity_accepts_newest_first_and_missing_balances():
+    older, newer = PART_1[1], PART_1[2]
+
+    assert balance_continuity(older, newer) == "ok"
+    assert balance_continuity(newer, older) == "ok"
+    assert balance_continuity(older, dict(newer, balance=None)) == "unknown"
@@ -0,0 +1,107 @@
+# TokenLedger under contention: increments and reservations from several
+# processes and threads sharing one SQLite file.
+
+import multiprocessing
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from token_ledger import TokenLedger
+
+PROCESSES = 4
+THREADS = 8
+INCREMENTS = 50  # per thread
+
+
+def _increment(db_path: str):
+    ledger = TokenLedger(db_path)
+
+    def work(_):
+        for _ in range(INCREMENTS):
+            ledger.add(3)
+            ledger.add(1, bucket="other")
+
+    with ThreadPoolExecutor(THREADS) as pool:
+        list(pool.map(work, range(THREADS)))
+
+
+def _reserve(db_path: str, granted):
+    ledger = TokenLedger(db_path)
+    for _ in range(25):
+        reservation, _ = ledger.reserve(100, lambda plan: 5000, bucket="budget")
+        if reservation is not None:
+            granted.value += 1
+
+
+def test_concurrent_increments_are_not_lost(tmp_path):
+    db_path = str(tmp_path / "ledger.db")
+    TokenLedger(db_path)
+
+    workers = [multiprocessing.Process(target=_increment, args=(db_path,)) for _ in range(PROCESSES)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(60)
+        assert worker.exitcode == 0
+
+    ledger = TokenLedger(db_path)
+    total = PROCESSES * THREADS * INCREMENTS
+    assert ledger.get()["used"] == total * 3
+    assert ledger.get("other")["used"] == total
+
+
+def test_concurrent_reservations_stay_within_limit(tmp_path):
+    db_path = str(tmp_path / "ledger.db")
+    TokenLedger(db_path)
+    granted = multiprocessing.Value("i", 0, lock=True)
+
+    workers = [multiprocessing.Process(target=_reserve, args=(db_path, granted)) for _ in range(PROCESSES)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(60)
+        assert worker.exitcode == 0
+
+    # 100 attempts of 100 tokens against a 5000 limit: exactly 50 fit
+    assert granted.value == 50
+    assert TokenLedger(db_path).get("budget")["reserved"] == 5000
+
+
+def test_get_does_not_wait_for_the_write_lock(tmp_path):
+    db_path = str(tmp_path / "ledger.db")
+    ledger = TokenLedger(db_path)
+    ledger.add(7)
+
+    # Another writer holds the write lock
+    writer = sqlite3.connect(db_path, isolation_level=None)
+    writer.execute("BEGIN IMMEDIATE")
+    writer.execute("UPDATE token_usage SET used = used + 1")
+    try:
+        result = {}
+
+        def read():
+            started = time.perf_counter()
+            result["data"] = ledger.get()
+            result["seconds"] = time.perf_counter() - started
+
+        reader = threading.Thread(target=read)
+        reader.start()
+        reader.join(5)
+        assert result["seconds"] < 0.5
+        assert result["data"]["used"] == 7
+    finally:
+        writer.execute("ROLLBACK")
+        writer.close()
+
+
+def test_expired_reservations_are_dropped(tmp_path):
+    ledger = TokenLedger(str(tmp_path / "ledger.db"))
+    reservation, _ = ledger.reserve(400, lambda plan: 1000, ttl=-1)
+    assert reservation is not None
+    assert ledger.get()["reserved"] == 0
+
+    # The next reservation sweeps it, so the whole limit is available again
+    reservation, data = ledger.reserve(1000, lambda plan: 1000)
+    assert reservation is not None
+    assert data["reserved"] == 1000
@@ -0,0 +1,244 @@
+# Token Usage Ledger
+# SQLite (WAL mode) backed token counter with atomic increments.
+# Safe to share between threads and between gunicorn/uvicorn worker processes.
+# Model calls reserve their estimated tokens before they run and settle the
+# reservation with the real count afterwards (see usage_budget.py).
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Optional, Tuple
+
+DEFAULT_BUCKET = "global"
+
+_COLUMNS = ("used", "plan", "reset_date", "last_notified_threshold")
+
+
+def _current_month() -> str:
+    return datetime.now().strftime("%Y-%m")
+
+
+class TokenLedger:
+    """
+    Monthly token usage counters stored in SQLite.
+
+    Every write runs in a single IMMEDIATE transaction, so concurrent
+    increments from any number of processes are serialized by SQLite and
+    never lose updates. The monthly reset happens inside the same transaction.
+    get() only reads (a deferred transaction, which never waits for the write
+    lock in WAL mode) and reports a bucket as the next write would leave it.
+
+    Reservations hold tokens of calls in flight against a bucket's limit. They
+    expire on their own, so a crashed worker does not hold budget forever.
+    """
+
+    def __init__(self, db_path: str, default_plan: str = "Bronze", legacy_json_path: Optional[str] = None):
+        self.db_path = db_path
+        self.default_plan = default_plan
+        self._local = threading.local()
+
+        with self._transaction() as conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS token_usage (
+                    bucket TEXT PRIMARY KEY,
+                    used INTEGER NOT NULL DEFAULT 0,
+                    plan TEXT NOT NULL,
+                    reset_date TEXT,
+                    last_notified_threshold INTEGER NOT NULL DEFAULT 0
+                )"""
+            )
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS token_reservations (
+                    id TEXT PRIMARY KEY,
+                    bucket TEXT NOT NULL,
+                    tokens INTEGER NOT NULL,
+                    expires REAL NOT NULL
+                )"""
+            )
+            empty = conn.execute("SELECT COUNT(*) FROM token_usage").fetchone()[0] == 0
+
+        if empty and legacy_json_path and os.path.exists(legacy_json_path):
+            self._import_legacy_json(legacy_json_path)
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # NORMAL is durable across process crashes in WAL mode and avoids an fsync per commit
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=10000")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    @contextmanager
+    def _read_transaction(self):
+        conn = self._connection()
+        # Deferred: a consistent snapshot without taking the write lock
+        conn.execute("BEGIN")
+        try:
+            yield conn
+        finally:
+            conn.execute("COMMIT")
+
+    def _new_bucket_plan(self, conn: sqlite3.Connection, bucket: str) -> str:
+        # New buckets start on the plan chosen before usage was tracked per bucket
+        inherited = None
+        if bucket != DEFAULT_BUCKET:
+            inherited = conn.execute("SELECT plan FROM token_usage WHERE bucket = ?", (DEFAULT_BUCKET,)).fetchone()
+        return inherited[0] if inherited else self.default_plan
+
+    def _row(self, conn: sqlite3.Connection, bucket: str) -> dict:
+        """Fetch a bucket, creating it or applying the monthly reset as needed (inside a transaction)"""
+        month = _current_month()
+        row = conn.execute(
+            "SELECT used, plan, reset_date, last_notified_threshold FROM token_usage WHERE bucket = ?",
+            (bucket,)
+        ).fetchone()
+
+        if row is None:
+            plan = self._new_bucket_plan(conn, bucket)
+            conn.execute(
+                "INSERT INTO token_usage (bucket, used, plan, reset_date, last_notified_threshold) VALUES (?, 0, ?, ?, 0)",
+                (bucket, plan, month)
+            )
+            return {"used": 0, "plan": plan, "reset_date": month, "last_notified_threshold": 0}
+
+        data = dict(zip(_COLUMNS, row))
+        if data["reset_date"] != month:
+            conn.execute(
+                "UPDATE token_usage SET used = 0, reset_date = ?, last_notified_threshold = 0 WHERE bucket = ?",
+                (month, bucket)
+            )
+            data.update(used=0, reset_date=month, last_notified_threshold=0)
+        return data
+
+    def _reserved(self, conn: sqlite3.Connection, bucket: str) -> int:
+        """Tokens held by unexpired reservations of a bucket"""
+        return conn.execute(
+            "SELECT COALESCE(SUM(tokens), 0) FROM token_reservations WHERE bucket = ? AND expires >= ?",
+            (bucket, time.time())
+        ).fetchone()[0]
+
+    def get(self, bucket: str = DEFAULT_BUCKET) -> dict:
+        """Return {used, reserved, plan, reset_date, last_notified_threshold} for a bucket (read-only)"""
+        month = _current_month()
+        with self._read_transaction() as conn:
+            row = conn.execute(
+                "SELECT used, plan, reset_date, last_notified_threshold FROM token_usage WHERE bucket = ?",
+                (bucket,)
+            ).fetchone()
+            if row is None:
+                data = {"used": 0, "plan": self._new_bucket_plan(conn, bucket), "reset_date": month, "last_notified_threshold": 0}
+            else:
+                data = dict(zip(_COLUMNS, row))
+                if data["reset_date"] != month:
+                    data.update(used=0, reset_date=month, last_notified_threshold=0)
+            data["reserved"] = self._reserved(conn, bucket)
+            return data
+
+    def reserve(
+        self,
+        tokens: int,
+        limit_for: Callable[[str], int],
+        bucket: str = DEFAULT_BUCKET,
+        ttl: float = 900
+    ) -> Tuple[Optional[str], dict]:
+        """
+        Atomically reserve tokens if used + reserved + tokens stays within the plan limit.
+
+        Args:
+            tokens: Tokens to hold
+            limit_for: Plan name -> token limit
+            bucket: Bucket to charge
+            ttl: Seconds until the reservation lapses if it is never settled
+
+        Returns:
+            (reservation id, or None if it does not fit, bucket state with "reserved" and "limit")
+        """
+        with self._transaction() as conn:
+            # Reservations of calls that never settled (crashed worker) lapse here
+            conn.execute("DELETE FROM token_reservations WHERE expires < ?", (time.time(),))
+            data = self._row(conn, bucket)
+            data["reserved"] = self._reserved(conn, bucket)
+            data["limit"] = limit_for(data["plan"])
+            if data["used"] + data["reserved"] + tokens > data["limit"]:
+                return None, data
+            reservation = uuid.uuid4().hex
+            conn.execute(
+                "INSERT INTO token_reservations (id, bucket, tokens, expires) VALUES (?, ?, ?, ?)",
+                (reservation, bucket, tokens, time.time() + ttl)
+            )
+            data["reserved"] += tokens
+            return reservation, data
+
+    def settle(self, reservation: str, tokens: int, bucket: str = DEFAULT_BUCKET) -> dict:
+        """Release a reservation and add the tokens actually used (0 if the call failed unbilled)"""
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM token_reservations WHERE id = ?", (reservation,))
+            data = self._row(conn, bucket)
+            if tokens:
+                conn.execute("UPDATE token_usage SET used = used + ? WHERE bucket = ?", (tokens, bucket))
+                data["used"] += tokens
+            return data
+
+    def add(self, tokens: int, bucket: str = DEFAULT_BUCKET) -> dict:
+        """Atomically add tokens to a bucket and return its updated state"""
+        with self._transaction() as conn:
+            data = self._row(conn, bucket)
+            conn.execute("UPDATE token_usage SET used = used + ? WHERE bucket = ?", (tokens, bucket))
+            data["used"] += tokens
+            return data
+
+    def update(self, bucket: str = DEFAULT_BUCKET, **fields) -> dict:
+        """Set one or more of plan / used / last_notified_threshold for a bucket"""
+        unknown = set(fields) - {"used", "plan", "last_notified_threshold"}
+        if unknown:
+            raise ValueError(f"Unknown token usage fields: {sorted(unknown)}")
+
+        with self._transaction() as conn:
+            data = self._row(conn, bucket)
+            if fields:
+                assignments = ", ".join(f"{name} = ?" for name in fields)
+                conn.execute(
+                    f"UPDATE token_usage SET {assignments} WHERE bucket = ?",
+                    (*fields.values(), bucket)
+                )
+                data.update(fields)
+            return data
+
+    def _import_legacy_json(self, path: str):
+        """One-time migration from the old token_usage.json file"""
+        try:
+            with open(path, "r") as f:
+                legacy = json.load(f)
+            with self._transaction() as conn:
+                conn.execute(
+                    "INSERT OR IGNORE INTO token_usage (bucket, used, plan, reset_date, last_notified_threshold) VALUES (?, ?, ?, ?, ?)",
+                    (
+                        DEFAULT_BUCKET,
+                        int(legacy.get("used", 0)),
+                        legacy.get("plan") or self.default_plan,
+                        legacy.get("reset_date"),
+                        int(legacy.get("last_notified_threshold", 0))
+                    )
+                )
+            print(f"📊 Migrated token usage from {path}")
+        except Exception as e:
+            print(f"Error migrating token usage from {path}: {e}")
@@ -0,0 +1,207 @@
+# Upload Spooling
+# Copies uploaded files to named temp files in fixed-size chunks while hashing them,
+# so request handlers pass file paths around instead of whole-file bytes copies.
+# RequestSizeLimit caps the request body before the form parser buffers it.
+
+import asyncio
+import hashlib
+import os
+import tempfile
+import weakref
+from typing import Optional
+
+from starlette.exceptions import HTTPException
+from starlette.responses import JSONResponse
+
+# Largest single uploaded file accepted
+UPLOAD_MAX_MB = float(os.getenv("UPLOAD_MAX_MB", "50"))
+UPLOAD_MAX_BYTES = int(UPLOAD_MAX_MB * 1024 * 1024)
+# Largest request body accepted (checked against Content-Length before the body is
+# read, and against the bytes actually received; see RequestSizeLimit)
+REQUEST_MAX_MB = float(os.getenv("REQUEST_MAX_MB", "200"))
+REQUEST_MAX_BYTES = int(REQUEST_MAX_MB * 1024 * 1024)
+# Spooled files go here (defaults to the system temp dir)
+UPLOAD_TMP_DIR = os.getenv("UPLOAD_TMP_DIR") or None
+
+_CHUNK_SIZE = 1024 * 1024
+
+
+def _remove_file(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class UploadTooLarge(Exception):
+    """The uploaded file is larger than the configured limit"""
+
+
+class StoredFile:
+    """
+    A file on disk with its size and SHA-256.
+
+    The PDF layer opens it by path, so each engine reads only what it needs
+    from disk. read() loads it for the few consumers that need bytes (base64
+    for the model). Files created by spooling are deleted on close().
+    """
+
+    def __init__(
+        self,
+        path: str,
+        filename: str,
+        content_type: str,
+        size: int,
+        sha256: str,
+        owned: bool = True
+    ):
+        self.path = path
+        self.filename = filename
+        self.content_type = content_type
+        self.size = size
+        self.sha256 = sha256
+        # Also deletes an owned file that is garbage collected without close()
+        # (e.g. a streaming response whose body never started)
+        self._finalizer = weakref.finalize(self, _remove_file, path) if owned else None
+
+    @classmethod
+    def from_path(cls, path: str, filename: str, content_type: str) -> "StoredFile":
+        """Wrap an existing file (not deleted on close), hashing it in chunks"""
+        digest = hashlib.sha256()
+        size = 0
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(_CHUNK_SIZE), b""):
+                digest.update(chunk)
+                size += len(chunk)
+        return cls(path, filename, content_type, size, digest.hexdigest(), owned=False)
+
+    @property
+    def is_pdf(self) -> bool:
+        return self.content_type == "application/pdf" or (self.filename or "").lower().endswith(".pdf")
+
+    def read(self) -> bytes:
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def close(self):
+        if self._finalizer is not None:
+            self._finalizer()
+
+    def __enter__(self) -> "StoredFile":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+async def spool_upload(file, max_bytes: Optional[int] = None) -> StoredFile:
+    """
+    Copy an UploadFile to a named temp file in 1MB chunks, hashing as it goes.
+
+    Memory use is one chunk regardless of file size, and each chunk is written
+    in a worker thread so the event loop is not blocked on disk. Copying stops
+    as soon as the file exceeds max_bytes (UPLOAD_MAX_MB by default).
+
+    This is not an early reject: by the time the handler runs, Starlette's form
+    parser has already received the whole body into its own SpooledTemporaryFile,
+    so this is a second copy. The body as a whole is capped earlier, while it
+    is received, by RequestSizeLimit (REQUEST_MAX_MB).
+
+    Args:
+        file: FastAPI/Starlette UploadFile
+        max_bytes: Size limit in bytes
+
+    Returns:
+        StoredFile; close it (or use it as a context manager) to delete the copy
+
+    Raises:
+        UploadTooLarge: The file is larger than max_bytes
+    """
+    max_bytes = max_bytes or UPLOAD_MAX_BYTES
+    digest = hashlib.sha256()
+    size = 0
+
+    fd, path = tempfile.mkstemp(prefix="upload-", suffix=".bin", dir=UPLOAD_TMP_DIR)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                chunk = await file.read(_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge(f"{file.filename} is larger than {max_bytes // (1024 * 1024)}MB")
+                digest.update(chunk)
+                await asyncio.to_thread(out.write, chunk)
+    except BaseException:
+        _remove_file(path)
+        raise
+
+    return StoredFile(
+        path,
+        file.filename or "upload",
+        file.content_type or "application/octet-stream",
+        size,
+        digest.hexdigest()
+    )
+
+
+class RequestSizeLimit:
+    """
+    ASGI middleware refusing request bodies larger than max_bytes with 413.
+
+    A declared Content-Length over the limit is refused before any of the body
+    is read; otherwise the http.request bytes are counted as the app receives
+    them, and the request fails once they pass the limit. Written as plain ASGI
+    (not @app.middleware) so streaming responses, disconnects and cancellation
+    reach the endpoint unchanged.
+
+    Args:
+        app: The ASGI app to wrap
+        max_bytes: Largest body accepted
+    """
+
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > self.max_bytes:
+            await self._too_large(scope, receive, send)
+            return
+
+        received = 0
+        response_started = False
+
+        async def receive_limited():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    raise HTTPException(status_code=413, detail="Request body too large")
+            return message
+
+        async def send_tracked(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, receive_limited, send_tracked)
+        except HTTPException as e:
+            # Raised by receive_limited outside the app's own exception handling
+            if e.status_code != 413 or response_started:
+                raise
+            await self._too_large(scope, receive, send)
+
+    @staticmethod
+    async def _too_large(scope, receive, send):
+        await JSONResponse(status_code=413, content={"detail": "Request body too large"})(scope, receive, send)
@@ -0,0 +1,130 @@
+# Token Budget
+# Per-API-key monthly token budgets, enforced before model calls. Each backend
+# API key has its own bucket in the token ledger. A request binds its bucket
+# once (bind_usage); every model call made while serving it then reserves its
+# estimated tokens first, is refused if they do not fit in what is left of the
+# plan, and settles the reservation with the usage the response reports.
+
+import asyncio
+import os
+from contextvars import ContextVar
+from typing import Callable, Optional
+
+from google.api_core.exceptions import ResourceExhausted
+
+from token_ledger import TokenLedger
+
+# Output tokens held for each call on top of its estimated input
+TOKEN_RESERVE_OUTPUT_TOKENS = int(os.getenv("TOKEN_RESERVE_OUTPUT_TOKENS", "1024"))
+# Largest input a single call may send (gemini-2.5-flash context window)
+GEMINI_MAX_INPUT_TOKENS = int(os.getenv("GEMINI_MAX_INPUT_TOKENS", "1048576"))
+
+
+class TokenBudgetExceeded(ResourceExhausted):
+    """
+    The call's estimated tokens do not fit in what is left of the plan.
+    A ResourceExhausted, so batch loops stop on it like on a provider 429.
+    """
+
+    def __init__(self, requested: int, used: int, reserved: int, limit: int, plan: str):
+        self.requested = requested
+        self.used = used
+        self.reserved = reserved
+        self.limit = limit
+        self.plan = plan
+        super().__init__(
+            f"Token limit reached: this request needs ~{requested} tokens but only "
+            f"{max(limit - used - reserved, 0)} of {limit} are left on your {plan} plan. "
+            "Please upgrade your plan or reset your token usage in Settings."
+        )
+
+
+class RequestTooLarge(Exception):
+    """A single call is larger than the model accepts"""
+
+    def __init__(self, tokens: int):
+        self.tokens = tokens
+        super().__init__(f"Request is too large for the model (~{tokens} tokens, limit {GEMINI_MAX_INPUT_TOKENS})")
+
+
+def check_request_size(tokens: int):
+    """
+    Raises:
+        RequestTooLarge: tokens exceed GEMINI_MAX_INPUT_TOKENS
+    """
+    if tokens > GEMINI_MAX_INPUT_TOKENS:
+        raise RequestTooLarge(tokens)
+
+
+class UsageScope:
+    """
+    Token budget of one request: the ledger bucket its model calls are charged to.
+
+    Args:
+        ledger: Token ledger
+        bucket: Bucket of the caller's API key
+        limit_for: Plan name -> monthly token limit
+    """
+
+    def __init__(self, ledger: TokenLedger, bucket: str, limit_for: Callable[[str], int]):
+        self.ledger = ledger
+        self.bucket = bucket
+        self.limit_for = limit_for
+        # Tokens the responses of this request reported
+        self.tokens_used = 0
+
+    def preflight(self, input_tokens: int, calls: int = 1):
+        """
+        Refuse a multi-call extraction up front if its estimate does not fit,
+        instead of failing part way after paying for the first calls. Blocking.
+
+        Args:
+            input_tokens: Estimated input tokens of all calls
+            calls: Number of calls (each is allowed TOKEN_RESERVE_OUTPUT_TOKENS of output)
+
+        Raises:
+            TokenBudgetExceeded: The estimate does not fit in the remaining budget
+        """
+        requested = input_tokens + calls * TOKEN_RESERVE_OUTPUT_TOKENS
+        data = self.ledger.get(self.bucket)
+        limit = self.limit_for(data["plan"])
+        if data["used"] + data["reserved"] + requested > limit:
+            raise TokenBudgetExceeded(requested, data["used"], data["reserved"], limit, data["plan"])
+
+    async def reserve(self, input_tokens: int) -> str:
+        """
+        Hold the call's estimated tokens (input plus output allowance).
+
+        Raises:
+            TokenBudgetExceeded: They do not fit in the remaining budget
+        """
+        requested = input_tokens + TOKEN_RESERVE_OUTPUT_TOKENS
+        reservation, data = await asyncio.to_thread(self.ledger.reserve, requested, self.limit_for, self.bucket)
+        if reservation is None:
+            raise TokenBudgetExceeded(requested, data["used"], data["reserved"], data["limit"], data["plan"])
+        return reservation
+
+    async def settle(self, reservation: str, tokens: Optional[int]):
+        """Replace the reservation with the tokens the response reported (None: the call failed)"""
+        tokens = tokens or 0
+        self.tokens_used += tokens
+        try:
+            await asyncio.to_thread(self.ledger.settle, reservation, tokens, self.bucket)
+        except Exception as e:
+            print(f"Error settling token reservation: {e}")
+
+
+_current_scope: ContextVar[Optional[UsageScope]] = ContextVar("usage_scope", default=None)
+
+
+def bind_usage(scope: UsageScope):
+    """
+    Charge the model calls of the current request (and the tasks it starts
+    from now on) to this scope.
+    """
+    _current_scope.set(scope)
+
+
+def current_usage() -> Optional[UsageScope]:
+    """Scope bound to the current request, if any"""
+    return _current_scope.get()